@@ -0,0 +1,357 @@
+import argparse
+import hashlib
+import io
+import json
+import lzma
+import multiprocessing as mp
+import shutil
+import sqlite3
+import sys
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+import chunk_diff
+import jar_store
+import storage
+
+_cache_root = Path("/Users/ryan/.vscape2/")
+_jar_db_uri = (
+    f"file:{Path(__file__).parent.parent / 'dl_standalone_latest.sqlite3'}?mode=ro"
+)
+_batch_db_path = Path(__file__).parent / "batch.sqlite3"
+# Cache snapshots are numbered by chunk_diff's registry of cache versions.
+_versions_db_path = Path(__file__).parent / "chunks.sqlite3"
+# How much of a compressed cache file is kept in memory before spilling to disk.
+_spool_size = 64 * 1024 * 1024
+
+# Version sources: every jar archived by dl_standalone_latest, and every snapshot of the client cache.
+SOURCE_JAR, SOURCE_CACHE = "jar", "cache"
+
+
+def entropy_profile(data: bytes, block_size: int = 65536) -> bytes:
+    """Shannon entropy (bits/byte) of each ``block_size`` block, as little-endian float32."""
+    a = np.frombuffer(data, dtype=np.uint8)
+    blocks = -(-len(a) // block_size)
+    ret = np.zeros(blocks, dtype=np.float32)
+    for ii in range(blocks):
+        counts = np.bincount(a[ii * block_size : (ii + 1) * block_size], minlength=256)
+        p = counts[counts > 0] / counts.sum()
+        ret[ii] = abs((p * np.log2(p)).sum())
+    return ret.astype("<f4").tobytes()
+
+
+def bigram_model(data: bytes) -> bytes:
+    """256x256 byte-bigram counts, row = current byte, column = next byte, as little-endian uint32."""
+    a = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    counts = np.bincount((a[:-1] << 8) | a[1:], minlength=256 * 256)
+    return counts.astype("<u4").tobytes()
+
+
+# Analyses over the content of one version item. member_hashes is special-cased: it needs the item's listing.
+ANALYSES: dict[str, Callable[[bytes], bytes]] = {
+    "entropy_profile": entropy_profile,
+    "bigram_model": bigram_model,
+}
+ALL_ANALYSES = (*ANALYSES, "member_hashes")
+
+
+# versionID is the chunk_diff versions.versionID of the snapshot.
+_cache_files_columns = """
+        (
+            versionID INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            blake2b TEXT NOT NULL REFERENCES cacheBlobs (blake2b),
+            PRIMARY KEY (versionID, name)
+        )
+"""
+
+
+def setup(con: sqlite3.Connection, versions: sqlite3.Connection) -> None:
+    """Creates the tables of ``con``. ``versions`` is the chunk_diff database holding the cache version registry."""
+    chunk_diff.setup(versions)
+    if con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cacheSnapshots'"
+    ).fetchone():
+        _migrate_snapshots(con, versions)
+    con.executescript(
+        f"""
+        CREATE TABLE IF NOT EXISTS cacheBlobs
+        (
+            blake2b TEXT PRIMARY KEY,
+            blob BLOB NOT NULL,
+            sizeBytes INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS cacheFiles {_cache_files_columns};
+        CREATE TABLE IF NOT EXISTS results
+        (
+            source TEXT NOT NULL,
+            versionID INTEGER NOT NULL,
+            item TEXT NOT NULL,
+            analysis TEXT NOT NULL,
+            result BLOB NOT NULL,
+            PRIMARY KEY (source, versionID, item, analysis)
+        );
+        CREATE INDEX IF NOT EXISTS resultsAnalysis ON results (analysis, item);
+        CREATE TABLE IF NOT EXISTS completed
+        (
+            source TEXT NOT NULL,
+            versionID INTEGER NOT NULL,
+            analysis TEXT NOT NULL,
+            PRIMARY KEY (source, versionID, analysis)
+        );
+        """
+    )
+    con.commit()
+
+
+def _migrate_snapshots(con: sqlite3.Connection, versions: sqlite3.Connection) -> None:
+    # Snapshots used to be numbered by a cacheSnapshots table of their own: renumber them by the registry
+    ids = [
+        (snapshot_id, chunk_diff.register_version(versions, cache_version, iso8601))
+        for snapshot_id, cache_version, iso8601 in con.execute(
+            "SELECT snapshotID, cacheVersion, iso8601 FROM cacheSnapshots"
+        ).fetchall()
+    ]
+    versions.commit()
+    con.execute(
+        "CREATE TEMP TABLE snapshotVersions (snapshotID INTEGER PRIMARY KEY, versionID INTEGER NOT NULL)"
+    )
+    con.executemany("INSERT INTO snapshotVersions VALUES (?, ?)", ids)
+    renumber = "UPDATE {0} SET versionID = -(SELECT versionID FROM snapshotVersions WHERE snapshotID = {0}.versionID)"
+    con.executescript(
+        f"""
+        BEGIN;
+        CREATE TABLE cacheFilesByVersion {_cache_files_columns};
+        INSERT INTO cacheFilesByVersion (versionID, name, blake2b)
+            SELECT versionID, name, blake2b FROM cacheFiles JOIN snapshotVersions USING (snapshotID);
+        DROP TABLE cacheFiles;
+        ALTER TABLE cacheFilesByVersion RENAME TO cacheFiles;
+        -- Negated first, so no row collides with one not yet renumbered
+        {renumber.format("results")} WHERE source = '{SOURCE_CACHE}';
+        UPDATE results SET versionID = -versionID WHERE source = '{SOURCE_CACHE}';
+        {renumber.format("completed")} WHERE source = '{SOURCE_CACHE}';
+        UPDATE completed SET versionID = -versionID WHERE source = '{SOURCE_CACHE}';
+        DROP TABLE cacheSnapshots;
+        DROP TABLE snapshotVersions;
+        COMMIT;
+        """
+    )
+
+
+def snapshot_cache(
+    con: sqlite3.Connection, versions: sqlite3.Connection, root: Path = _cache_root
+) -> int | None:
+    """Archives the client cache under ``root`` if its ``cacheVersion.dat`` has not been archived before.
+
+    Files are stored content-addressed, so unchanged files cost nothing, and are hashed and compressed as streams.
+    Returns the version id in the chunk_diff registry, or ``None``.
+    """
+    version_id = chunk_diff.register_version(
+        versions, chunk_diff.version_hash((root / "cacheVersion.dat").read_bytes())
+    )
+    versions.commit()
+    if con.execute(
+        "SELECT 1 FROM cacheFiles WHERE versionID = ? LIMIT 1", (version_id,)
+    ).fetchone():
+        return None
+    for path in sorted(p for p in root.rglob("*") if p.is_file()):
+        with path.open("rb") as fd:
+            digest = hashlib.file_digest(
+                fd, lambda: hashlib.blake2b(digest_size=16)
+            ).hexdigest()
+            if not con.execute(
+                "SELECT 1 FROM cacheBlobs WHERE blake2b = ?", (digest,)
+            ).fetchone():
+                _store_blob(con, digest, fd)
+        con.execute(
+            "INSERT INTO cacheFiles (versionID, name, blake2b) VALUES (?, ?, ?)",
+            (version_id, str(path.relative_to(root)), digest),
+        )
+    con.commit()
+    return version_id
+
+
+def _store_blob(con: sqlite3.Connection, digest: str, fd: BinaryIO) -> None:
+    # Compressed a chunk at a time, then written into a zeroblob of the final size
+    fd.seek(0)
+    compressor = lzma.LZMACompressor(preset=1)
+    with tempfile.SpooledTemporaryFile(max_size=_spool_size) as spool:
+        while chunk := fd.read(storage.CHUNK_SIZE):
+            spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        rowid = con.execute(
+            "INSERT INTO cacheBlobs (blake2b, blob, sizeBytes) VALUES (?, zeroblob(?), ?)",
+            (digest, spool.tell(), fd.tell()),
+        ).lastrowid
+        spool.seek(0)
+        with con.blobopen("cacheBlobs", "blob", rowid) as blob:
+            shutil.copyfileobj(spool, blob, storage.CHUNK_SIZE)
+
+
+def _jar_items(jar_id: int) -> Iterator[tuple[str, str, bytes]]:
+    # One item per jar: the concatenated member contents. The stored archive bytes are mostly deflate noise.
+    with sqlite3.connect(_jar_db_uri, uri=True) as con:
+        columns = {row[1] for row in con.execute("PRAGMA table_info(jars)")}
+        jar_blob, jar_storage = con.execute(
+            "SELECT jarBlob, "
+            + ("storage" if "storage" in columns else f"'{jar_store.STORAGE_XZ}'")
+            + " FROM jars WHERE jarID = ?",
+            (jar_id,),
+        ).fetchone()
+        members, parts = [], []
+        if jar_storage == jar_store.STORAGE_MEMBERS:
+            members = jar_store.list_members(con, jar_id)
+            parts = [storage.get(con, blake2b) for _, blake2b in members]
+        else:
+            with zipfile.ZipFile(io.BytesIO(lzma.decompress(jar_blob))) as jar:
+                for info in jar.infolist():
+                    data = jar.read(info)
+                    members.append((info.filename, jar_store.member_hash(data)))
+                    parts.append(data)
+    yield "", json.dumps(members), b"".join(parts)
+
+
+def _cache_items(version_id: int) -> Iterator[tuple[str, str, bytes]]:
+    with sqlite3.connect(_batch_db_path) as con:
+        files = con.execute(
+            "SELECT name, blake2b FROM cacheFiles WHERE versionID = ? ORDER BY name",
+            (version_id,),
+        ).fetchall()
+        yield "", json.dumps(files), b""
+        for name, blake2b in files:
+            (blob,) = con.execute(
+                "SELECT blob FROM cacheBlobs WHERE blake2b = ?", (blake2b,)
+            ).fetchone()
+            yield name, "", lzma.decompress(blob)
+
+
+def _run_kernel(task: tuple[str, int, tuple[str, ...]]) -> tuple[str, int, list[tuple]]:
+    # Runs in a worker: load one version and run each requested analysis over each of its items.
+    source, version_id, analyses = task
+    items = _jar_items(version_id) if source == SOURCE_JAR else _cache_items(version_id)
+    rows = []
+    for item, listing, data in items:
+        if listing and "member_hashes" in analyses:
+            rows.append((item, "member_hashes", listing.encode()))
+        if not data:
+            continue
+        for analysis in analyses:
+            if analysis in ANALYSES:
+                rows.append((item, analysis, ANALYSES[analysis](data)))
+    return source, version_id, rows
+
+
+def pending(con: sqlite3.Connection, analyses: tuple[str, ...]) -> list[tuple]:
+    """Returns ``(source, versionID, analyses still to run)`` for every version missing any of ``analyses``."""
+    versions = []
+    try:
+        with sqlite3.connect(_jar_db_uri, uri=True) as jar_con:
+            versions += [
+                (SOURCE_JAR, row[0])
+                for row in jar_con.execute("SELECT jarID FROM jars ORDER BY jarID")
+            ]
+    except sqlite3.OperationalError:
+        pass  # No jars archived yet
+    versions += [
+        (SOURCE_CACHE, row[0])
+        for row in con.execute(
+            "SELECT DISTINCT versionID FROM cacheFiles ORDER BY versionID"
+        )
+    ]
+    done = set(con.execute("SELECT source, versionID, analysis FROM completed"))
+    tasks = []
+    for source, version_id in versions:
+        todo = tuple(a for a in analyses if (source, version_id, a) not in done)
+        if todo:
+            tasks.append((source, version_id, todo))
+    return tasks
+
+
+def run(con: sqlite3.Connection, analyses: tuple[str, ...] = ALL_ANALYSES) -> int:
+    """Runs ``analyses`` over every version not yet processed, one version per worker. Returns versions processed."""
+    for analysis in analyses:
+        if analysis not in ALL_ANALYSES:
+            raise ValueError(f"Unknown analysis {analysis}.")
+    tasks = pending(con, analyses)
+    with mp.Pool() as pool:
+        for source, version_id, rows in pool.imap_unordered(_run_kernel, tasks):
+            con.executemany(
+                "INSERT OR REPLACE INTO results (source, versionID, item, analysis, result) VALUES (?, ?, ?, ?, ?)",
+                ((source, version_id, *row) for row in rows),
+            )
+            todo = next(t[2] for t in tasks if t[:2] == (source, version_id))
+            con.executemany(
+                "INSERT OR IGNORE INTO completed (source, versionID, analysis) VALUES (?, ?, ?)",
+                ((source, version_id, analysis) for analysis in todo),
+            )
+            con.commit()
+            print(f"[+] {source} {version_id}: {len(rows)} results")
+    return len(tasks)
+
+
+def load(
+    con: sqlite3.Connection, analysis: str, source: str = SOURCE_JAR, item: str = ""
+) -> list[tuple[int, np.ndarray | list]]:
+    """Returns ``(versionID, result)`` for ``analysis`` across every processed version, oldest first."""
+    ret = []
+    for version_id, blob in con.execute(
+        """
+        SELECT versionID, result FROM results
+        WHERE analysis = ? AND source = ? AND item = ? ORDER BY versionID
+        """,
+        (analysis, source, item),
+    ):
+        if analysis == "entropy_profile":
+            ret.append((version_id, np.frombuffer(blob, dtype="<f4")))
+        elif analysis == "bigram_model":
+            ret.append((version_id, np.frombuffer(blob, dtype="<u4").reshape(256, 256)))
+        else:
+            ret.append((version_id, json.loads(blob)))
+    return ret
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run analyses over every archived version."
+    )
+    # Checked below rather than with choices: argparse also checks an empty "*" list against them
+    parser.add_argument(
+        "analyses",
+        nargs="*",
+        metavar="ANALYSIS",
+        help=f"any of {', '.join(ALL_ANALYSES)} (default: all)",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="Archive the current client cache first.",
+    )
+    args = parser.parse_args()
+    unknown = sorted(set(args.analyses) - set(ALL_ANALYSES))
+    if unknown:
+        parser.error(f"unknown analyses: {', '.join(unknown)}")
+    analyses = tuple(args.analyses) or ALL_ANALYSES
+
+    with (
+        sqlite3.connect(_batch_db_path) as con,
+        sqlite3.connect(_versions_db_path) as versions,
+    ):
+        setup(con, versions)
+        if args.snapshot:
+            version_id = snapshot_cache(con, versions)
+            print(
+                "[=] Cache unchanged"
+                if version_id is None
+                else f"[+] Cache snapshot of version {version_id}"
+            )
+        count = run(con, analyses)
+    print(f"[+] Done. {count} versions processed.")
+
+
+if __name__ == "__main__":
+    main()
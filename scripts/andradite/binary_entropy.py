@@ -2,10 +2,9 @@ import os
 import multiprocessing as mp
 import statistics
 import math
-import matplotlib.pyplot as plt
 import numpy as np
 from pathlib import Path
-from typing import Literal
+from typing import BinaryIO, Literal
 from time import perf_counter_ns
 
 
@@ -69,10 +68,18 @@ class Perf(object):
 
 
 class Loader(object):
-    def __init__(self):
-        self._root_path = Path("/Users/ryan/.vscape2/")
+    def __init__(self, root_path: Path = Path("/Users/ryan/.vscape2/")):
+        self._root_path = root_path
         self._cache: dict[Path, bytes] = {}
 
+    def list_files(self) -> list[str]:
+        """Returns the path of every file in the cache, relative to its root, in sorted order."""
+        return sorted(
+            str(p.relative_to(self._root_path))
+            for p in self._root_path.rglob("*")
+            if p.is_file()
+        )
+
     def load(self, filename: str) -> bytes:
         path_to_file = self._root_path / filename
         try:
@@ -89,6 +96,10 @@ class Loader(object):
                 except IOError as e:
                     e.add_note(f"Failed to load {str(path_to_file)}")
 
+    def open_file(self, filename: str) -> BinaryIO:
+        """Opens a file of the cache for reading, bypassing ``load``'s cache, for callers that read each file once."""
+        return open(self._root_path / filename, "rb")
+
     def get_cache_version(self) -> bytes:
         return self.load("cacheVersion.dat")
 
@@ -172,6 +183,8 @@ def _binning_kernel_variance(_slice: list[float]) -> float:
 
 
 def main():
+    import matplotlib.pyplot as plt
+
     event_perf, overall_perf = Perf(), Perf()
 
     overall_perf(mode="reset")
@@ -2,7 +2,6 @@ from typing import NoReturn
 from pathlib import Path
 from collections import defaultdict
 from math import log2
-import matplotlib.pyplot as plt
 from typedef import Bits, Bytes
 
 
@@ -42,6 +41,8 @@ loader = Loader(path_to_cache=Path("/Users/ryan/.vscape2/"))
 
 
 def main() -> NoReturn:
+    import matplotlib.pyplot as plt
+
     sprites_idx = loader.get_sprites_idx()
 
     # length = len(sprites_idx)
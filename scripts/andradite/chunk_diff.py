@@ -0,0 +1,331 @@
+import argparse
+import bisect
+import hashlib
+import sqlite3
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Literal, NamedTuple
+
+import numpy as np
+
+from binary_entropy import Loader
+
+_chunk_db_path = Path(__file__).parent / "chunks.sqlite3"
+
+# Gear hash over a 32-byte window. A chunk ends where the top AVG_BITS bits of the hash are zero, so chunks
+# average 2**AVG_BITS bytes, bounded by MIN_CHUNK and MAX_CHUNK.
+WINDOW = 32
+AVG_BITS = 13
+MIN_CHUNK = 2 * 1024
+MAX_CHUNK = 64 * 1024
+_GEAR = np.random.default_rng(0x616E64).integers(
+    0, 2**64, 256, dtype=np.uint64, endpoint=False
+)
+_block_size = 4 * 1024 * 1024
+
+
+class Chunk(NamedTuple):
+    offset: int
+    length: int
+    blake2b: str
+
+
+class Region(NamedTuple):
+    kind: Literal["added", "removed", "moved"]
+    name: str
+    old_offset: int | None
+    new_offset: int | None
+    length: int
+
+
+def _cut_candidates(data: bytes) -> np.ndarray:
+    """Returns every offset that ends a window whose gear hash satisfies the cut condition, ascending."""
+    a = np.frombuffer(data, dtype=np.uint8)
+    shift = np.uint64(64 - AVG_BITS)
+    ret = []
+    for start in range(0, len(a), _block_size):
+        # Each block carries the preceding WINDOW - 1 bytes so hashes at its start see a full window
+        lo = max(start - WINDOW + 1, 0)
+        g = _GEAR[a[lo : start + _block_size]]
+        h = np.zeros(len(g), dtype=np.uint64)
+        for k in range(min(WINDOW, len(g))):
+            h[k:] += g[: len(g) - k] << np.uint64(k)
+        ret.append(np.flatnonzero((h[start - lo :] >> shift) == 0) + start + 1)
+    return np.concatenate(ret) if ret else np.zeros(0, dtype=np.int64)
+
+
+def chunk(data: bytes) -> list[Chunk]:
+    """Splits ``data`` into content-defined chunks. An insertion or deletion only changes the chunks around it."""
+    candidates = _cut_candidates(data)
+    ret, last, n = [], 0, len(data)
+    while last < n:
+        j = np.searchsorted(candidates, last + MIN_CHUNK)
+        if j < len(candidates) and candidates[j] <= last + MAX_CHUNK:
+            end = int(candidates[j])
+        else:
+            end = min(last + MAX_CHUNK, n)
+        ret.append(
+            Chunk(
+                last,
+                end - last,
+                hashlib.blake2b(data[last:end], digest_size=16).hexdigest(),
+            )
+        )
+        last = end
+    return ret
+
+
+def setup(con: sqlite3.Connection) -> None:
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS versions
+        (
+            versionID INTEGER PRIMARY KEY ASC AUTOINCREMENT,
+            cacheVersion TEXT UNIQUE NOT NULL,
+            iso8601 TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chunkedFiles
+        (
+            blake2b TEXT PRIMARY KEY,
+            sizeBytes INTEGER NOT NULL,
+            chunkCount INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files
+        (
+            versionID INTEGER NOT NULL REFERENCES versions (versionID),
+            name TEXT NOT NULL,
+            blake2b TEXT NOT NULL REFERENCES chunkedFiles (blake2b),
+            PRIMARY KEY (versionID, name)
+        );
+        CREATE TABLE IF NOT EXISTS manifests
+        (
+            fileHash TEXT NOT NULL REFERENCES chunkedFiles (blake2b),
+            position INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            blake2b TEXT NOT NULL,
+            PRIMARY KEY (fileHash, position)
+        );
+        """
+    )
+    con.commit()
+
+
+def version_hash(cache_version: bytes) -> str:
+    """Identifies a cache version by the content of its ``cacheVersion.dat``."""
+    return hashlib.blake2b(cache_version, digest_size=16).hexdigest()
+
+
+def register_version(
+    con: sqlite3.Connection, cache_version: str, iso8601: str | None = None
+) -> int:
+    """Returns the id of the cache version with ``version_hash`` ``cache_version``, adding it if it is new.
+
+    This is the registry of cache versions shared by every tool that records per-version data (see ``batch``), so
+    a version has the same id everywhere. Registering does not index it.
+    """
+    row = con.execute(
+        "SELECT versionID FROM versions WHERE cacheVersion = ?", (cache_version,)
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    return con.execute(
+        "INSERT INTO versions (cacheVersion, iso8601) VALUES (?, ?)",
+        (cache_version, iso8601 or datetime.now(tz=timezone.utc).isoformat()),
+    ).lastrowid
+
+
+def index_version(con: sqlite3.Connection, loader: Loader) -> int:
+    """Stores a chunk manifest for every file in ``loader``'s cache and returns the version id.
+
+    Versions are keyed by ``cacheVersion.dat``; files are keyed by content, so only changed files are chunked.
+    """
+    version_id = register_version(con, version_hash(loader.get_cache_version()))
+    if con.execute(
+        "SELECT 1 FROM files WHERE versionID = ? LIMIT 1", (version_id,)
+    ).fetchone():
+        return version_id
+
+    for name in loader.list_files():
+        # Files are read past Loader.load, which would keep the whole cache in memory. Each is hashed as a stream
+        # and only read whole, then released, if its content has not been chunked before.
+        with loader.open_file(name) as fd:
+            file_hash = hashlib.file_digest(
+                fd, lambda: hashlib.blake2b(digest_size=16)
+            ).hexdigest()
+            if not con.execute(
+                "SELECT 1 FROM chunkedFiles WHERE blake2b = ?", (file_hash,)
+            ).fetchone():
+                fd.seek(0)
+                data = fd.read()
+                chunks = chunk(data)
+                con.executemany(
+                    "INSERT INTO manifests (fileHash, position, offset, length, blake2b) VALUES (?, ?, ?, ?, ?)",
+                    ((file_hash, ii, *c) for ii, c in enumerate(chunks)),
+                )
+                con.execute(
+                    "INSERT INTO chunkedFiles (blake2b, sizeBytes, chunkCount) VALUES (?, ?, ?)",
+                    (file_hash, len(data), len(chunks)),
+                )
+                del data
+        con.execute(
+            "INSERT INTO files (versionID, name, blake2b) VALUES (?, ?, ?)",
+            (version_id, name, file_hash),
+        )
+    con.commit()
+    return version_id
+
+
+def _manifest(con: sqlite3.Connection, file_hash: str) -> list[Chunk]:
+    return [
+        Chunk(*row)
+        for row in con.execute(
+            "SELECT offset, length, blake2b FROM manifests WHERE fileHash = ? ORDER BY position",
+            (file_hash,),
+        )
+    ]
+
+
+def _longest_increasing(seq: list[int]) -> set[int]:
+    """Returns the indices into ``seq`` of one longest strictly increasing subsequence."""
+    tails, tail_idx, prev = [], [], [-1] * len(seq)
+    for ii, value in enumerate(seq):
+        j = bisect.bisect_left(tails, value)
+        if j > 0:
+            prev[ii] = tail_idx[j - 1]
+        if j == len(tails):
+            tails.append(value)
+            tail_idx.append(ii)
+        else:
+            tails[j], tail_idx[j] = value, ii
+    ret, ii = set(), tail_idx[-1] if tail_idx else -1
+    while ii != -1:
+        ret.add(ii)
+        ii = prev[ii]
+    return ret
+
+
+def _merge(regions: list[Region]) -> list[Region]:
+    # Coalesce runs of regions of the same kind that are contiguous on every side they have.
+    ret = []
+    for r in regions:
+        if ret:
+            p = ret[-1]
+            if (
+                p.kind == r.kind
+                and (p.old_offset is None or p.old_offset + p.length == r.old_offset)
+                and (p.new_offset is None or p.new_offset + p.length == r.new_offset)
+            ):
+                ret[-1] = p._replace(length=p.length + r.length)
+                continue
+        ret.append(r)
+    return ret
+
+
+def diff_manifests(name: str, old: list[Chunk], new: list[Chunk]) -> list[Region]:
+    """Pairs equal chunks between two manifests. Unpaired new chunks were added and unpaired old chunks removed;
+    paired chunks that are out of order relative to the longest in-order run of pairs were moved.
+    """
+    unused = defaultdict(deque)
+    for ii, c in enumerate(old):
+        unused[c.blake2b].append(ii)
+    added, pairs = [], []
+    for c in new:
+        if unused[c.blake2b]:
+            pairs.append((unused[c.blake2b].popleft(), c))
+        else:
+            added.append(Region("added", name, None, c.offset, c.length))
+    paired_old = {ii for ii, _ in pairs}
+    removed = [
+        Region("removed", name, c.offset, None, c.length)
+        for ii, c in enumerate(old)
+        if ii not in paired_old
+    ]
+    in_order = _longest_increasing([ii for ii, _ in pairs])
+    moved = [
+        Region("moved", name, old[ii].offset, c.offset, c.length)
+        for jj, (ii, c) in enumerate(pairs)
+        if jj not in in_order
+    ]
+    return _merge(added) + _merge(removed) + _merge(moved)
+
+
+def diff(con: sqlite3.Connection, old_version: int, new_version: int) -> list[Region]:
+    """Returns the regions added, removed and moved between two indexed versions. Files whose content is
+    unchanged are skipped without reading their manifests."""
+    old_files = dict(
+        con.execute(
+            "SELECT name, blake2b FROM files WHERE versionID = ?", (old_version,)
+        )
+    )
+    new_files = dict(
+        con.execute(
+            "SELECT name, blake2b FROM files WHERE versionID = ?", (new_version,)
+        )
+    )
+    ret = []
+    for name in sorted(old_files.keys() | new_files.keys()):
+        old_hash, new_hash = old_files.get(name), new_files.get(name)
+        if old_hash == new_hash:
+            continue
+        ret += diff_manifests(
+            name,
+            _manifest(con, old_hash) if old_hash else [],
+            _manifest(con, new_hash) if new_hash else [],
+        )
+    return ret
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Content-defined chunking diff between cache versions."
+    )
+    parser.add_argument(
+        "--root", type=Path, help="Index the cache at this path instead."
+    )
+    parser.add_argument(
+        "--old", type=int, help="Old version id. Defaults to the second-newest."
+    )
+    parser.add_argument(
+        "--new", type=int, help="New version id. Defaults to the newest."
+    )
+    args = parser.parse_args()
+
+    with sqlite3.connect(_chunk_db_path) as con:
+        setup(con)
+        loader = Loader() if args.root is None else Loader(root_path=args.root)
+        print(f"[+] Indexed cache as version {index_version(con, loader)}")
+
+        versions = [
+            row[0]
+            for row in con.execute(
+                # Versions registered by other tools but never indexed have no files
+                "SELECT versionID FROM versions WHERE versionID IN (SELECT versionID FROM files) ORDER BY versionID"
+            )
+        ]
+        if args.old is None and args.new is None and len(versions) < 2:
+            print("[=] Only one version indexed, nothing to diff.")
+            return
+        old = args.old if args.old is not None else versions[-2]
+        new = args.new if args.new is not None else versions[-1]
+
+        totals = defaultdict(lambda: defaultdict(int))
+        for region in diff(con, old, new):
+            totals[region.name][region.kind] += region.length
+            print(
+                f"{region.kind:>7} {region.name} old@{region.old_offset} new@{region.new_offset} "
+                f"{region.length} bytes"
+            )
+        for name, kinds in totals.items():
+            print(
+                f"[=] {name}: "
+                + ", ".join(f"{k} {v} bytes" for k, v in sorted(kinds.items()))
+            )
+        print(
+            f"[+] Done. {len(totals)} files changed between versions {old} and {new}."
+        )
+
+
+if __name__ == "__main__":
+    main()
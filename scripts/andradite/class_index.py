@@ -0,0 +1,479 @@
+import io
+import lzma
+import multiprocessing as mp
+import sqlite3
+import struct
+import sys
+import zipfile
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+sys.path.append(str(Path(__file__).parent.parent))
+import jar_store
+
+_jar_db_uri = (
+    f"file:{Path(__file__).parent.parent / 'dl_standalone_latest.sqlite3'}?mode=ro"
+)
+_index_db_path = Path(__file__).parent / "class_index.sqlite3"
+
+_chunksize = 64
+
+
+class ClassInfo(NamedTuple):
+    blake2b: str
+    name: str
+    super_name: str | None
+    major_version: int
+    strings: list[str]
+    # (kind, value): constant pool Integer/Long/Float/Double, plus iconst/bipush/sipush immediates in bytecode
+    numbers: list[tuple[str, float | int]]
+    # (kind, owner, name, descriptor) for every Fieldref/Methodref/InterfaceMethodref
+    refs: list[tuple[str, str, str, str]]
+    # (kind, access_flags, name, descriptor) for declared fields and methods
+    members: list[tuple[str, int, str, str]]
+
+
+class ClassFile(object):
+    """Minimal Java class-file reader: constant pool, fields, methods and the constants pushed by bytecode."""
+
+    # Constant pool tags
+    UTF8, INTEGER, FLOAT, LONG, DOUBLE = 1, 3, 4, 5, 6
+    CLASS, STRING, FIELDREF, METHODREF, INTERFACE_METHODREF, NAME_AND_TYPE = (
+        7,
+        8,
+        9,
+        10,
+        11,
+        12,
+    )
+    METHOD_HANDLE, METHOD_TYPE, DYNAMIC, INVOKE_DYNAMIC, MODULE, PACKAGE = (
+        15,
+        16,
+        17,
+        18,
+        19,
+        20,
+    )
+
+    # Operand bytes for fixed-size instructions; everything else not listed takes none.
+    _operands = {
+        **{
+            op: 1
+            for op in (0x10, 0x12, 0xA9, 0xBC, *range(0x15, 0x1A), *range(0x36, 0x3B))
+        },
+        **{
+            op: 2
+            for op in (
+                0x11,
+                0x13,
+                0x14,
+                0x84,
+                *range(0x99, 0xA9),
+                *range(0xB2, 0xB9),
+                0xBB,
+                0xBD,
+                0xC0,
+                0xC1,
+                0xC6,
+                0xC7,
+            )
+        },
+        0xC5: 3,
+        **{op: 4 for op in (0xB9, 0xBA, 0xC8, 0xC9)},
+    }
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+        if self._u4() != 0xCAFEBABE:
+            raise ValueError("Not a class file.")
+        self.minor_version, self.major_version = self._u2(), self._u2()
+        self.pool: list[tuple | None] = [None]
+        count = self._u2()
+        while len(self.pool) < count:
+            self.pool.append(self._constant())
+            if self.pool[-1][0] in (self.LONG, self.DOUBLE):
+                self.pool.append(None)  # 8-byte constants take two slots
+
+    def _u1(self) -> int:
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def _u2(self) -> int:
+        self.pos += 2
+        return struct.unpack_from(">H", self.data, self.pos - 2)[0]
+
+    def _u4(self) -> int:
+        self.pos += 4
+        return struct.unpack_from(">I", self.data, self.pos - 4)[0]
+
+    def _bytes(self, n: int) -> bytes:
+        self.pos += n
+        return self.data[self.pos - n : self.pos]
+
+    def _constant(self) -> tuple:
+        tag = self._u1()
+        if tag == self.UTF8:
+            raw = self._bytes(self._u2())
+            # Modified UTF-8 encodes NUL as C0 80.
+            return tag, raw.replace(b"\xc0\x80", b"\x00").decode("utf-8", "replace")
+        elif tag == self.INTEGER:
+            return tag, struct.unpack(">i", self._bytes(4))[0]
+        elif tag == self.FLOAT:
+            return tag, struct.unpack(">f", self._bytes(4))[0]
+        elif tag == self.LONG:
+            return tag, struct.unpack(">q", self._bytes(8))[0]
+        elif tag == self.DOUBLE:
+            return tag, struct.unpack(">d", self._bytes(8))[0]
+        elif tag in (
+            self.CLASS,
+            self.STRING,
+            self.METHOD_TYPE,
+            self.MODULE,
+            self.PACKAGE,
+        ):
+            return tag, self._u2()
+        elif tag in (
+            self.FIELDREF,
+            self.METHODREF,
+            self.INTERFACE_METHODREF,
+            self.NAME_AND_TYPE,
+            self.DYNAMIC,
+            self.INVOKE_DYNAMIC,
+        ):
+            return tag, self._u2(), self._u2()
+        elif tag == self.METHOD_HANDLE:
+            return tag, self._u1(), self._u2()
+        raise ValueError(f"Unknown constant pool tag {tag} at offset {self.pos - 1}.")
+
+    def utf8(self, index: int) -> str:
+        return self.pool[index][1]
+
+    def class_name(self, index: int) -> str | None:
+        return None if index == 0 else self.utf8(self.pool[index][1])
+
+    def _attributes(self) -> Iterator[tuple[str, bytes]]:
+        for _ in range(self._u2()):
+            name = self.utf8(self._u2())
+            yield name, self._bytes(self._u4())
+
+    @classmethod
+    def code_constants(cls, code: bytes) -> Iterator[tuple[str, int]]:
+        """Yields the integers pushed by iconst_*, bipush and sipush in a method's bytecode."""
+        pc = 0
+        while pc < len(code):
+            op = code[pc]
+            if 0x02 <= op <= 0x08:
+                yield "iconst", op - 0x03
+            elif op == 0x10:
+                yield "bipush", struct.unpack_from(">b", code, pc + 1)[0]
+            elif op == 0x11:
+                yield "sipush", struct.unpack_from(">h", code, pc + 1)[0]
+
+            if op == 0xAA:  # tableswitch
+                pad = (4 - (pc + 1) % 4) % 4
+                low, high = struct.unpack_from(">ii", code, pc + 1 + pad + 4)
+                pc += 1 + pad + 12 + (high - low + 1) * 4
+            elif op == 0xAB:  # lookupswitch
+                pad = (4 - (pc + 1) % 4) % 4
+                (npairs,) = struct.unpack_from(">i", code, pc + 1 + pad + 4)
+                pc += 1 + pad + 8 + npairs * 8
+            elif op == 0xC4:  # wide
+                pc += 6 if code[pc + 1] == 0x84 else 4
+            else:
+                pc += 1 + cls._operands.get(op, 0)
+
+    def parse(self, blake2b: str) -> ClassInfo:
+        strings, numbers, refs = [], [], []
+        for entry in self.pool:
+            if entry is None:
+                continue
+            tag = entry[0]
+            if tag == self.STRING:
+                strings.append(self.utf8(entry[1]))
+            elif tag == self.INTEGER:
+                numbers.append(("int", entry[1]))
+            elif tag == self.LONG:
+                numbers.append(("long", entry[1]))
+            elif tag == self.FLOAT:
+                numbers.append(("float", entry[1]))
+            elif tag == self.DOUBLE:
+                numbers.append(("double", entry[1]))
+            elif tag in (self.FIELDREF, self.METHODREF, self.INTERFACE_METHODREF):
+                _, name_index, descriptor_index = self.pool[entry[2]]
+                refs.append(
+                    (
+                        {9: "field", 10: "method", 11: "interface"}[tag],
+                        self.class_name(entry[1]),
+                        self.utf8(name_index),
+                        self.utf8(descriptor_index),
+                    )
+                )
+
+        _access_flags = self._u2()
+        this_class, super_class = self._u2(), self._u2()
+        interfaces_count = self._u2()
+        self.pos += 2 * interfaces_count
+
+        members = []
+        for kind in ("field", "method"):
+            for _ in range(self._u2()):
+                access_flags, name, descriptor = (
+                    self._u2(),
+                    self.utf8(self._u2()),
+                    self.utf8(self._u2()),
+                )
+                members.append((kind, access_flags, name, descriptor))
+                for attribute, body in self._attributes():
+                    if attribute == "Code":
+                        (code_length,) = struct.unpack_from(">I", body, 4)
+                        numbers.extend(self.code_constants(body[8 : 8 + code_length]))
+
+        return ClassInfo(
+            blake2b,
+            self.class_name(this_class),
+            self.class_name(super_class),
+            self.major_version,
+            strings,
+            numbers,
+            refs,
+            members,
+        )
+
+
+def _parse_kernel(task: tuple[str, bytes, bool]) -> ClassInfo | tuple[str, str]:
+    # Runs in a worker. Members arrive still XZ compressed so decompression is parallel too.
+    blake2b, data, is_xz = task
+    try:
+        if is_xz:
+            data = lzma.decompress(data, format=lzma.FORMAT_XZ)
+        return ClassFile(data).parse(blake2b)
+    except (
+        ValueError,
+        IndexError,
+        KeyError,
+        TypeError,
+        struct.error,
+        lzma.LZMAError,
+    ) as e:
+        return blake2b, f"{type(e).__name__}: {e}"
+
+
+def setup(con: sqlite3.Connection) -> None:
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS classes
+        (
+            blake2b TEXT PRIMARY KEY,
+            name TEXT,
+            superName TEXT,
+            majorVersion INTEGER,
+            error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS classVersions
+        (
+            jarID INTEGER NOT NULL,
+            memberName TEXT NOT NULL,
+            blake2b TEXT NOT NULL REFERENCES classes (blake2b),
+            PRIMARY KEY (jarID, memberName)
+        );
+        CREATE INDEX IF NOT EXISTS classVersionsBlake2b ON classVersions (blake2b);
+        CREATE TABLE IF NOT EXISTS strings
+        (
+            value TEXT NOT NULL,
+            blake2b TEXT NOT NULL REFERENCES classes (blake2b)
+        );
+        CREATE INDEX IF NOT EXISTS stringsValue ON strings (value);
+        CREATE TABLE IF NOT EXISTS numbers
+        (
+            kind TEXT NOT NULL,
+            value NUMERIC NOT NULL,
+            blake2b TEXT NOT NULL REFERENCES classes (blake2b),
+            UNIQUE (value, kind, blake2b)
+        );
+        CREATE TABLE IF NOT EXISTS refs
+        (
+            kind TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            name TEXT NOT NULL,
+            descriptor TEXT NOT NULL,
+            blake2b TEXT NOT NULL REFERENCES classes (blake2b)
+        );
+        CREATE INDEX IF NOT EXISTS refsOwnerName ON refs (owner, name);
+        CREATE INDEX IF NOT EXISTS refsName ON refs (name);
+        CREATE TABLE IF NOT EXISTS members
+        (
+            kind TEXT NOT NULL,
+            accessFlags INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            descriptor TEXT NOT NULL,
+            blake2b TEXT NOT NULL REFERENCES classes (blake2b)
+        );
+        CREATE INDEX IF NOT EXISTS membersBlake2b ON members (blake2b);
+        CREATE TABLE IF NOT EXISTS indexedJars
+        (
+            jarID INTEGER PRIMARY KEY
+        );
+        """
+    )
+    con.commit()
+
+
+def _iter_jar(
+    jar_con: sqlite3.Connection, jar_id: int
+) -> Iterator[tuple[str, str, bytes, bool]]:
+    # Yields (member name, blake2b, data, data is XZ compressed) for each .class member of a stored jar.
+    columns = {row[1] for row in jar_con.execute("PRAGMA table_info(jars)")}
+    jar_blob, storage = jar_con.execute(
+        "SELECT jarBlob, "
+        + ("storage" if "storage" in columns else f"'{jar_store.STORAGE_XZ}'")
+        + " FROM jars WHERE jarID = ?",
+        (jar_id,),
+    ).fetchone()
+    if storage == jar_store.STORAGE_MEMBERS:
+        yield from (
+            (name, blake2b, blob, bool(xz))
+            for name, blake2b, blob, xz in jar_con.execute(
+                """
+                SELECT name, blake2b, blob, xz FROM manifests JOIN blobs USING (blake2b)
+                WHERE jarID = ? AND name LIKE '%.class' ORDER BY position ASC
+                """,
+                (jar_id,),
+            )
+        )
+    else:
+        with zipfile.ZipFile(io.BytesIO(lzma.decompress(jar_blob))) as jar:
+            for info in jar.infolist():
+                if info.filename.endswith(".class"):
+                    data = jar.read(info)
+                    yield info.filename, jar_store.member_hash(data), data, False
+
+
+def index_jar(
+    jar_con: sqlite3.Connection,
+    index_con: sqlite3.Connection,
+    jar_id: int,
+    pool: mp.Pool,
+) -> tuple[int, int]:
+    """Indexes every class of one jar. Classes already indexed from another version are only linked, not parsed.
+
+    Returns the number of classes in the jar and the number newly parsed."""
+    known = set()
+    tasks, versions = [], []
+    for name, blake2b, data, is_xz in _iter_jar(jar_con, jar_id):
+        versions.append((jar_id, name, blake2b))
+        if blake2b in known:
+            continue
+        known.add(blake2b)
+        if (
+            index_con.execute(
+                "SELECT 1 FROM classes WHERE blake2b = ?", (blake2b,)
+            ).fetchone()
+            is None
+        ):
+            tasks.append((blake2b, data, is_xz))
+
+    for result in pool.imap_unordered(_parse_kernel, tasks, chunksize=_chunksize):
+        if not isinstance(result, ClassInfo):
+            index_con.execute(
+                "INSERT OR REPLACE INTO classes (blake2b, error) VALUES (?, ?)", result
+            )
+            continue
+        index_con.execute(
+            "INSERT OR REPLACE INTO classes (blake2b, name, superName, majorVersion) VALUES (?, ?, ?, ?)",
+            (result.blake2b, result.name, result.super_name, result.major_version),
+        )
+        index_con.executemany(
+            "INSERT INTO strings (value, blake2b) VALUES (?, ?)",
+            ((s, result.blake2b) for s in result.strings),
+        )
+        index_con.executemany(
+            "INSERT OR IGNORE INTO numbers (kind, value, blake2b) VALUES (?, ?, ?)",
+            ((kind, value, result.blake2b) for kind, value in result.numbers),
+        )
+        index_con.executemany(
+            "INSERT INTO refs (kind, owner, name, descriptor, blake2b) VALUES (?, ?, ?, ?, ?)",
+            ((*ref, result.blake2b) for ref in result.refs),
+        )
+        index_con.executemany(
+            "INSERT INTO members (kind, accessFlags, name, descriptor, blake2b) VALUES (?, ?, ?, ?, ?)",
+            ((*member, result.blake2b) for member in result.members),
+        )
+
+    index_con.executemany(
+        "INSERT OR REPLACE INTO classVersions (jarID, memberName, blake2b) VALUES (?, ?, ?)",
+        versions,
+    )
+    index_con.execute("INSERT OR IGNORE INTO indexedJars (jarID) VALUES (?)", (jar_id,))
+    index_con.commit()
+    return len(versions), len(tasks)
+
+
+def find_number(index_con: sqlite3.Connection, value: int | float) -> list[tuple]:
+    """Returns ``(jarID, memberName, kind)`` for every archived class that uses the numeric constant ``value``."""
+    return index_con.execute(
+        """
+        SELECT jarID, memberName, kind FROM numbers JOIN classVersions USING (blake2b)
+        WHERE value = ? ORDER BY jarID, memberName
+        """,
+        (value,),
+    ).fetchall()
+
+
+def find_string(index_con: sqlite3.Connection, value: str) -> list[tuple]:
+    """Returns ``(jarID, memberName)`` for every archived class with ``value`` as a string literal."""
+    return index_con.execute(
+        """
+        SELECT jarID, memberName FROM strings JOIN classVersions USING (blake2b)
+        WHERE value = ? ORDER BY jarID, memberName
+        """,
+        (value,),
+    ).fetchall()
+
+
+def find_ref(
+    index_con: sqlite3.Connection, name: str, owner: str | None = None
+) -> list[tuple]:
+    """Returns ``(jarID, memberName, kind, owner, descriptor)`` for every reference to member ``name``."""
+    query = """
+        SELECT jarID, memberName, kind, owner, descriptor FROM refs JOIN classVersions USING (blake2b)
+        WHERE name = ?"""
+    params: tuple = (name,)
+    if owner is not None:
+        query += " AND owner = ?"
+        params += (owner,)
+    return index_con.execute(query + " ORDER BY jarID, memberName", params).fetchall()
+
+
+def main() -> None:
+    with sqlite3.connect(_jar_db_uri, uri=True) as jar_con, sqlite3.connect(
+        _index_db_path
+    ) as index_con:
+        setup(index_con)
+        jar_ids = [
+            row[0] for row in jar_con.execute("SELECT jarID FROM jars ORDER BY jarID")
+        ]
+        done = {row[0] for row in index_con.execute("SELECT jarID FROM indexedJars")}
+        with mp.Pool() as pool:
+            for jar_id in jar_ids:
+                if jar_id in done:
+                    continue
+                print(f"[=] Indexing jar {jar_id}")
+                count, parsed = index_jar(jar_con, index_con, jar_id, pool)
+                print(
+                    f"[+] {count} classes, {parsed} parsed, {count - parsed} already indexed"
+                )
+
+    if len(sys.argv) > 1:
+        with sqlite3.connect(_index_db_path) as index_con:
+            value = sys.argv[1]
+            try:
+                for row in find_number(index_con, int(value, 0)):
+                    print(*row)
+            except ValueError:
+                for row in find_string(index_con, value) + find_ref(index_con, value):
+                    print(*row)
+
+
+if __name__ == "__main__":
+    main()
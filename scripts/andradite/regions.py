@@ -0,0 +1,362 @@
+import argparse
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, Literal, NamedTuple
+
+import numpy as np
+
+_cache_root = Path("/Users/ryan/.vscape2/")
+_region_db_path = Path(__file__).parent / "regions.sqlite3"
+_read_size = 1024 * 1024
+
+LABELS = ("table", "text", "compressed", "random")
+Label = Literal["table", "text", "compressed", "random"]
+
+# Window classification. Text is mostly printable ASCII; tables sit well below the entropy of packed data;
+# random data is indistinguishable from uniform by a chi-square test, compressed data usually is not.
+TEXT_PRINTABLE = 0.85
+TABLE_ENTROPY = 6.0
+# 255 degrees of freedom: mean 255, standard deviation sqrt(2 * 255). Four deviations above the mean.
+RANDOM_CHI2 = 255 + 4 * (2 * 255) ** 0.5
+
+_printable = np.zeros(256, dtype=bool)
+_printable[0x20:0x7F] = True
+_printable[[0x09, 0x0A, 0x0D]] = True
+
+
+class Region(NamedTuple):
+    offset: int
+    length: int
+    label: Label
+    entropy_mean: float
+    entropy_min: float
+    entropy_max: float
+    printable: float  # fraction of printable ASCII bytes
+    zeros: float  # fraction of 0x00 bytes
+
+
+class _Windows(NamedTuple):
+    entropy: np.ndarray
+    chi2: np.ndarray
+    printable: np.ndarray
+    zeros: np.ndarray
+    labels: list[Label]
+
+
+def _window_stats(a: np.ndarray, window: int) -> _Windows:
+    """Per-window entropy, chi-square against uniform, printable and zero fractions, for ``len(a) // window``
+    full windows, or one short window if ``a`` is shorter than ``window``."""
+    n = max(len(a) // window, 1)
+    a = a[: n * window] if len(a) >= window else a
+    size = len(a) // n
+    rows = np.repeat(np.arange(n, dtype=np.int64) * 256, size)
+    counts = np.bincount(rows + a, minlength=n * 256).reshape(n, 256)
+    p = counts / size
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = np.abs(np.where(counts > 0, p * np.log2(p), 0.0).sum(axis=1))
+    expected = size / 256
+    chi2 = ((counts - expected) ** 2 / expected).sum(axis=1)
+    printable = counts[:, _printable].sum(axis=1) / size
+    zeros = counts[:, 0] / size
+    labels = [
+        (
+            "text"
+            if pr >= TEXT_PRINTABLE
+            else (
+                "table"
+                if h < TABLE_ENTROPY
+                else "random" if c < RANDOM_CHI2 else "compressed"
+            )
+        )
+        for h, c, pr in zip(entropy, chi2, printable)
+    ]
+    return _Windows(entropy, chi2, printable, zeros, labels)
+
+
+class _Accumulator(object):
+    def __init__(self, offset: int, label: Label):
+        self.offset, self.label = offset, label
+        self.length = self.windows = 0
+        self.entropy_sum, self.printable_sum, self.zeros_sum = 0.0, 0.0, 0.0
+        self.entropy_min, self.entropy_max = float("inf"), float("-inf")
+
+    def add(self, size: int, entropy: float, printable: float, zeros: float) -> None:
+        self.length += size
+        self.windows += 1
+        self.entropy_sum += entropy
+        self.printable_sum += printable * size
+        self.zeros_sum += zeros * size
+        self.entropy_min = min(self.entropy_min, entropy)
+        self.entropy_max = max(self.entropy_max, entropy)
+
+    @property
+    def entropy_mean(self) -> float:
+        return self.entropy_sum / self.windows
+
+    def region(self) -> Region:
+        return Region(
+            self.offset,
+            self.length,
+            self.label,
+            self.entropy_mean,
+            self.entropy_min,
+            self.entropy_max,
+            self.printable_sum / self.length,
+            self.zeros_sum / self.length,
+        )
+
+
+class Segmenter(object):
+    """Streaming change-point segmentation of a byte stream into labeled regions.
+
+    Bytes are fed in any amount; each full window is classified, and a region ends when either a different label
+    holds for ``min_windows`` consecutive windows (shorter excursions are absorbed), or a two-sided CUSUM on the
+    window entropy drifts more than ``threshold`` bits away from the region's mean. Memory use is one window plus
+    ``min_windows`` pending windows regardless of input size.
+    """
+
+    def __init__(
+        self,
+        window: int = 4096,
+        min_windows: int = 4,
+        drift: float = 0.25,
+        threshold: float = 4.0,
+    ):
+        self.window, self.min_windows = window, min_windows
+        self.drift, self.threshold = drift, threshold
+        self._buffer = bytearray()
+        self._offset = 0
+        self._current: _Accumulator | None = None
+        self._pending: list[tuple[int, Label, tuple]] = []
+        self._cusum_pos = self._cusum_neg = 0.0
+
+    def _start(self, offset: int, label: Label) -> None:
+        self._current = _Accumulator(offset, label)
+        self._cusum_pos = self._cusum_neg = 0.0
+
+    def _absorb(
+        self, offset: int, label: Label, stats: tuple[int, float, float, float]
+    ) -> Iterator[Region]:
+        current = self._current
+        if current.windows >= self.min_windows:
+            deviation = stats[1] - current.entropy_mean
+            self._cusum_pos = max(0.0, self._cusum_pos + deviation - self.drift)
+            self._cusum_neg = max(0.0, self._cusum_neg - deviation - self.drift)
+            if max(self._cusum_pos, self._cusum_neg) > self.threshold:
+                # The level shifted: split before this window. It may be a shorter excursion of another label
+                # that the region was absorbing, so the new region takes the window's own label.
+                yield current.region()
+                self._start(offset, label)
+        self._current.add(*stats)
+
+    def _window(self, offset: int, label: Label, stats: tuple) -> Iterator[Region]:
+        if self._current is None:
+            self._start(offset, label)
+        if label == self._current.label:
+            for pending in self._pending:
+                yield from self._absorb(*pending)
+            self._pending.clear()
+            yield from self._absorb(offset, label, stats)
+            return
+
+        self._pending.append((offset, label, stats))
+        if len(self._pending) > self.min_windows:
+            # The oldest pending window never started a run of its own, so it belongs to the current region
+            yield from self._absorb(*self._pending.pop(0))
+            if self._current.label == label:
+                # It split off a region of this window's label, which the other pending windows then continue
+                for pending in self._pending:
+                    yield from self._absorb(*pending)
+                self._pending.clear()
+                return
+        if len(self._pending) == self.min_windows and all(
+            p[1] == label for p in self._pending
+        ):
+            yield self._current.region()
+            self._start(self._pending[0][0], label)
+            for pending in self._pending:
+                yield from self._absorb(*pending)
+            self._pending.clear()
+
+    def _process(self, data: bytes) -> Iterator[Region]:
+        w = _window_stats(np.frombuffer(data, dtype=np.uint8), self.window)
+        size = len(data) // len(w.labels)
+        for ii, label in enumerate(w.labels):
+            stats = (
+                size,
+                float(w.entropy[ii]),
+                float(w.printable[ii]),
+                float(w.zeros[ii]),
+            )
+            yield from self._window(self._offset, label, stats)
+            self._offset += size
+
+    def feed(self, data: bytes) -> Iterator[Region]:
+        """Consumes ``data`` and yields every region completed by it."""
+        self._buffer += data
+        full = len(self._buffer) - len(self._buffer) % self.window
+        if full:
+            yield from self._process(bytes(self._buffer[:full]))
+            del self._buffer[:full]
+
+    def close(self) -> Iterator[Region]:
+        """Classifies the trailing partial window and yields the remaining regions."""
+        if self._buffer:
+            yield from self._process(bytes(self._buffer))
+            self._buffer.clear()
+        if self._current is not None:
+            for pending in self._pending:
+                yield from self._absorb(*pending)
+            self._pending.clear()
+            yield self._current.region()
+            self._current = None
+
+
+def segment(fd: BinaryIO, **kwargs) -> Iterator[Region]:
+    """Segments everything readable from ``fd`` without holding more than one read in memory."""
+    segmenter = Segmenter(**kwargs)
+    while data := fd.read(_read_size):
+        yield from segmenter.feed(data)
+    yield from segmenter.close()
+
+
+def setup(con: sqlite3.Connection) -> None:
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS sources
+        (
+            sourceID INTEGER PRIMARY KEY ASC AUTOINCREMENT,
+            name TEXT NOT NULL,
+            blake2b TEXT NOT NULL,
+            sizeBytes INTEGER NOT NULL,
+            window INTEGER NOT NULL,
+            UNIQUE (name, blake2b, window)
+        );
+        CREATE TABLE IF NOT EXISTS regions
+        (
+            sourceID INTEGER NOT NULL REFERENCES sources (sourceID),
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            label TEXT NOT NULL,
+            entropyMean REAL NOT NULL,
+            entropyMin REAL NOT NULL,
+            entropyMax REAL NOT NULL,
+            printable REAL NOT NULL,
+            zeros REAL NOT NULL,
+            PRIMARY KEY (sourceID, offset)
+        );
+        CREATE INDEX IF NOT EXISTS regionsLabel ON regions (label, sourceID);
+        """
+    )
+    con.commit()
+
+
+def index_file(
+    con: sqlite3.Connection, path: Path, name: str | None = None, window: int = 4096
+) -> int:
+    """Segments the file at ``path`` and stores its regions under ``name``. Returns the source id.
+
+    The file is hashed during the same pass, and a file already indexed with identical content is not stored
+    again."""
+    name = name or str(path)
+    hasher = hashlib.blake2b(digest_size=16)
+    segmenter = Segmenter(window=window)
+    regions, size = [], 0
+    with open(path, "rb") as fd:
+        while data := fd.read(_read_size):
+            hasher.update(data)
+            size += len(data)
+            regions += segmenter.feed(data)
+    regions += segmenter.close()
+
+    row = con.execute(
+        "SELECT sourceID FROM sources WHERE name = ? AND blake2b = ? AND window = ?",
+        (name, hasher.hexdigest(), window),
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    source_id = con.execute(
+        "INSERT INTO sources (name, blake2b, sizeBytes, window) VALUES (?, ?, ?, ?)",
+        (name, hasher.hexdigest(), size, window),
+    ).lastrowid
+    con.executemany(
+        """
+        INSERT INTO regions (sourceID, offset, length, label, entropyMean, entropyMin, entropyMax, printable, zeros)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        ((source_id, *region) for region in regions),
+    )
+    con.commit()
+    return source_id
+
+
+def get_regions(
+    con: sqlite3.Connection,
+    name: str,
+    labels: Iterable[Label] = LABELS,
+    min_length: int = 0,
+) -> list[Region]:
+    """Returns the regions of the newest indexed version of ``name`` with one of ``labels``, in file order."""
+    labels = tuple(labels)
+    return [
+        Region(*row)
+        for row in con.execute(
+            f"""
+            SELECT offset, length, label, entropyMean, entropyMin, entropyMax, printable, zeros FROM regions
+            WHERE sourceID = (SELECT MAX(sourceID) FROM sources WHERE name = ?)
+                AND label IN ({", ".join("?" * len(labels))}) AND length >= ?
+            ORDER BY offset
+            """,
+            (name, *labels, min_length),
+        )
+    ]
+
+
+def read_regions(
+    fd: BinaryIO, regions: Iterable[Region]
+) -> Iterator[tuple[Region, bytes]]:
+    """Yields each region with its bytes, so later analyses can skip everything else."""
+    for region in regions:
+        fd.seek(region.offset)
+        yield region, fd.read(region.length)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Segment files into labeled entropy regions."
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        type=Path,
+        help="Defaults to every file in the client cache.",
+    )
+    parser.add_argument("--window", type=int, default=4096)
+    args = parser.parse_args()
+
+    files = args.files or sorted(p for p in _cache_root.rglob("*") if p.is_file())
+    with sqlite3.connect(_region_db_path) as con:
+        setup(con)
+        for path in files:
+            name = (
+                str(path.relative_to(_cache_root))
+                if path.is_relative_to(_cache_root)
+                else str(path)
+            )
+            source_id = index_file(con, path, name, args.window)
+            print(f"[+] {name}")
+            for row in con.execute(
+                """
+                SELECT label, COUNT(*), SUM(length), AVG(entropyMean) FROM regions
+                WHERE sourceID = ? GROUP BY label ORDER BY SUM(length) DESC
+                """,
+                (source_id,),
+            ):
+                print(
+                    f"    {row[0]:>10}: {row[1]} regions, {row[2]} bytes, {row[3]:.3f} bits/byte"
+                )
+
+
+if __name__ == "__main__":
+    main()
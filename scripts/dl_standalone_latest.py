@@ -1,9 +1,13 @@
-from typing import NoReturn
+from typing import NoReturn, NamedTuple
 import sqlite3 as sql
 import requests
 import hashlib
 import lzma
+import tempfile
+import zipfile
 from random import sample
+import jar_store
+import storage
 
 # Enable mock return values for certain functions
 _mock_mode: bool = False
@@ -13,40 +17,156 @@ if _mock_mode:
 _db_uri = "file:dl_standalone_latest.sqlite3?mode=rwc"
 _dl_url = """https://vidyascape.org/files/client/vidyascape.jar"""
 
+# Download/compression granularity, and how much of the jar is kept in memory before spilling to disk.
+_chunk_size = 1024 * 1024
+_spool_size = 64 * 1024 * 1024
 
-def get_jar(mock=False) -> bytes:
-    if not mock:
-        try:
-            resp = requests.get(_dl_url)
-            resp.raise_for_status()
+
+class Download(NamedTuple):
+    """A downloaded jar, spooled to a temporary file, along with its size, hash and HTTP cache validators."""
+
+    file: tempfile.SpooledTemporaryFile
+    size_bytes: int
+    blake2b_hex: str
+    etag: str | None
+    last_modified: str | None
+
+
+def setup(con: sql.Connection) -> None:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jars
+        (
+            jarID INTEGER PRIMARY KEY ASC AUTOINCREMENT,
+            jarBlob BLOB NOT NULL ON CONFLICT ABORT,
+            sizeBytes INTEGER NOT NULL ON CONFLICT ABORT,
+            blake2b TEXT UNIQUE ON CONFLICT ABORT
+        );
+        """
+    )
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS validators
+        (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            lastModified TEXT,
+            blake2b TEXT
+        );
+        """
+    )
+    con.commit()
+
+
+def get_validators(con: sql.Connection, url: str) -> dict[str, str]:
+    """Returns conditional request headers for ``url`` built from the last successful download."""
+    row = con.execute(
+        "SELECT etag, lastModified FROM validators WHERE url = ?", (url,)
+    ).fetchone()
+    headers = {}
+    if row is not None:
+        etag, last_modified = row
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def set_validators(con: sql.Connection, url: str, download: Download) -> None:
+    """Remembers the validators of ``download`` for the next conditional request. Does not commit: only call it in
+    the transaction that stores the jar, or once the jar is known to be stored, so a failed download is fetched again.
+    """
+    con.execute(
+        "INSERT OR REPLACE INTO validators (url, etag, lastModified, blake2b) VALUES (?, ?, ?, ?)",
+        (url, download.etag, download.last_modified, download.blake2b_hex),
+    )
+
+
+def get_jar(
+    url: str = _dl_url, headers: dict[str, str] | None = None
+) -> Download | None:
+    """Streams the jar at ``url`` into a spooled temporary file, hashing each chunk as it arrives.
+
+    Returns ``None`` if the server answers ``304 Not Modified`` to the conditional ``headers``.
+
+    :raises requests.exceptions.RequestException:
+    """
+    try:
+        with requests.get(url, headers=headers or {}, stream=True, timeout=30) as resp:
             print(f"Response Code {resp.status_code}, ", end="")
-            return resp.content
-        except requests.exceptions.RequestException as e:
-            e.add_note(f"Failed to download the jar.")
-    else:
-        with sql.connect(_db_uri, uri=True) as con:
-            cur = con.cursor()
-            # Choose a random jar from the 10 most-recent
-            ret = [
-                t[0]
-                for t in con.execute("""SELECT jarBlob FROM jars LIMIT 10""").fetchall()
-            ]
-            ret = sample(ret, k=1)[0]
-            con.commit()
-            cur.close()
-        return lzma.decompress(ret)
+            if resp.status_code == requests.codes.not_modified:
+                return None
+            resp.raise_for_status()
+
+            hasher = hashlib.blake2b(digest_size=16)
+            size_bytes = 0
+            spool = tempfile.SpooledTemporaryFile(max_size=_spool_size)
+            for chunk in resp.iter_content(chunk_size=_chunk_size):
+                hasher.update(chunk)
+                spool.write(chunk)
+                size_bytes += len(chunk)
+            spool.seek(0)
+            return Download(
+                spool,
+                size_bytes,
+                hasher.hexdigest(),
+                resp.headers.get("ETag"),
+                resp.headers.get("Last-Modified"),
+            )
+    except requests.exceptions.RequestException as e:
+        e.add_note(f"Failed to download the jar.")
+        raise
 
 
-def main() -> NoReturn:
+def get_jar_mock(con: sql.Connection) -> Download:
+    jar_store.setup(con)
+    # Choose a random jar from the 10 most-recent
+    jar_ids = [
+        t[0] for t in con.execute("""SELECT jarID FROM jars LIMIT 10""").fetchall()
+    ]
+    jar_blob = jar_store.read_jar(con, sample(jar_ids, k=1)[0])
+    spool = tempfile.SpooledTemporaryFile(max_size=_spool_size)
+    spool.write(jar_blob)
+    spool.seek(0)
+    return Download(
+        spool,
+        len(jar_blob),
+        hashlib.blake2b(jar_blob, digest_size=16).hexdigest(),
+        None,
+        None,
+    )
+
+
+def main(
+    url: str = _dl_url, db_uri: str = _db_uri, mock: bool = _mock_mode
+) -> NoReturn:
     if not lzma.is_check_supported(lzma.CHECK_SHA256):
         raise AssertionError(
             "Your version of liblzma lacks support for the lzma.CHECK_SHA256 integrity check type."
         )
 
+    # One connection for the whole run; WAL mode keeps the andradite readers from blocking it.
+    try:
+        con = storage.connect(db_uri, uri=True)
+        setup(con)
+        headers = get_validators(con, url)
+    except sql.Error as e:
+        e.add_note("Failed when accessing dl_standalone_latest.sqlite3.")
+        raise
+    try:
+        update(con, url, headers, mock)
+    finally:
+        con.close()
+
+
+def update(
+    con: sql.Connection, url: str, headers: dict[str, str], mock: bool
+) -> NoReturn:
+    """Downloads the jar unless it is unmodified and stores its members unless the version is already known."""
     try:
         print("Getting the jar... ", end="")
-        jar_blob = get_jar(mock=_mock_mode)
-        assert jar_blob is not None
+        download = get_jar_mock(con) if mock else get_jar(url, headers)
         print(" done.")
     except requests.exceptions.RequestException as e:
         e.add_note(f"Failed to download the jar.")
@@ -54,79 +174,71 @@ def main() -> NoReturn:
     except KeyboardInterrupt:
         raise
 
-    try:
-        size_bytes_uncompressed = len(jar_blob)
-        blake2b_hex = hashlib.blake2b(
-            jar_blob,
-            digest_size=16,
-        ).hexdigest()
-        assert size_bytes_uncompressed is not None
-        assert blake2b_hex is not None
+    if download is None:
+        print("The jar has not been modified since the last download.")
+        print("Operation complete.")
+        exit()
+
+    with download.file:
+        size_bytes_uncompressed, blake2b_hex = download.size_bytes, download.blake2b_hex
         assert size_bytes_uncompressed != 0
         assert len(blake2b_hex) == 32
         print(f"vidyascape.jar {size_bytes_uncompressed} {blake2b_hex}")
-    except KeyboardInterrupt:
-        raise
-    except Exception as e:
-        e.add_note("Failed to hash the jar.")
-        raise
 
-    try:
-        print("LZMA compressing the jar... ")
-        jar_blob_lzma = lzma.compress(
-            data=jar_blob,
-            format=lzma.FORMAT_XZ,
-            check=lzma.CHECK_SHA256,
-            preset=9 | lzma.PRESET_EXTREME,
-        )
-        size_bytes_compressed = len(jar_blob_lzma)
-        print(
-            f"{size_bytes_uncompressed} bytes -> {size_bytes_compressed} bytes ({round(100 * (1-(size_bytes_compressed / size_bytes_uncompressed)), ndigits=3)}% compressed, abs. change: {size_bytes_compressed-size_bytes_uncompressed} bytes)"
-        )
-        print(f"done.")
-    except KeyboardInterrupt:
-        raise
-    except lzma.LZMAError as e:
-        e.add_note("Failed to lzma compress the jar.")
-        raise
+        try:
+            known = con.execute(
+                "SELECT 1 FROM jars WHERE blake2b = ?", (blake2b_hex,)
+            ).fetchone()
+            if known is not None and not mock:
+                set_validators(con, url, download)
+                con.commit()
+        except sql.Error as e:
+            e.add_note("Failed when accessing dl_standalone_latest.sqlite3.")
+            raise
 
-    try:
-        print("Transacting with DB...", end="")
-        with sql.connect(database=_db_uri, uri=True) as con:
+        if known is not None:
+            print("There was not a newer version available.")
+            print("Operation complete.")
+            exit()
+
+        try:
+            print("Storing the jar's members...", end="")
+            jar_store.setup(con)
             cur = con.cursor()
             cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS jars 
-                (
-                    jarID INTEGER PRIMARY KEY ASC AUTOINCREMENT,
-                    jarBlob BLOB NOT NULL ON CONFLICT ABORT,
-                    sizeBytes INTEGER NOT NULL ON CONFLICT ABORT,
-                    blake2b TEXT UNIQUE ON CONFLICT ABORT
-                );
-                """
-            )
-            con.commit()
-            cur.execute(
-                "INSERT OR ABORT INTO jars (jarBlob, sizeBytes, blake2b) VALUES (?, ?, ?)",
+                "INSERT OR ABORT INTO jars (jarBlob, sizeBytes, blake2b, storage) VALUES (?, ?, ?, ?)",
                 (
-                    jar_blob_lzma,
+                    b"",
                     size_bytes_uncompressed,
                     blake2b_hex,
+                    jar_store.STORAGE_MEMBERS,
                 ),
             )
+            report = jar_store.store_members(con, cur.lastrowid, download.file)
+            if not mock:
+                set_validators(con, url, download)
             con.commit()
             cur.close()
-        print(" done.")
-    except sql.IntegrityError as e:
-        print(
-            f" done.\nThere was not a newer version available, or an error occurred:\n>\t{e.sqlite_errorname}: \
+            print(" done.")
+            print(
+                f"{report['members']} members, {report['membersNew']} new, {report['bytesNew']} bytes added "
+                f"({size_bytes_uncompressed} bytes uncompressed)"
+            )
+        except sql.IntegrityError as e:
+            con.rollback()
+            print(
+                f" done.\nThere was not a newer version available, or an error occurred:\n>\t{e.sqlite_errorname}: \
 {e.sqlite_errorcode}"
-        )
-    except sql.Error as e:
-        e.add_note("Failed when accessing dl_standalone_latest.sqlite3.")
-        raise
-    except KeyboardInterrupt:
-        raise
+            )
+        except sql.Error as e:
+            e.add_note("Failed when accessing dl_standalone_latest.sqlite3.")
+            raise
+        except (zipfile.BadZipFile, lzma.LZMAError) as e:
+            con.rollback()
+            e.add_note("Failed to unpack the jar into members.")
+            raise
+        except KeyboardInterrupt:
+            raise
 
     print("Operation complete.")
     exit()
@@ -0,0 +1,256 @@
+import io
+import lzma
+import shutil
+import sqlite3 as sql
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import BinaryIO
+
+import storage
+
+_db_uri = "file:dl_standalone_latest.sqlite3?mode=rwc"
+
+# jars.storage values: the whole jar as one XZ blob in jarBlob, or a manifest of members kept in storage's
+# content-addressed blobs.
+STORAGE_XZ, STORAGE_MEMBERS = "xz", "members"
+
+# How much of a decompressed XZ jar is kept in memory before spilling to disk.
+_spool_size = 64 * 1024 * 1024
+
+
+def member_hash(data: bytes) -> str:
+    """The key of a member's content in the manifest and in storage's blobs."""
+    return storage.blob_hash(data)
+
+
+# Zip files may repeat a member name, so manifest rows are keyed on position.
+_manifests_columns = """
+        (
+            jarID INTEGER NOT NULL ON CONFLICT ABORT REFERENCES jars (jarID),
+            position INTEGER NOT NULL ON CONFLICT ABORT,
+            name TEXT NOT NULL ON CONFLICT ABORT,
+            blake2b TEXT NOT NULL ON CONFLICT ABORT REFERENCES blobs (blake2b),
+            dateTime TEXT NOT NULL ON CONFLICT ABORT,
+            compressType INTEGER NOT NULL ON CONFLICT ABORT,
+            externalAttr INTEGER NOT NULL ON CONFLICT ABORT,
+            PRIMARY KEY (jarID, position)
+        )
+"""
+
+
+def setup(con: sql.Connection) -> None:
+    storage.setup(con)
+    if con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'members'"
+    ).fetchone():
+        # Members used to have a table of their own, with the same keys and XZ blobs
+        con.executescript(
+            """
+            BEGIN;
+            INSERT OR IGNORE INTO blobs (blake2b, sizeBytes, xz, blob)
+                SELECT blake2b, sizeBytes, 1, memberBlob FROM members;
+            DROP TABLE members;
+            COMMIT;
+            """
+        )
+    row = con.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'manifests'"
+    ).fetchone()
+    if row is not None and (
+        "PRIMARY KEY (jarID, name)" in row[0] or "REFERENCES members" in row[0]
+    ):
+        # Tables keyed on name kept only the last of several members with the same name: rekey on position, and
+        # refer to blobs rather than members
+        con.executescript(
+            f"""
+            BEGIN;
+            CREATE TABLE manifestsRekeyed {_manifests_columns};
+            INSERT INTO manifestsRekeyed SELECT * FROM manifests;
+            DROP TABLE manifests;
+            ALTER TABLE manifestsRekeyed RENAME TO manifests;
+            COMMIT;
+            """
+        )
+    con.execute(f"CREATE TABLE IF NOT EXISTS manifests {_manifests_columns}")
+    con.execute("CREATE INDEX IF NOT EXISTS manifestsBlake2b ON manifests (blake2b)")
+    columns = {row[1] for row in con.execute("PRAGMA table_info(jars)")}
+    if "storage" not in columns:
+        con.execute(
+            f"ALTER TABLE jars ADD COLUMN storage TEXT NOT NULL DEFAULT '{STORAGE_XZ}'"
+        )
+    con.commit()
+
+
+def store_members(
+    con: sql.Connection, jar_id: int, jar_file: BinaryIO
+) -> dict[str, int]:
+    """Writes one manifest row per zip member of ``jar_file`` and stores each member not already present.
+
+    Members go through ``storage.put`` as XZ compressed blobs keyed by the blake2b of their uncompressed content,
+    and are streamed out of the zip a chunk at a time.
+
+    :raises zipfile.BadZipFile:
+    :raises lzma.LZMAError:
+    """
+    report = {"members": 0}
+    blobs_before, bytes_before = _stored(con)
+    with zipfile.ZipFile(jar_file) as jar:
+        for position, info in enumerate(jar.infolist()):
+            with jar.open(info) as fd:
+                digest = storage.put(con, fd, xz=True)
+            con.execute(
+                """
+                INSERT OR REPLACE INTO manifests
+                    (jarID, position, name, blake2b, dateTime, compressType, externalAttr)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    jar_id,
+                    position,
+                    info.filename,
+                    digest,
+                    datetime(*info.date_time).isoformat(),
+                    info.compress_type,
+                    info.external_attr,
+                ),
+            )
+            report["members"] += 1
+    con.execute(
+        "UPDATE jars SET storage = ? WHERE jarID = ?", (STORAGE_MEMBERS, jar_id)
+    )
+    blobs_after, bytes_after = _stored(con)
+    report["membersNew"] = blobs_after - blobs_before
+    report["bytesNew"] = bytes_after - bytes_before
+    return report
+
+
+def _stored(con: sql.Connection) -> tuple[int, int]:
+    # LENGTH of a blob is read from its record header, without walking its overflow pages
+    return con.execute(
+        "SELECT COUNT(*), COALESCE(SUM(LENGTH(blob)), 0) FROM blobs"
+    ).fetchone()
+
+
+def list_members(con: sql.Connection, jar_id: int) -> list[tuple[str, str]]:
+    """Returns ``(name, blake2b)`` for each member of the jar, in archive order."""
+    return con.execute(
+        "SELECT name, blake2b FROM manifests WHERE jarID = ? ORDER BY position ASC",
+        (jar_id,),
+    ).fetchall()
+
+
+def get_member(con: sql.Connection, jar_id: int, name: str) -> bytes:
+    """Returns one member of a stored jar without touching any other member. Of several members called ``name``,
+    the last one is returned, as ``zipfile`` does.
+
+    :raises KeyError: if the jar has no member called ``name``.
+    """
+    row = con.execute(
+        """
+        SELECT blake2b FROM manifests
+        WHERE jarID = ? AND name = ? ORDER BY position DESC LIMIT 1
+        """,
+        (jar_id, name),
+    ).fetchone()
+    if row is None:
+        raise KeyError(f"{name} is not a member of jar {jar_id}.")
+    return storage.get(con, row[0])
+
+
+def open_xz_jar(con: sql.Connection, jar_id: int) -> tempfile.SpooledTemporaryFile:
+    """Decompresses a jar stored as one XZ blob into a spooled temporary file, reading the blob piecewise.
+
+    :raises lzma.LZMAError:
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=_spool_size)
+    decompressor = lzma.LZMADecompressor()
+    for chunk in storage.read_chunks(con, "jars", "jarBlob", jar_id):
+        spool.write(decompressor.decompress(chunk))
+    if not decompressor.eof:
+        spool.close()
+        raise lzma.LZMAError(f"The XZ stream of jar {jar_id} is truncated.")
+    spool.seek(0)
+    return spool
+
+
+def read_jar(con: sql.Connection, jar_id: int) -> bytes:
+    """Returns a stored jar. Jars kept as members are rebuilt from their manifest; the member contents, names,
+    order and timestamps match the original, but the archive bytes (and so its blake2b) generally do not.
+    """
+    (jar_storage,) = con.execute(
+        "SELECT storage FROM jars WHERE jarID = ?", (jar_id,)
+    ).fetchone()
+    if jar_storage == STORAGE_XZ:
+        with open_xz_jar(con, jar_id) as fd:
+            return fd.read()
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as jar:
+        for name, date_time, compress_type, external_attr, digest in con.execute(
+            """
+            SELECT name, dateTime, compressType, externalAttr, blake2b FROM manifests
+            WHERE jarID = ? ORDER BY position ASC
+            """,
+            (jar_id,),
+        ).fetchall():
+            info = zipfile.ZipInfo(
+                name, datetime.fromisoformat(date_time).timetuple()[:6]
+            )
+            info.compress_type = compress_type
+            info.external_attr = external_attr
+            # Each member is decompressed straight from its blob into the archive, one chunk at a time
+            with (
+                storage.open_blob(con, digest) as fd,
+                jar.open(info, "w") as member,
+            ):
+                shutil.copyfileobj(fd, member, storage.CHUNK_SIZE)
+    return out.getvalue()
+
+
+def migrate(con: sql.Connection) -> dict[str, int]:
+    """Converts every jar still stored as one XZ blob into a manifest of members and reports the space saved."""
+    setup(con)
+    before = (
+        con.execute("SELECT COALESCE(SUM(LENGTH(jarBlob)), 0) FROM jars").fetchone()[0]
+        + _stored(con)[1]
+    )
+
+    report = {"jars": 0, "members": 0, "membersNew": 0}
+    jar_ids = [
+        row[0]
+        for row in con.execute(
+            "SELECT jarID FROM jars WHERE storage = ? ORDER BY jarID ASC", (STORAGE_XZ,)
+        )
+    ]
+    for jar_id in jar_ids:
+        with open_xz_jar(con, jar_id) as fd:
+            jar_report = store_members(con, jar_id, fd)
+        con.execute("UPDATE jars SET jarBlob = X'' WHERE jarID = ?", (jar_id,))
+        con.commit()
+        report["jars"] += 1
+        report["members"] += jar_report["members"]
+        report["membersNew"] += jar_report["membersNew"]
+
+    after = (
+        con.execute("SELECT COALESCE(SUM(LENGTH(jarBlob)), 0) FROM jars").fetchone()[0]
+        + _stored(con)[1]
+    )
+    report["bytesBefore"], report["bytesAfter"] = before, after
+    return report
+
+
+def main() -> None:
+    with storage.connect(_db_uri, uri=True) as con:
+        report = migrate(con)
+    saved = report["bytesBefore"] - report["bytesAfter"]
+    print(
+        f"Migrated {report['jars']} jars ({report['members']} members, {report['membersNew']} unique new). "
+        f"{report['bytesBefore']} bytes -> {report['bytesAfter']} bytes "
+        f"({round(100 * saved / max(report['bytesBefore'], 1), ndigits=3)}% saved, abs. change: {-saved} bytes)"
+    )
+    print("Run VACUUM on the database to return the freed pages to the filesystem.")
+
+
+if __name__ == "__main__":
+    main()
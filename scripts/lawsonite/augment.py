@@ -0,0 +1,217 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Literal, NamedTuple
+
+import numpy as np
+
+import dataset
+from dataset import ICON_HEIGHT, ICON_WIDTH
+
+dataset_dir = Path("/db") / Path("lawsonite")
+
+# Backgrounds icons appear over: inventory, bank, equipment and shop interfaces.
+BACKGROUNDS = np.asarray(
+    [(62, 53, 41), (73, 64, 52), (62, 54, 42), (75, 67, 54)], dtype=np.float32
+)
+
+
+class Batch(NamedTuple):
+    x: np.ndarray  # float32 in [0, 1]; (N, H, W, 3) "rgb" or (N, 4, H, W) "planes"
+    rows: np.ndarray  # (N,) dataset row of each sample
+    ids: np.ndarray  # (N,) item id of each sample
+
+
+class Augmenter(object):
+    """Produces augmented batches from the packed dataset with whole-batch NumPy operations.
+
+    Each sample is shifted by up to ``max_shift`` pixels, then composited over a background drawn from
+    ``BACKGROUNDS`` with up to ``jitter`` of per-channel noise. ``layout="planes"`` instead keeps the four RGBA
+    channels as separate planes, as in the channel split sketched in ``create_dataset.py``.
+    """
+
+    def __init__(
+        self,
+        ds: dataset.Dataset,
+        batch_size: int = 256,
+        max_shift: int = 2,
+        jitter: float = 6.0,
+        layout: Literal["rgb", "planes"] = "rgb",
+        rows: np.ndarray | None = None,
+    ):
+        if layout not in ("rgb", "planes"):
+            raise ValueError('layout must be "rgb" or "planes"')
+        self.ds, self.batch_size, self.max_shift = ds, batch_size, max_shift
+        self.jitter, self.layout = jitter, layout
+        self.rows = ds.unique_rows() if rows is None else rows
+
+    def batch(self, rng: np.random.Generator) -> Batch:
+        n, s = self.batch_size, self.max_shift
+        rows = np.sort(rng.choice(self.rows, size=n))
+        icons = np.asarray(self.ds.icons[rows])
+
+        # (N, 4, H, W) planes, each shifted by up to s pixels: pad with transparency and take one window per icon
+        padded = np.pad(icons, ((0, 0), (s, s), (s, s), (0, 0)))
+        windows = np.lib.stride_tricks.sliding_window_view(
+            padded, (ICON_HEIGHT, ICON_WIDTH), axis=(1, 2)
+        )
+        planes = windows[
+            np.arange(n),
+            rng.integers(0, 2 * s + 1, size=n),
+            rng.integers(0, 2 * s + 1, size=n),
+        ]
+
+        if self.layout == "planes":
+            x = planes.astype(np.float32)
+            x *= np.float32(1 / 255)
+        else:
+            background = BACKGROUNDS[rng.integers(len(BACKGROUNDS), size=n)]
+            background += rng.uniform(-self.jitter, self.jitter, size=(n, 3))
+            background = background[:, None, None, :]
+            rgba = planes.transpose(0, 2, 3, 1)
+            alpha = rgba[..., 3:] * np.float32(1 / 255)
+            # background + (icon - background) * alpha, in place to keep temporaries down
+            x = rgba[..., :3].astype(np.float32)
+            x -= background
+            x *= alpha
+            x += background
+            np.clip(x, 0, 255, out=x)
+            x *= np.float32(1 / 255)
+        return Batch(x, rows, self.ds.ids[rows])
+
+    def batches(self, count: int | None = None, seed: int = 0) -> Iterator[Batch]:
+        """Yields ``count`` batches, or forever, in the calling thread."""
+        rng = np.random.default_rng(seed)
+        ii = 0
+        while count is None or ii < count:
+            yield self.batch(rng)
+            ii += 1
+
+
+def prefetch(
+    augmenter: Augmenter,
+    count: int | None = None,
+    workers: int = 2,
+    depth: int = 8,
+    seed: int = 0,
+) -> Iterator[Batch]:
+    """Yields batches prepared ahead of time by ``workers`` threads, up to ``depth`` batches in advance.
+
+    NumPy releases the GIL for the gathers and arithmetic that dominate ``Augmenter.batch``, so threads run in
+    parallel without copying the dataset into worker processes. Batch order depends on scheduling.
+    """
+    if workers == 0:
+        yield from augmenter.batches(count, seed)
+        return
+
+    out: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    remaining = [count]
+    lock = threading.Lock()
+
+    def put(item) -> None:
+        # Gives up once the consumer has gone away, so a full queue cannot hold a worker forever
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def work(worker: int) -> None:
+        rng = np.random.default_rng([seed, worker])
+        try:
+            while not stop.is_set():
+                with lock:
+                    if remaining[0] is not None:
+                        if remaining[0] == 0:
+                            break
+                        remaining[0] -= 1
+                put(augmenter.batch(rng))
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    threads = [
+        threading.Thread(target=work, args=(ii,), daemon=True) for ii in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        finished = 0
+        while finished < workers:
+            item = out.get()
+            if item is None:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def benchmark(
+    augmenter: Augmenter,
+    batches: int = 200,
+    workers: tuple[int, ...] = (0, 1, 2, 4),
+    consumer_ms: float = 0.0,
+) -> list[dict]:
+    """Measures batches/s for each worker count. ``consumer_ms`` simulates a training step per batch, to show how
+    much of the preparation is hidden behind it."""
+    ret = []
+    for count in workers:
+        waited = 0.0
+        t = time.perf_counter()
+        it = prefetch(augmenter, batches, workers=count)
+        while True:
+            t_wait = time.perf_counter()
+            try:
+                next(it)
+            except StopIteration:
+                break
+            waited += time.perf_counter() - t_wait
+            if consumer_ms:
+                time.sleep(consumer_ms / 1000)
+        elapsed = time.perf_counter() - t
+        ret.append(
+            {
+                "workers": count,
+                "batch_size": augmenter.batch_size,
+                "layout": augmenter.layout,
+                "batches_per_s": batches / elapsed,
+                "samples_per_s": batches * augmenter.batch_size / elapsed,
+                "consumer_wait_fraction": waited / elapsed,
+            }
+        )
+    return ret
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the lawsonite augmentation pipeline."
+    )
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--layout", choices=("rgb", "planes"), default="rgb")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--consumer-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    augmenter = Augmenter(
+        dataset.load(dataset_dir), batch_size=args.batch_size, layout=args.layout
+    )
+    for result in benchmark(
+        augmenter, args.batches, tuple(args.workers), args.consumer_ms
+    ):
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
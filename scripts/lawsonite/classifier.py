@@ -0,0 +1,157 @@
+import pickle
+import sys
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.neighbors import NearestNeighbors
+
+import dataset
+from dataset import ICON_HEIGHT, ICON_WIDTH
+
+dataset_dir = Path("/db") / Path("lawsonite")
+
+# Inventory background behind the icons. Dataset icons are composited over it so they look like a screenshot.
+BACKGROUND = (62, 53, 41)
+# A slot whose mean absolute difference from the background is below this is empty.
+EMPTY_THRESHOLD = 4.0
+# Features are 2x2 average-pooled RGB, projected onto this many principal components.
+COMPONENTS = 64
+
+
+class Grid(NamedTuple):
+    """Where the inventory slots are in a screenshot. Defaults are for the fixed-size 765x503 client."""
+
+    left: int = 563
+    top: int = 213
+    columns: int = 4
+    rows: int = 7
+    pitch_x: int = 42
+    pitch_y: int = 36
+
+
+class Prediction(NamedTuple):
+    slot: int
+    item_id: int | None  # None for an empty slot
+    name: str | None
+    distance: float
+
+
+def slots(screenshot: np.ndarray, grid: Grid = Grid()) -> np.ndarray:
+    """Cuts every slot out of an ``(H, W, 3 or 4)`` screenshot in one gather.
+
+    Returns ``(grid.rows * grid.columns, ICON_HEIGHT, ICON_WIDTH, 3)`` uint8, in row-major slot order.
+    """
+    ys = grid.top + grid.pitch_y * np.arange(grid.rows)
+    xs = grid.left + grid.pitch_x * np.arange(grid.columns)
+    y = ys[:, None, None, None] + np.arange(ICON_HEIGHT)[None, None, :, None]
+    x = xs[None, :, None, None] + np.arange(ICON_WIDTH)[None, None, None, :]
+    return screenshot[y, x, :3].reshape(-1, ICON_HEIGHT, ICON_WIDTH, 3)
+
+
+def composite(
+    icons: np.ndarray, background: tuple[int, int, int] = BACKGROUND
+) -> np.ndarray:
+    """Alpha-blends ``(N, H, W, 4)`` RGBA icons over a solid background, returning ``(N, H, W, 3)`` float32."""
+    alpha = icons[..., 3:].astype(np.float32) / 255
+    return icons[..., :3] * alpha + np.asarray(background, dtype=np.float32) * (
+        1 - alpha
+    )
+
+
+def features(rgb: np.ndarray) -> np.ndarray:
+    """Returns ``(N, ICON_HEIGHT * ICON_WIDTH * 3 / 4)`` float32 pooled pixel features of ``(N, H, W, 3)`` RGB."""
+    n = len(rgb)
+    rgb = np.asarray(rgb).reshape(n, ICON_HEIGHT // 2, 2, ICON_WIDTH // 2, 2, 3)
+    # Sum each 2x2 block in uint16 before converting; a float mean over the full-size array is several times slower
+    pooled = rgb[:, :, 0].astype(np.uint16) + rgb[:, :, 1]
+    pooled = pooled[:, :, :, 0] + pooled[:, :, :, 1]
+    return pooled.reshape(n, -1).astype(np.float32) * np.float32(1 / (4 * 255))
+
+
+class Classifier(object):
+    """Nearest-neighbour match of inventory slots against the icon dataset."""
+
+    def __init__(
+        self, ds: dataset.Dataset, background=BACKGROUND, components=COMPONENTS
+    ):
+        self.ids, self.names, self.background = ds.ids, ds.names, background
+        x = features(composite(np.asarray(ds.icons), background))
+        self.pca = PCA(n_components=min(components, *x.shape), random_state=0).fit(x)
+        self.index = NearestNeighbors(n_neighbors=1, algorithm="brute").fit(
+            self.pca.transform(x)
+        )
+
+    @classmethod
+    def load(cls, out_dir: Path = dataset_dir) -> "Classifier":
+        """Loads the classifier prebuilt for the dataset in ``out_dir``, building and saving it if the dataset
+        has changed since."""
+        path, index = out_dir / "classifier.pickle", out_dir / "index.json"
+        if path.exists() and path.stat().st_mtime_ns >= index.stat().st_mtime_ns:
+            with open(path, "rb") as fd:
+                return pickle.load(fd)
+        classifier = cls(dataset.load(out_dir))
+        with open(path.with_suffix(".tmp"), "wb") as fd:
+            pickle.dump(classifier, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        path.with_suffix(".tmp").replace(path)
+        return classifier
+
+    def classify_slots(self, rgb: np.ndarray) -> list[Prediction]:
+        """Classifies ``(N, H, W, 3)`` slot images in one batched query."""
+        empty = (
+            np.abs(
+                rgb.astype(np.float32) - np.asarray(self.background, dtype=np.float32)
+            ).mean(axis=(1, 2, 3))
+            < EMPTY_THRESHOLD
+        )
+        distances, rows = self.index.kneighbors(self.pca.transform(features(rgb)))
+        return [
+            (
+                Prediction(ii, None, None, 0.0)
+                if empty[ii]
+                else Prediction(
+                    ii,
+                    int(self.ids[rows[ii, 0]]),
+                    self.names[rows[ii, 0]],
+                    float(distances[ii, 0]),
+                )
+            )
+            for ii in range(len(rgb))
+        ]
+
+    def classify(self, screenshot: np.ndarray, grid: Grid = Grid()) -> list[Prediction]:
+        return self.classify_slots(slots(screenshot, grid))
+
+
+def main() -> None:
+    from PIL import Image
+
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} SCREENSHOT")
+        exit(1)
+
+    t = time.perf_counter()
+    classifier = Classifier.load()
+    print(f"Loaded classifier in {1000 * (time.perf_counter() - t):.1f} ms")
+    with Image.open(sys.argv[1]) as im:
+        screenshot = np.asarray(im.convert("RGB"))
+
+    t = time.perf_counter()
+    predictions = classifier.classify(screenshot)
+    elapsed = time.perf_counter() - t
+
+    grid = Grid()
+    for row in range(grid.rows):
+        print(
+            " | ".join(
+                f"{p.name or '-':<20.20}"
+                for p in predictions[row * grid.columns : (row + 1) * grid.columns]
+            )
+        )
+    print(f"Classified {len(predictions)} slots in {1000 * elapsed:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,45 @@
-from datetime import datetime
 from pathlib import Path
-from PIL import Image
 import json
+import sqlite3
+import dataset
+import descriptors
+import phash
 
 root_dir = Path("/db")
 
 icons_dir = root_dir / Path("docs/items-icons")
-
-descriptors = json.load(open(root_dir / Path("docs/items-complete.json"), "r"))
-
-inclusions = {}
-exclusions = {}
-
-for k, v in descriptors.items():
-    if v["quest_item"] is True:
-        exclusions[k] = v
-    elif v["incomplete"] is True:
-        exclusions[k] = v
-    elif v["duplicate"] is True:
-        exclusions[k] = v
-    elif v["release_date"] is None:
-        exclusions[k] = v
-    elif datetime.fromisoformat(v["release_date"]) > datetime.fromisoformat(
-        "2007-08-31"
+descriptors_path = root_dir / Path("docs/items-complete.json")
+dataset_dir = root_dir / Path("lawsonite")
+
+
+def main() -> None:
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    with sqlite3.connect(dataset_dir / "descriptors.sqlite3") as con:
+        descriptors.setup(con)
+        sync = descriptors.sync(con, descriptors_path)
+        total = descriptors.count_items(con)
+        inclusions = descriptors.inclusions(con)
+
+    print(
+        f"Descriptors parsed: {sync['parsed']}, changed: {sync['changed']}, removed: {sync['removed']}"
+    )
+    print(
+        f"Total Descriptors: {total}\nExcluded: {total - len(inclusions)}\nIncluded: {len(inclusions)}"
+    )
+
+    report = dataset.build(icons_dir, inclusions, dataset_dir)
+    print(
+        f"Packed {report['icons']} icons into {dataset_dir / 'icons.npy'} "
+        f"({report['decoded']} decoded, {report['undecodable']} undecodable)"
+    )
+
+    if report["decoded"] or "duplicate_groups" not in json.load(
+        open(dataset_dir / "index.json", "r")
     ):
-        exclusions[k] = v
-    else:
-        inclusions[k] = v
-
-print(
-    f"Total Descriptors: {len(descriptors)}\nExcluded: {len(exclusions)}\nIncluded: {len(inclusions)}"
-)
+        report = phash.update(dataset_dir)
+        print(
+            f"{report['groups']} near-duplicate groups, {report['redundant']} redundant icons"
+        )
 
 
 # with Image.open(icons_dir / "4151.png") as im:
@@ -40,3 +49,7 @@ print(
 #         im2.paste(chan, (xoff, 0))
 #
 #     im2.show()
+
+
+if __name__ == "__main__":
+    main()
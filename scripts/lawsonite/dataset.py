@@ -0,0 +1,184 @@
+import json
+import multiprocessing as mp
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+import numpy as np
+
+# Item icons are 36x32. Every icon is stored at this shape, smaller ones centered on a transparent background.
+ICON_HEIGHT, ICON_WIDTH = 32, 36
+ICON_SHAPE = (ICON_HEIGHT, ICON_WIDTH, 4)
+
+_chunksize = 64
+
+
+class Dataset(NamedTuple):
+    icons: np.ndarray  # (N, ICON_HEIGHT, ICON_WIDTH, 4) uint8 RGBA, memory-mapped
+    ids: np.ndarray  # (N,) int64 item id of each row
+    names: list[str]
+    # Item ids with near-identical icons, lowest id first
+    duplicate_groups: list[list[int]] = []
+
+    def row(self, item_id: int) -> int:
+        """Returns the row holding ``item_id``.
+
+        :raises KeyError:
+        """
+        rows = np.flatnonzero(self.ids == item_id)
+        if len(rows) == 0:
+            raise KeyError(f"Item {item_id} is not in the dataset.")
+        return int(rows[0])
+
+    def unique_rows(self) -> np.ndarray:
+        """Returns the rows to train on: every item except the non-first members of each duplicate group."""
+        redundant = [
+            item_id for group in self.duplicate_groups for item_id in group[1:]
+        ]
+        return np.flatnonzero(~np.isin(self.ids, redundant))
+
+
+def _decode(path: Path) -> bytes | None:
+    # Runs in a worker. PIL is only needed here, so loading a built dataset never imports it.
+    from PIL import Image
+
+    try:
+        with Image.open(path) as im:
+            im = im.convert("RGBA")
+            if (im.height, im.width) != (ICON_HEIGHT, ICON_WIDTH):
+                canvas = Image.new("RGBA", (ICON_WIDTH, ICON_HEIGHT), (0, 0, 0, 0))
+                canvas.paste(
+                    im, ((ICON_WIDTH - im.width) // 2, (ICON_HEIGHT - im.height) // 2)
+                )
+                im = canvas
+            return im.tobytes()
+    except (FileNotFoundError, OSError):
+        return None
+
+
+def _stat(path: Path) -> list[int]:
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+def build(
+    icons_dir: Path, items: Iterable[tuple[int, str]], out_dir: Path
+) -> dict[str, int]:
+    """Decodes the icon of each ``(id, name)`` in ``items`` in a process pool and packs them into
+    ``out_dir/icons.npy`` with a matching ``out_dir/index.json``. Items without a readable icon are skipped.
+
+    Rows of an existing dataset whose icon file is unchanged (same size and mtime) are copied rather than
+    decoded again, icons that failed to decode are not retried until they change, and nothing is written at
+    all if neither the items nor their icons changed.
+    """
+    items = sorted(
+        (item_id, name, _stat(icons_dir / f"{item_id}.png"))
+        for item_id, name in items
+        if (icons_dir / f"{item_id}.png").is_file()
+    )
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    previous, previous_rows, previous_failed = None, {}, set()
+    try:
+        with open(out_dir / "index.json", "r") as fd:
+            index = json.load(fd)
+        if "stats" in index:
+            previous = np.load(out_dir / "icons.npy", mmap_mode="r")
+            previous_rows = {
+                (item_id, tuple(stat)): row
+                for row, (item_id, stat) in enumerate(zip(index["ids"], index["stats"]))
+            }
+            previous_failed = {
+                (item_id, tuple(stat)) for item_id, stat in index.get("undecodable", [])
+            }
+            kept = [x for x in items if (x[0], tuple(x[2])) not in previous_failed]
+            if len(kept) + len(previous_failed) == len(items) and kept == list(
+                zip(index["ids"], index["names"], index["stats"])
+            ):
+                return {
+                    "icons": len(kept),
+                    "decoded": 0,
+                    "undecodable": len(previous_failed),
+                }
+    except FileNotFoundError:
+        pass
+
+    changed = [
+        (item_id, stat)
+        for item_id, _, stat in items
+        if (item_id, tuple(stat)) not in previous_rows
+        and (item_id, tuple(stat)) not in previous_failed
+    ]
+    tmp = out_dir / "icons.npy.tmp"
+    icons = np.lib.format.open_memmap(
+        tmp, mode="w+", dtype=np.uint8, shape=(len(items), *ICON_SHAPE)
+    )
+    ids, names, stats, failed = [], [], [], []
+    decoded = {}
+    if changed:
+        with mp.Pool() as pool:
+            decoded = dict(
+                zip(
+                    (item_id for item_id, _ in changed),
+                    pool.imap(
+                        _decode,
+                        (icons_dir / f"{item_id}.png" for item_id, _ in changed),
+                        _chunksize,
+                    ),
+                )
+            )
+    for item_id, name, stat in items:
+        row = previous_rows.get((item_id, tuple(stat)))
+        if row is not None:
+            icons[len(ids)] = previous[row]
+        elif decoded.get(item_id) is not None:
+            icons[len(ids)] = np.frombuffer(decoded[item_id], dtype=np.uint8).reshape(
+                ICON_SHAPE
+            )
+        else:
+            failed.append([item_id, stat])
+            continue
+        ids.append(item_id)
+        names.append(name)
+        stats.append(stat)
+    icons.flush()
+    del previous
+
+    if len(ids) < len(items):
+        # Some icons failed to decode; copy the rows that were written into an array of the right length.
+        packed = np.lib.format.open_memmap(
+            out_dir / "icons.npy.part",
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(ids), *ICON_SHAPE),
+        )
+        packed[:] = icons[: len(ids)]
+        packed.flush()
+        del packed, icons
+        (out_dir / "icons.npy.part").replace(tmp)
+    else:
+        del icons
+
+    tmp.replace(out_dir / "icons.npy")
+    with open(out_dir / "index.json.tmp", "w") as fd:
+        json.dump(
+            {"ids": ids, "names": names, "stats": stats, "undecodable": failed}, fd
+        )
+    (out_dir / "index.json.tmp").replace(out_dir / "index.json")
+    return {
+        "icons": len(ids),
+        "decoded": len(changed),
+        "undecodable": len(failed),
+    }
+
+
+def load(out_dir: Path) -> Dataset:
+    """Maps a dataset written by ``build``. Nothing is decoded and no icon is read until it is sliced."""
+    with open(out_dir / "index.json", "r") as fd:
+        index = json.load(fd)
+    icons = np.load(out_dir / "icons.npy", mmap_mode="r")
+    ids = np.asarray(index["ids"], dtype=np.int64)
+    if len(ids) != len(icons):
+        raise RuntimeError(
+            "icons.npy and index.json are out of step. Rebuild the dataset."
+        )
+    return Dataset(icons, ids, index["names"], index.get("duplicate_groups", []))
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, TextIO
+
+# The original filter dropped items released after this date.
+RELEASE_CUTOFF = "2007-08-31"
+
+_read_size = 1024 * 1024
+_decoder = json.JSONDecoder()
+
+
+def setup(con: sqlite3.Connection) -> None:
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS source
+        (
+            path TEXT PRIMARY KEY,
+            blake2b TEXT NOT NULL,
+            sizeBytes INTEGER NOT NULL,
+            mtimeNs INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS items
+        (
+            itemID INTEGER PRIMARY KEY,
+            name TEXT,
+            questItem INTEGER NOT NULL,
+            incomplete INTEGER NOT NULL,
+            duplicate INTEGER NOT NULL,
+            releaseDate TEXT,
+            blake2b TEXT NOT NULL,
+            descriptor TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS itemsFilter ON items (questItem, incomplete, duplicate, releaseDate);
+        """
+    )
+    con.commit()
+
+
+def iter_descriptors(fd: TextIO) -> Iterator[tuple[str, str]]:
+    """Yields ``(key, descriptor JSON)`` for each member of the top-level object in ``fd``, reading it in
+    chunks instead of materialising the whole document."""
+    buffer, pos, eof = "", 0, False
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        data = fd.read(_read_size)
+        buffer, pos = buffer[pos:] + data, 0
+        eof = not data
+        return not eof
+
+    def skip(chars: str) -> None:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return
+
+    def value():
+        nonlocal pos
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(buffer, pos)
+                # A value that ends exactly at the end of the buffer may have been cut short
+                if end < len(buffer) or eof:
+                    ret, pos = (obj, buffer[pos:end]), end
+                    return ret
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    skip(" \t\r\n")
+    if buffer[pos : pos + 1] != "{":
+        raise ValueError("Expected a JSON object of descriptors.")
+    pos += 1
+    while True:
+        skip(" \t\r\n,")
+        if buffer[pos : pos + 1] == "}" or (pos >= len(buffer) and eof):
+            return
+        key, _ = value()
+        skip(" \t\r\n:")
+        _, text = value()
+        yield key, text
+
+
+def _release_date(value: str | None) -> str | None:
+    return None if value is None else datetime.fromisoformat(value).isoformat()
+
+
+def _file_hash(path: Path) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fd:
+        while data := fd.read(_read_size):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def sync(con: sqlite3.Connection, path: Path) -> dict[str, int]:
+    """Brings the ``items`` table in line with the descriptor file at ``path``.
+
+    Unchanged size and mtime skip the file entirely; an unchanged hash skips parsing. Otherwise the file is
+    streamed and only items whose descriptor text changed are rewritten.
+    """
+    report = {"parsed": 0, "changed": 0, "removed": 0}
+    st = path.stat()
+    row = con.execute(
+        "SELECT blake2b, sizeBytes, mtimeNs FROM source WHERE path = ?", (str(path),)
+    ).fetchone()
+    if row is not None and row[1:] == (st.st_size, st.st_mtime_ns):
+        return report
+    blake2b = _file_hash(path)
+    if row is not None and row[0] == blake2b:
+        con.execute(
+            "UPDATE source SET sizeBytes = ?, mtimeNs = ? WHERE path = ?",
+            (st.st_size, st.st_mtime_ns, str(path)),
+        )
+        con.commit()
+        return report
+
+    known = dict(con.execute("SELECT itemID, blake2b FROM items"))
+    seen = set()
+    with open(path, "r") as fd:
+        for key, text in iter_descriptors(fd):
+            item_id = int(key)
+            seen.add(item_id)
+            report["parsed"] += 1
+            digest = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+            if known.get(item_id) == digest:
+                continue
+            v = json.loads(text)
+            con.execute(
+                """
+                INSERT OR REPLACE INTO items
+                    (itemID, name, questItem, incomplete, duplicate, releaseDate, blake2b, descriptor)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    item_id,
+                    v.get("name"),
+                    v["quest_item"] is True,
+                    v["incomplete"] is True,
+                    v["duplicate"] is True,
+                    _release_date(v["release_date"]),
+                    digest,
+                    text,
+                ),
+            )
+            report["changed"] += 1
+    removed = known.keys() - seen
+    con.executemany("DELETE FROM items WHERE itemID = ?", ((i,) for i in removed))
+    report["removed"] = len(removed)
+    con.execute(
+        "INSERT OR REPLACE INTO source (path, blake2b, sizeBytes, mtimeNs) VALUES (?, ?, ?, ?)",
+        (str(path), blake2b, st.st_size, st.st_mtime_ns),
+    )
+    con.commit()
+    return report
+
+
+def inclusions(
+    con: sqlite3.Connection, cutoff: str = RELEASE_CUTOFF
+) -> list[tuple[int, str]]:
+    """Returns ``(itemID, name)`` for every item that is not a quest item, incomplete or a duplicate, and was
+    released on or before ``cutoff``."""
+    return con.execute(
+        """
+        SELECT itemID, name FROM items
+        WHERE questItem = 0 AND incomplete = 0 AND duplicate = 0
+            AND releaseDate IS NOT NULL AND releaseDate <= ?
+        ORDER BY itemID
+        """,
+        (_release_date(cutoff),),
+    ).fetchall()
+
+
+def count_items(con: sqlite3.Connection) -> int:
+    return con.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+
+def get_descriptor(con: sqlite3.Connection, item_id: int) -> dict:
+    """Returns the full descriptor of one item.
+
+    :raises KeyError:
+    """
+    row = con.execute(
+        "SELECT descriptor FROM items WHERE itemID = ?", (item_id,)
+    ).fetchone()
+    if row is None:
+        raise KeyError(f"No descriptor for item {item_id}.")
+    return json.loads(row[0])
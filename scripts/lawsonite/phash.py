@@ -0,0 +1,157 @@
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+import dataset
+from dataset import ICON_HEIGHT, ICON_WIDTH
+
+# Icons are near-duplicates when both hashes are within these Hamming distances (of 64 bits).
+PHASH_RADIUS = 6
+DHASH_RADIUS = 8
+
+_PHASH_SIZE = 32
+_batch_size = 4096
+
+dataset_dir = Path("/db") / Path("lawsonite")
+
+
+def _gray(icons: np.ndarray) -> np.ndarray:
+    # Luma premultiplied by alpha, so transparent pixels are black whatever colour they carry
+    icons = np.asarray(icons, dtype=np.float32)
+    luma = icons[..., :3] @ np.asarray([0.299, 0.587, 0.114], dtype=np.float32)
+    return luma * icons[..., 3] / 255
+
+
+def _pack(bits: np.ndarray) -> np.ndarray:
+    return (
+        np.packbits(bits.reshape(len(bits), 64), axis=1)
+        .view(">u8")[:, 0]
+        .astype(np.uint64)
+    )
+
+
+def dhash(icons: np.ndarray) -> np.ndarray:
+    """64-bit difference hash of ``(N, H, W, 4)`` icons: 4x4 block means on an 8x9 grid, compared left to right."""
+    blocks = (
+        _gray(icons)
+        .reshape(len(icons), 8, ICON_HEIGHT // 8, 9, ICON_WIDTH // 9)
+        .mean(axis=(2, 4))
+    )
+    return _pack(blocks[:, :, 1:] > blocks[:, :, :-1])
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k, x = np.arange(n)[:, None], np.arange(n)[None, :]
+    ret = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    ret[0] /= np.sqrt(2)
+    return ret.astype(np.float32)
+
+
+_DCT = _dct_matrix(_PHASH_SIZE)
+
+
+def phash(icons: np.ndarray) -> np.ndarray:
+    """64-bit perceptual hash of ``(N, H, W, 4)`` icons: the signs of the 8x8 lowest DCT frequencies of the
+    central 32x32 pixels relative to their median, DC term excluded from the median."""
+    left = (ICON_WIDTH - _PHASH_SIZE) // 2
+    gray = _gray(icons)[:, :, left : left + _PHASH_SIZE]
+    coefficients = (_DCT @ gray @ _DCT.T)[:, :8, :8].reshape(len(icons), 64)
+    median = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    return _pack(coefficients > median)
+
+
+def _segments(radius: int) -> list[tuple[int, int]]:
+    # radius + 1 disjoint bit ranges covering all 64 bits: (shift, width)
+    widths = [64 // (radius + 1) + (ii < 64 % (radius + 1)) for ii in range(radius + 1)]
+    return [(sum(widths[:ii]), w) for ii, w in enumerate(widths)]
+
+
+def near_pairs(hashes: np.ndarray, radius: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns row pairs ``(i, j)`` whose hashes differ in at most ``radius`` bits, by multi-index hashing.
+
+    Split into ``radius + 1`` segments, two such hashes must agree exactly on at least one segment, so only rows
+    sharing a segment value are compared. Rows are sorted by each segment and compared with their neighbours
+    ``k`` places on, for growing ``k`` until no neighbours share the segment; each step is one vector operation.
+    """
+    ret_i, ret_j = [], []
+    for shift, width in _segments(radius):
+        keys = (hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        for k in range(1, len(hashes)):
+            same = sorted_keys[k:] == sorted_keys[:-k]
+            if not same.any():
+                break
+            i, j = order[:-k][same], order[k:][same]
+            close = np.bitwise_count(hashes[i] ^ hashes[j]) <= radius
+            ret_i.append(i[close])
+            ret_j.append(j[close])
+    if not ret_i:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(ret_i), np.concatenate(ret_j)
+
+
+def duplicate_groups(dhashes: np.ndarray, phashes: np.ndarray) -> list[list[int]]:
+    """Groups rows whose icons are near-duplicates under both hashes. Groups are transitive and each is sorted."""
+    i, j = near_pairs(phashes, PHASH_RADIUS)
+    close = np.bitwise_count(dhashes[i] ^ dhashes[j]) <= DHASH_RADIUS
+    parent = list(range(len(phashes)))
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(i[close].tolist(), j[close].tolist()):
+        parent[find(a)] = find(b)
+
+    groups: dict[int, list[int]] = {}
+    for row in range(len(parent)):
+        groups.setdefault(find(row), []).append(row)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def update(out_dir: Path) -> dict[str, int]:
+    """Hashes every icon of the dataset in ``out_dir``, saves the hashes to ``hashes.npy`` (rows of dHash, pHash)
+    and writes the near-duplicate groups, as item ids, into ``index.json``."""
+    ds = dataset.load(out_dir)
+    hashes = np.zeros((len(ds.ids), 2), dtype=np.uint64)
+    for start in range(0, len(ds.ids), _batch_size):
+        icons = np.asarray(ds.icons[start : start + _batch_size])
+        hashes[start : start + len(icons), 0] = dhash(icons)
+        hashes[start : start + len(icons), 1] = phash(icons)
+    with open(out_dir / "hashes.npy.tmp", "wb") as fd:
+        np.save(fd, hashes)
+    (out_dir / "hashes.npy.tmp").replace(out_dir / "hashes.npy")
+
+    groups = sorted(
+        sorted(int(ds.ids[row]) for row in group)
+        for group in duplicate_groups(hashes[:, 0], hashes[:, 1])
+    )
+    with open(out_dir / "index.json", "r") as fd:
+        index = json.load(fd)
+    index["duplicate_groups"] = groups
+    with open(out_dir / "index.json.tmp", "w") as fd:
+        json.dump(index, fd)
+    (out_dir / "index.json.tmp").replace(out_dir / "index.json")
+    return {
+        "icons": len(ds.ids),
+        "groups": len(groups),
+        "redundant": sum(len(g) - 1 for g in groups),
+    }
+
+
+def main() -> None:
+    out_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else dataset_dir
+    report = update(out_dir)
+    print(
+        f"{report['icons']} icons, {report['groups']} near-duplicate groups, "
+        f"{report['redundant']} redundant icons"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from classifier import Classifier, Grid, Prediction, dataset_dir, slots
+
+_host, _port = "127.0.0.1", 8642
+
+
+class Batcher(object):
+    """Collects slot queries from concurrent requests and classifies them together.
+
+    A batch is sent when ``max_slots`` slots are waiting, or ``max_wait`` seconds after its first request
+    arrived, whichever comes first. One thread owns the classifier, so it needs no locking.
+    """
+
+    def __init__(
+        self, classifier: Classifier, max_slots: int = 1024, max_wait: float = 0.002
+    ):
+        self.classifier, self.max_slots, self.max_wait = classifier, max_slots, max_wait
+        self._queue: queue.Queue[tuple[np.ndarray, Future] | None] = queue.Queue()
+        self.batches = self.batched_requests = 0
+        self._thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, rgb: np.ndarray) -> list[Prediction]:
+        """Classifies ``(N, H, W, 3)`` slot images as part of the next batch, blocking until it is done."""
+        future = Future()
+        self._queue.put((rgb, future))
+        return future.result()
+
+    def _run(self) -> None:
+        while (first := self._queue.get()) is not None:
+            batch, size = [first], len(first[0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_slots:
+                try:
+                    item = self._queue.get(
+                        timeout=max(deadline - time.perf_counter(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            try:
+                predictions = self.classifier.classify_slots(
+                    np.concatenate([rgb for rgb, _ in batch])
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for rgb, future in batch:
+                future.set_result(
+                    [
+                        p._replace(slot=p.slot - start)
+                        for p in predictions[start : start + len(rgb)]
+                    ]
+                )
+                start += len(rgb)
+            self.batches += 1
+            self.batched_requests += len(batch)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+
+class Latency(object):
+    """Per-request latencies over the last ``window`` requests."""
+
+    def __init__(self, window: int = 10_000):
+        self._samples: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def summary(self) -> dict[str, float | int]:
+        with self._lock:
+            samples = np.fromiter(self._samples, dtype=np.float64)
+        ret = {"count": self.count}
+        if len(samples):
+            for q in (50, 90, 99):
+                ret[f"p{q}_ms"] = float(np.percentile(samples, q)) * 1000
+            ret["max_ms"] = float(samples.max()) * 1000
+        return ret
+
+
+class Service(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        classifier: Classifier,
+        grid: Grid = Grid(),
+        **kwargs,
+    ):
+        super().__init__(address, _Handler)
+        self.grid = grid
+        self.batcher = Batcher(classifier, **kwargs)
+        self.latency = Latency()
+
+    def stats(self) -> dict:
+        return {
+            "latency": self.latency.summary(),
+            "batches": self.batcher.batches,
+            "requests_per_batch": self.batcher.batched_requests
+            / max(self.batcher.batches, 1),
+        }
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.batcher.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: Service
+
+    def _reply(self, code: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path == "/stats":
+            self._reply(200, self.server.stats())
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        if self.path != "/classify":
+            self._reply(404, {"error": "not found"})
+            return
+        t = time.perf_counter()
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            with Image.open(io.BytesIO(body)) as im:
+                screenshot = np.asarray(im.convert("RGB"))
+            rgb = slots(screenshot, self.server.grid)
+        except (OSError, IndexError, ValueError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+        predictions = self.server.batcher.submit(rgb)
+        elapsed = time.perf_counter() - t
+        self.server.latency.add(elapsed)
+        self._reply(
+            200,
+            {"slots": [p._asdict() for p in predictions], "latency_ms": elapsed * 1000},
+        )
+
+    def log_message(self, format, *args) -> None:
+        pass  # One line per request would cost more than the request
+
+
+def classify(image: bytes, url: str = f"http://{_host}:{_port}") -> list[Prediction]:
+    """Stand-in client: posts one encoded screenshot to a running service."""
+    request = urllib.request.Request(
+        url + "/classify",
+        data=image,
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    with urllib.request.urlopen(request) as resp:
+        return [Prediction(**p) for p in json.load(resp)["slots"]]
+
+
+def get_stats(url: str = f"http://{_host}:{_port}") -> dict:
+    with urllib.request.urlopen(url + "/stats") as resp:
+        return json.load(resp)
+
+
+def _synthetic_screenshots(
+    classifier: Classifier, out_dir: Path, count: int, grid: Grid
+) -> list[bytes]:
+    # Screenshots built from dataset icons, so the benchmark needs nothing but the dataset.
+    import dataset
+    from classifier import composite
+
+    ds = dataset.load(out_dir)
+    rng = np.random.default_rng(0)
+    ret = []
+    for _ in range(count):
+        shot = np.empty((503, 765, 3), dtype=np.uint8)
+        shot[:] = classifier.background
+        rows = rng.integers(len(ds.ids), size=grid.rows * grid.columns)
+        icons = composite(np.asarray(ds.icons[np.sort(rows)])).round().astype(np.uint8)
+        for slot, icon in enumerate(icons):
+            y = grid.top + grid.pitch_y * (slot // grid.columns)
+            x = grid.left + grid.pitch_x * (slot % grid.columns)
+            shot[y : y + icon.shape[0], x : x + icon.shape[1]] = icon
+        fd = io.BytesIO()
+        Image.fromarray(shot).save(fd, format="PNG")
+        ret.append(fd.getvalue())
+    return ret
+
+
+def bench(out_dir: Path = dataset_dir, requests: int = 500, clients: int = 16) -> dict:
+    """Starts a service on an ephemeral port and drives it with ``clients`` concurrent stand-in clients."""
+    classifier = Classifier.load(out_dir)
+    service = Service((_host, 0), classifier)
+    thread = threading.Thread(target=service.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://{_host}:{service.server_address[1]}"
+    try:
+        shots = _synthetic_screenshots(classifier, out_dir, 16, service.grid)
+        t = time.perf_counter()
+        with ThreadPoolExecutor(clients) as pool:
+            list(
+                pool.map(
+                    lambda ii: classify(shots[ii % len(shots)], url), range(requests)
+                )
+            )
+        elapsed = time.perf_counter() - t
+        stats = get_stats(url)
+    finally:
+        service.shutdown()
+        service.server_close()
+    stats["requests_per_s"] = requests / elapsed
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Lawsonite screenshot classification service."
+    )
+    parser.add_argument("--port", type=int, default=_port)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    parser.add_argument(
+        "--bench", action="store_true", help="Benchmark with local stand-in clients."
+    )
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.bench:
+        print(json.dumps(bench(requests=args.requests, clients=args.clients), indent=2))
+        return
+
+    t = time.perf_counter()
+    service = Service(
+        (_host, args.port), Classifier.load(), max_wait=args.max_wait_ms / 1000
+    )
+    print(
+        f"Loaded in {time.perf_counter() - t:.2f} s, listening on http://{_host}:{args.port}"
+    )
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+        print(json.dumps(service.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,26 @@
 # capture.py
 import hashlib
+import sys
 import time
 import pyshark
 import sqlite3
 import spessartine
+import codec
+from pathlib import Path
 from spessartine import Net, FilePath, Log
+from stats import TrafficStats
 from typing import NoReturn
 
+sys.path.append(str(Path(__file__).parent.parent))
+import storage
+
 sender: str = __file__.rpartition("/")[-1].strip()
 
 
-def setup() -> (sqlite3.Cursor, pyshark.LiveRingCapture):
-    Log.log(sender, "Started execution.")
-
+def setup_database(path=FilePath.database) -> sqlite3.Cursor:
     # sqlite3: Create spessartine.sqlite3 if it does not exist. Then, create any tables that should exist.
-    try:
-        _ = open(
-            FilePath.database, "x+b"
-        ).close()  # raises FileExistsError if db_path exists
-    except FileExistsError:
-        pass
-
-    # sqlite3: Connect to DB, get a cursor
-    connection = sqlite3.connect(FilePath.database, timeout=10)
+    # WAL mode lets analysis scripts read while the capture is writing.
+    connection = storage.connect(path)
     cursor = connection.cursor()
 
     connection.execute(
@@ -50,10 +48,20 @@ def setup() -> (sqlite3.Cursor, pyshark.LiveRingCapture):
     """
     )
     connection.commit()
+    storage.setup(connection)
+    codec.setup(connection)
+
+    return cursor
+
+
+def setup() -> (sqlite3.Cursor, pyshark.LiveRingCapture):
+    Log.log(sender, "Started execution.")
+
+    cursor = setup_database()
 
     # pyshark: Create a capture backed by a finite sized ring buffer
     tcp_bidi_data_only, thirty_two_mb = (
-        "host 192.168.1.10 && host 50.116.63.13",
+        f"host {Net.client_address} && host {Net.server_address}",
         32 * 1024,
     )
     capture = pyshark.LiveRingCapture(
@@ -78,11 +86,12 @@ def teardown(cursor_: sqlite3.Cursor, capture_: pyshark.LiveRingCapture) -> NoRe
     exit(0)
 
 
-def mainloop(cursor_: sqlite3.Cursor, capture_: pyshark.LiveRingCapture) -> None:
-    timeout = 10.0
+def make_callback(cursor_: sqlite3.Cursor, stats: TrafficStats):
+    """Returns the per-packet callback that stores a pyshark packet and records it in ``stats``."""
 
     def _callback(packet) -> None:
         raw_packet = packet.get_raw_packet()
+        t_insert = time.perf_counter()
         cursor_.execute(
             """
                 INSERT OR ABORT INTO packets (packet, sizeBytes, blake2b, iso8601) VALUES (?, ?, ?, ?)
@@ -94,19 +103,42 @@ def mainloop(cursor_: sqlite3.Cursor, capture_: pyshark.LiveRingCapture) -> None
                 spessartine.Time.now(),
             ),
         )
+        stats.record_insert(time.perf_counter() - t_insert)
+
+        src = getattr(getattr(packet, "ip", None), "src", None)
+        if src == Net.client_address:
+            direction = "client_to_server"
+        elif src == Net.server_address:
+            direction = "server_to_client"
+        else:
+            direction = "other"
+        stats.record_packet(
+            int(packet.length), direction, float(packet.sniff_timestamp)
+        )
+
+    return _callback
+
+
+def mainloop(cursor_: sqlite3.Cursor, capture_: pyshark.LiveRingCapture) -> None:
+    timeout = 10.0
+    stats = TrafficStats()
+    _callback = make_callback(cursor_, stats)
 
     t, acc = time.monotonic(), 0
     while True:
         dt = time.monotonic() - t
         if dt >= 10.0:
             Log.log(sender, f"+{acc} packets. ({round(acc/dt, 1)} pkt/s)")
+            t_commit = time.perf_counter()
             cursor_.connection.commit()
+            stats.record_commit(time.perf_counter() - t_commit)
             t = time.monotonic()
             acc = 0
 
         try:
             _ = capture_.apply_on_packets(_callback, timeout=timeout, packet_count=1)
             acc += 1
+            stats.publish()
 
         except KeyboardInterrupt:
             # Exit main loop on CTRL+C
@@ -124,6 +156,8 @@ def mainloop(cursor_: sqlite3.Cursor, capture_: pyshark.LiveRingCapture) -> None
             break
 
         except Exception as exc:
+            stats.record_error()
+            stats.publish(force=True)
             Log.log(
                 sender,
                 f"Exception: An unknown exception occurred: {exc}",
@@ -0,0 +1,304 @@
+# clustering.py
+
+import multiprocessing as mp
+import sqlite3
+from hashlib import blake2b
+
+import Levenshtein
+import numpy as np
+from tqdm import tqdm
+
+from reassembly import parse_frame
+from spessartine import FilePath, Log
+
+sender: str = __file__.rpartition("/")[-1].strip()
+
+# Signature layout: NUM_BANDS bands of ROWS_PER_BAND minhashes each. Two payloads with Jaccard similarity s
+# share at least one band with probability 1 - (1 - s**ROWS_PER_BAND) ** NUM_BANDS.
+NUM_BANDS, ROWS_PER_BAND = 16, 4
+NUM_PERMUTATIONS = NUM_BANDS * ROWS_PER_BAND
+SHINGLE_SIZE = 4
+
+# Candidates must still pass an exact edit-distance check.
+MIN_SIMILARITY = 0.8
+
+# Upper bound on the exact comparisons a payload makes within one LSH bucket.
+MAX_REPRESENTATIVES = 8
+
+_MERSENNE_31 = (1 << 31) - 1
+_rng = np.random.default_rng(seed=0x5E55)
+_A = _rng.integers(1, _MERSENNE_31, size=(NUM_PERMUTATIONS, 1), dtype=np.uint64)
+_B = _rng.integers(0, _MERSENNE_31, size=(NUM_PERMUTATIONS, 1), dtype=np.uint64)
+
+
+def shingles(payload: bytes) -> np.ndarray:
+    """Returns the distinct ``SHINGLE_SIZE``-byte windows of ``payload`` packed into integers."""
+    a = np.frombuffer(payload, dtype=np.uint8).astype(np.uint64)
+    if len(a) < SHINGLE_SIZE:
+        return np.array([int.from_bytes(payload, "big") + 1], dtype=np.uint64)
+    s = np.zeros(len(a) - SHINGLE_SIZE + 1, dtype=np.uint64)
+    for ii in range(SHINGLE_SIZE):
+        s = (s << np.uint64(8)) | a[ii : len(a) - SHINGLE_SIZE + 1 + ii]
+    return np.unique(s)
+
+
+def minhash(payload: bytes) -> np.ndarray:
+    s = shingles(payload) % np.uint64(_MERSENNE_31)
+    return ((_A * s + _B) % np.uint64(_MERSENNE_31)).min(axis=1)
+
+
+def _signatures(payloads: list[bytes]) -> list[tuple[bytes, tuple[bytes, ...]]]:
+    # Runs in a worker: the MinHash signature of each payload and one short digest per LSH band.
+    ret = []
+    for payload in payloads:
+        signature = minhash(payload).astype(np.uint32)
+        ret.append(
+            (
+                signature.tobytes(),
+                tuple(
+                    blake2b(band.tobytes(), digest_size=8).digest()
+                    for band in signature.reshape(NUM_BANDS, ROWS_PER_BAND)
+                ),
+            )
+        )
+    return ret
+
+
+def setup(connection: sqlite3.Connection) -> None:
+    connection.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS clusterPayloads
+        (
+            id INTEGER UNIQUE NOT NULL PRIMARY KEY ASC,
+            blake2b BLOB UNIQUE NOT NULL ON CONFLICT ABORT,
+            packetID INTEGER NOT NULL ON CONFLICT ABORT,
+            clusterID INTEGER NOT NULL ON CONFLICT ABORT,
+            signature BLOB NOT NULL ON CONFLICT ABORT
+        );
+        CREATE INDEX IF NOT EXISTS clusterPayloadsClusterID ON clusterPayloads (clusterID);
+        CREATE TABLE IF NOT EXISTS clusterBuckets
+        (
+            band INTEGER NOT NULL ON CONFLICT ABORT,
+            bucket BLOB NOT NULL ON CONFLICT ABORT,
+            payloadID INTEGER NOT NULL ON CONFLICT ABORT REFERENCES clusterPayloads (id),
+            PRIMARY KEY (band, bucket, payloadID)
+        );
+        CREATE TABLE IF NOT EXISTS clusteringState
+        (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            lastPacketID INTEGER NOT NULL ON CONFLICT ABORT
+        );
+    """
+    )
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(packets)")}
+    if "clusterID" not in columns:
+        connection.execute("ALTER TABLE packets ADD COLUMN clusterID INTEGER")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS packetsClusterID ON packets (clusterID)"
+    )
+    connection.commit()
+
+
+class Clusterer(object):
+    """Groups the payloads of ``packets`` into clusters of similar messages and stores the cluster id on each
+    packet. A cluster is named after the lowest packet id it contains.
+
+    Distinct payloads, their MinHash signatures and the representatives of each LSH bucket are kept in
+    ``clusterPayloads`` and ``clusterBuckets``, so each run only signs the packets added since the previous
+    one. Only pairs that collide in at least one band are compared with ``Levenshtein.ratio``, and within a
+    bucket a payload is compared against at most ``MAX_REPRESENTATIVES`` members.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, chunksize: int = 1024):
+        self.connection = connection
+        self.chunksize = chunksize
+        # Per batch: payloadID -> payload / clusterID, (band, bucket) -> representatives, clusterID -> merged into
+        self.payloads: dict[int, bytes] = {}
+        self.clusters: dict[int, int] = {}
+        self.buckets: dict[tuple[int, bytes], list[int]] = {}
+        self.parent: dict[int, int] = {}
+        self.payloads_added = 0
+        self.merges = 0
+
+    def find(self, x: int) -> int:
+        while (parent := self.parent.get(x, x)) != x:
+            self.parent[x] = self.parent.get(parent, parent)
+            x = parent
+        return x
+
+    def union(self, x: int, y: int) -> None:
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parent[max(x, y)] = min(x, y)
+
+    def _load(self, payload_id: int) -> None:
+        # Representatives stored by an earlier run: the payload is read back from its first packet.
+        cluster_id, frame = self.connection.execute(
+            """
+            SELECT clusterPayloads.clusterID, packets.packet FROM clusterPayloads
+            JOIN packets ON packets.id = clusterPayloads.packetID
+            WHERE clusterPayloads.id = ?
+            """,
+            (payload_id,),
+        ).fetchone()
+        self.payloads[payload_id] = parse_frame(frame).payload
+        self.clusters[payload_id] = cluster_id
+
+    def _representatives(self, band: int, bucket: bytes) -> list[int]:
+        try:
+            return self.buckets[band, bucket]
+        except KeyError:
+            members = [
+                payload_id
+                for (payload_id,) in self.connection.execute(
+                    "SELECT payloadID FROM clusterBuckets WHERE band = ? AND bucket = ? ORDER BY payloadID ASC",
+                    (band, bucket),
+                )
+            ]
+            for payload_id in members:
+                if payload_id not in self.payloads:
+                    self._load(payload_id)
+            self.buckets[band, bucket] = members
+            return members
+
+    def _place(self, payload_id: int, keys: tuple[bytes, ...]) -> None:
+        payload = self.payloads[payload_id]
+        for band, bucket in enumerate(keys):
+            representatives = self._representatives(band, bucket)
+            for rep in representatives:
+                if self.find(self.clusters[payload_id]) == self.find(
+                    self.clusters[rep]
+                ):
+                    break
+                if Levenshtein.ratio(payload, self.payloads[rep]) >= MIN_SIMILARITY:
+                    self.union(self.clusters[payload_id], self.clusters[rep])
+                    break
+            else:
+                if len(representatives) < MAX_REPRESENTATIVES:
+                    representatives.append(payload_id)
+                    self.connection.execute(
+                        "INSERT INTO clusterBuckets (band, bucket, payloadID) VALUES (?, ?, ?)",
+                        (band, bucket, payload_id),
+                    )
+
+    def _batch(self, rows: list[tuple[int, bytes]], pool: mp.Pool) -> None:
+        # Identical payloads (e.g. keep-alives) are signed and clustered once.
+        known: dict[bytes, int] = {}
+        new: list[tuple[int, bytes]] = []
+        labels: list[tuple[int, int]] = []
+        for packet_id, frame in rows:
+            segment = parse_frame(frame)
+            if segment is None or not segment.payload:
+                continue
+            digest = blake2b(segment.payload, digest_size=16).digest()
+            payload_id = known.get(digest)
+            if payload_id is None:
+                row = self.connection.execute(
+                    "SELECT id, clusterID FROM clusterPayloads WHERE blake2b = ?",
+                    (digest,),
+                ).fetchone()
+                if row is None:
+                    new.append((packet_id, segment.payload))
+                    payload_id = -len(new)  # Placeholder until the row is inserted
+                else:
+                    payload_id, self.clusters[payload_id] = row
+                known[digest] = payload_id
+            labels.append((payload_id, packet_id))
+
+        signed = pool.map(
+            _signatures,
+            [
+                [payload for _, payload in new[ii : ii + self.chunksize]]
+                for ii in range(0, len(new), self.chunksize)
+            ],
+        )
+        ids = {}
+        for placeholder, ((packet_id, payload), (signature, keys)) in enumerate(
+            zip(new, (s for chunk in signed for s in chunk)), start=1
+        ):
+            payload_id = self.connection.execute(
+                "INSERT INTO clusterPayloads (blake2b, packetID, clusterID, signature) VALUES (?, ?, ?, ?)",
+                (
+                    blake2b(payload, digest_size=16).digest(),
+                    packet_id,
+                    packet_id,
+                    signature,
+                ),
+            ).lastrowid
+            ids[-placeholder] = payload_id
+            self.payloads[payload_id] = payload
+            self.clusters[payload_id] = packet_id
+            self._place(payload_id, keys)
+        self.payloads_added += len(new)
+
+        self.connection.executemany(
+            "UPDATE packets SET clusterID = ? WHERE id = ?",
+            (
+                (self.find(self.clusters[ids.get(payload_id, payload_id)]), packet_id)
+                for payload_id, packet_id in labels
+            ),
+        )
+        self.connection.executemany(
+            "UPDATE clusterPayloads SET clusterID = ? WHERE id = ?",
+            ((self.find(self.clusters[ii]), ii) for ii in ids.values()),
+        )
+        # A new payload can bridge clusters stored by earlier batches: rename the merged ones.
+        fresh = {packet_id for packet_id, _ in new}
+        for cluster_id in list(self.parent):
+            root = self.find(cluster_id)
+            if root == cluster_id or cluster_id in fresh:
+                continue
+            for table in ("clusterPayloads", "packets"):
+                self.connection.execute(
+                    f"UPDATE {table} SET clusterID = ? WHERE clusterID = ?",
+                    (root, cluster_id),
+                )
+            self.merges += 1
+        self.payloads.clear()
+        self.clusters.clear()
+        self.buckets.clear()
+        self.parent.clear()
+
+    def run(self, batch_size: int = 10000) -> int:
+        """Clusters every packet newer than the stored checkpoint. Returns the number of packets read."""
+        row = self.connection.execute(
+            "SELECT lastPacketID FROM clusteringState WHERE id = 0"
+        ).fetchone()
+        last_packet_id = 0 if row is None else row[0]
+        (total,) = self.connection.execute(
+            "SELECT COUNT(*) FROM packets WHERE id > ?", (last_packet_id,)
+        ).fetchone()
+        count = 0
+        with mp.Pool() as pool, tqdm(total=total) as progress:
+            while True:
+                rows = self.connection.execute(
+                    "SELECT id, packet FROM packets WHERE id > ? ORDER BY id ASC LIMIT ?",
+                    (last_packet_id, batch_size),
+                ).fetchall()
+                if not rows:
+                    return count
+                self._batch(rows, pool)
+                last_packet_id = rows[-1][0]
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO clusteringState (id, lastPacketID) VALUES (0, ?)",
+                    (last_packet_id,),
+                )
+                self.connection.commit()
+                count += len(rows)
+                progress.update(len(rows))
+
+
+def main() -> None:
+    with sqlite3.connect(FilePath.database, timeout=10) as con:
+        setup(con)
+        clusterer = Clusterer(con)
+        count = clusterer.run()
+    Log.log(
+        sender,
+        f"Clustered {count} packets (+{clusterer.payloads_added} distinct payloads, "
+        f"{clusterer.merges} clusters merged).",
+    )
+
+
+if __name__ == "__main__":
+    main()
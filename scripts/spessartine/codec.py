@@ -0,0 +1,384 @@
+# codec.py
+
+import io
+import lzma
+import zlib
+import random
+import sqlite3
+from collections import Counter
+from hashlib import blake2b
+from time import perf_counter_ns
+import tracemalloc
+from typing import BinaryIO, Iterable
+
+# Rows written before codecs existed have a NULL codec column; they are XZ.
+LEGACY_CODEC_ID = "xz"
+
+# zlib only looks back 32 KiB, so a larger preset dictionary is wasted.
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+# Compressed bytes read from the underlying file per step when decompressing a stream.
+_read_size = 1024 * 1024
+
+# Dictionaries already loaded from the database, keyed by their blake2b hex digest.
+_dictionaries: dict[str, bytes] = {}
+
+
+class Codec(object):
+    """Base class for a reversible bytes -> bytes transform. ``codec_id`` is stored next to each blob."""
+
+    codec_id: str = ""
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def open(self, fd: BinaryIO) -> BinaryIO:
+        """Returns a readable stream of the decompressed content of ``fd``, such as an incremental blob. Codecs that
+        can decompress incrementally read ``fd`` piece by piece; the stream never closes ``fd``.
+        """
+        return io.BytesIO(self.decompress(fd.read()))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.codec_id!r})"
+
+
+class _Inflating(io.RawIOBase):
+    def __init__(self, fd: BinaryIO, decompressor):
+        self._fd, self._decompressor = fd, decompressor
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._decompressor.eof:
+            data = self._decompressor.unconsumed_tail or self._fd.read(_read_size)
+            if not data:
+                raise EOFError("Compressed data ended before the end-of-stream marker.")
+            out = self._decompressor.decompress(data, len(b))
+            if out:
+                b[: len(out)] = out
+                return len(out)
+        return 0
+
+
+class Raw(Codec):
+    codec_id = "raw"
+
+    def compress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+
+class XZ(Codec):
+    """The original ``spessartine.pack`` format: XZ container, SHA-256 check, extreme preset."""
+
+    codec_id = "xz"
+
+    def __init__(self, preset: int = 6, extreme: bool = True):
+        assert isinstance(preset, int)
+        assert 9 >= preset >= 0
+        assert lzma.is_check_supported(lzma.CHECK_SHA256)
+        self.preset = preset | lzma.PRESET_EXTREME if extreme else preset
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(
+            data,
+            format=lzma.FORMAT_XZ,
+            check=lzma.CHECK_SHA256,
+            preset=self.preset,
+        )
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+    def open(self, fd: BinaryIO) -> BinaryIO:
+        return lzma.LZMAFile(fd, format=lzma.FORMAT_XZ)
+
+    def __repr__(self):
+        return f"XZ(preset={self.preset:#x})"
+
+
+class Zlib(Codec):
+    """Raw deflate at a fixed level. Levels 1-3 trade ratio for a large gain in throughput."""
+
+    codec_id = "zlib"
+
+    def __init__(self, level: int = 1):
+        assert isinstance(level, int)
+        assert 9 >= level >= 0
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        c = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+
+    def _decompressor(self):
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, data: bytes) -> bytes:
+        d = self._decompressor()
+        return d.decompress(data) + d.flush()
+
+    def open(self, fd: BinaryIO) -> BinaryIO:
+        return io.BufferedReader(_Inflating(fd, self._decompressor()))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.codec_id!r}, level={self.level})"
+
+
+class ZlibDict(Zlib):
+    """Raw deflate primed with a preset dictionary trained on stored packets.
+
+    The dictionary itself lives in the ``dictionaries`` table; the codec id names it by hash.
+    """
+
+    def __init__(self, dictionary: bytes, level: int = 1):
+        assert isinstance(dictionary, bytes)
+        assert 0 < len(dictionary) <= MAX_DICTIONARY_SIZE
+        super().__init__(level)
+        self.dictionary = dictionary
+        self.codec_id = "zdict:" + dictionary_hash(dictionary)
+
+    def compress(self, data: bytes) -> bytes:
+        c = zlib.compressobj(
+            self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self.dictionary
+        )
+        return c.compress(data) + c.flush()
+
+    def _decompressor(self):
+        return zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.dictionary)
+
+
+def dictionary_hash(dictionary: bytes) -> str:
+    return blake2b(dictionary, digest_size=16).hexdigest()
+
+
+def setup(connection: sqlite3.Connection) -> None:
+    """Creates the ``dictionaries`` and ``captureBuffers`` tables and adds a ``codec`` column to ``capture`` if it is
+    missing.
+
+    ``captureBuffers.blake2b`` keys a buffer kept in ``storage``'s blobs; rows written before that hold the buffer
+    inline and have no key."""
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS dictionaries
+        (
+            id INTEGER UNIQUE NOT NULL PRIMARY KEY ASC,
+            dictionary BLOB NOT NULL ON CONFLICT ABORT,
+            blake2b STRING UNIQUE NOT NULL ON CONFLICT ABORT
+        );
+    """
+    )
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS captureBuffers
+        (
+            captureID INTEGER NOT NULL ON CONFLICT ABORT REFERENCES capture (id),
+            idx INTEGER NOT NULL ON CONFLICT ABORT,
+            codec STRING NOT NULL ON CONFLICT ABORT,
+            buffer BLOB NOT NULL ON CONFLICT ABORT,
+            blake2b STRING REFERENCES blobs (blake2b),
+            PRIMARY KEY (captureID, idx)
+        );
+    """
+    )
+    columns = {
+        row[1] for row in connection.execute("PRAGMA table_info(captureBuffers)")
+    }
+    if "blake2b" not in columns:
+        connection.execute(
+            "ALTER TABLE captureBuffers ADD COLUMN blake2b STRING REFERENCES blobs (blake2b)"
+        )
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(capture)")}
+    if columns and "codec" not in columns:
+        connection.execute("ALTER TABLE capture ADD COLUMN codec STRING")
+    connection.commit()
+
+
+def store_dictionary(connection: sqlite3.Connection, dictionary: bytes) -> ZlibDict:
+    codec = ZlibDict(dictionary)
+    connection.execute(
+        "INSERT OR IGNORE INTO dictionaries (dictionary, blake2b) VALUES (?, ?)",
+        (dictionary, dictionary_hash(dictionary)),
+    )
+    connection.commit()
+    _dictionaries[dictionary_hash(dictionary)] = dictionary
+    return codec
+
+
+def get(codec_id: str | None, connection: sqlite3.Connection | None = None) -> Codec:
+    """Returns a ``Codec`` able to decompress blobs tagged with ``codec_id``.
+
+    ``connection`` is only needed the first time a given dictionary codec is resolved.
+
+    :raises KeyError: if ``codec_id`` is unknown or its dictionary is not stored.
+    """
+    if codec_id is None:
+        codec_id = LEGACY_CODEC_ID
+
+    if codec_id == XZ.codec_id:
+        return XZ()
+    elif codec_id == Raw.codec_id:
+        return Raw()
+    elif codec_id == Zlib.codec_id:
+        return Zlib()
+    elif codec_id.startswith("zdict:"):
+        digest = codec_id.partition(":")[-1]
+        if digest not in _dictionaries:
+            if connection is None:
+                raise KeyError(f"{codec_id} requires a database connection.")
+            row = connection.execute(
+                "SELECT dictionary FROM dictionaries WHERE blake2b = ?", (digest,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(f"No stored dictionary for {codec_id}.")
+            _dictionaries[digest] = row[0]
+        return ZlibDict(_dictionaries[digest])
+    raise KeyError(f"Unknown codec {codec_id}.")
+
+
+def train_dictionary(
+    samples: Iterable[bytes], size: int = MAX_DICTIONARY_SIZE, segment_size: int = 8
+) -> bytes:
+    """Builds a zlib preset dictionary out of the byte segments that recur most across ``samples``.
+
+    Segments are scored by how many samples contain them, then packed most-common-last so that the most
+    useful matches sit at the shortest back-reference distance."""
+    assert 0 < size <= MAX_DICTIONARY_SIZE
+    assert segment_size > 0
+
+    counts = Counter()
+    for sample in samples:
+        seen = {
+            sample[ii : ii + segment_size]
+            for ii in range(0, len(sample) - segment_size + 1)
+        }
+        counts.update(seen)
+
+    chosen, total = [], 0
+    for segment, count in counts.most_common():
+        if count < 2 or total + segment_size > size:
+            break
+        chosen.append(segment)
+        total += segment_size
+
+    return b"".join(reversed(chosen))
+
+
+def benchmark(corpus: list[bytes], codecs: list[Codec]) -> list[dict[str, str | float]]:
+    """Compresses every element of ``corpus`` independently with each codec.
+
+    Returns one row per codec with the compression ratio and MB/s in each direction."""
+    size_in = sum(len(blob) for blob in corpus)
+    assert size_in > 0
+    results = []
+    for codec in codecs:
+        t = perf_counter_ns()
+        compressed = [codec.compress(blob) for blob in corpus]
+        dt_compress = perf_counter_ns() - t
+
+        t = perf_counter_ns()
+        for blob, original in zip(compressed, corpus):
+            assert codec.decompress(blob) == original
+        dt_decompress = perf_counter_ns() - t
+
+        size_out = sum(len(blob) for blob in compressed)
+        results.append(
+            {
+                "codec": repr(codec),
+                "ratio": size_in / size_out,
+                "compress_mb_s": size_in / max(dt_compress, 1) * 10**3,
+                "decompress_mb_s": size_in / max(dt_decompress, 1) * 10**3,
+            }
+        )
+    return results
+
+
+def main(sample_size: int = 1000, corpus_size: int = 10000) -> None:
+    import spessartine
+
+    with sqlite3.connect(spessartine.FilePath.database) as con:
+        packets = [
+            row[0]
+            for row in con.execute(
+                "SELECT packet FROM packets ORDER BY id DESC LIMIT ?",
+                (sample_size + corpus_size,),
+            )
+        ]
+    assert len(packets) > 0, "The packets table is empty."
+
+    random.shuffle(packets)
+    training, corpus = packets[:sample_size], packets[sample_size:] or packets
+    dictionary = train_dictionary(training)
+    print(
+        f"Trained a {len(dictionary)} byte dictionary on {len(training)} packets, "
+        f"benchmarking on {len(corpus)} packets."
+    )
+
+    codecs = [XZ(6), XZ(0, extreme=False), Zlib(1), Zlib(6)]
+    if dictionary:
+        codecs += [ZlibDict(dictionary, 1), ZlibDict(dictionary, 6)]
+
+    print(f"{'codec':<48} {'ratio':>8} {'comp MB/s':>10} {'decomp MB/s':>12}")
+    for row in benchmark(corpus, codecs):
+        print(
+            f"{row['codec']:<48} {row['ratio']:>8.3f} "
+            f"{row['compress_mb_s']:>10.1f} {row['decompress_mb_s']:>12.1f}"
+        )
+
+
+def measure_oob(size_mb: int = 256, chunks: int = 8) -> list[dict[str, str | float]]:
+    """Packs and unpacks a ``size_mb`` MiB object made of ``chunks`` large buffers, in band and out of band.
+
+    Returns the wall time and ``tracemalloc`` peak of each round trip."""
+    import numpy as np
+    import spessartine
+
+    chunk = np.frombuffer(random.randbytes(size_mb * 1024 * 1024 // chunks), np.uint8)
+    obj = {"frames": [chunk.copy() for _ in range(chunks)], "meta": "synthetic"}
+    del chunk
+
+    def _measure(name, fn):
+        tracemalloc.start()
+        t = perf_counter_ns()
+        ret = fn()
+        dt = perf_counter_ns() - t
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append(
+            {"step": name, "seconds": dt / 10**9, "peak_mb": peak / 1024 / 1024}
+        )
+        return ret
+
+    results = []
+    for name, c in (("raw", Raw()), ("zlib1", Zlib(1))):
+        blob, _ = _measure(f"pack/{name}", lambda: spessartine.pack(obj, codec=c))
+        _measure(f"unpack/{name}", lambda: spessartine.unpack(blob, codec=c))
+        del blob
+        blob, buffers, _ = _measure(
+            f"pack_oob/{name}",
+            lambda: spessartine.pack_oob(obj, codec=Raw(), buffer_codec=c),
+        )
+        _measure(
+            f"unpack_oob/{name}",
+            lambda: spessartine.unpack_oob(blob, buffers, codec=Raw(), buffer_codec=c),
+        )
+        del blob, buffers
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ["oob"]:
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+        print(f"{'step':<20} {'seconds':>8} {'peak MiB':>10}")
+        for row in measure_oob(size):
+            print(f"{row['step']:<20} {row['seconds']:>8.3f} {row['peak_mb']:>10.1f}")
+    else:
+        main()
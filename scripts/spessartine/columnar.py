@@ -0,0 +1,198 @@
+# columnar.py
+
+import datetime
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from spessartine import FilePath, Log
+
+sender: str = __file__.rpartition("/")[-1].strip()
+
+# Fixed-width columns, one element per exported packet. Packets outside a client <-> server TCP flow have -1 as
+# flow id and direction.
+COLUMNS: dict[str, np.dtype] = {
+    "id": np.dtype(np.int64),
+    "timestamp": np.dtype(np.float64),
+    "size": np.dtype(np.int32),
+    "direction": np.dtype(np.int8),
+    "flow_id": np.dtype(np.int64),
+}
+
+# Raw frames are concatenated into one arena; packet i is payload[offsets[i]:offsets[i + 1]].
+PAYLOAD, OFFSETS = "payload", "offsets"
+
+_MANIFEST = "manifest.json"
+
+
+class Columns(object):
+    """Read-only, memory-mapped view of an exported corpus."""
+
+    def __init__(self, root=FilePath.columns):
+        self.root = root
+        with open(self.root / _MANIFEST, "r") as fd:
+            self.manifest = json.load(fd)
+        self.length: int = self.manifest["rows"]
+        self._arrays: dict[str, np.ndarray] = {}
+
+    def _map(self, name: str, dtype: np.dtype, length: int) -> np.ndarray:
+        try:
+            return self._arrays[name]
+        except KeyError:
+            if length == 0:
+                arr = np.empty(0, dtype=dtype)
+            else:
+                arr = np.memmap(
+                    self.root / f"{name}.bin", dtype=dtype, mode="r", shape=(length,)
+                )
+            self._arrays[name] = arr
+            return arr
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name in COLUMNS:
+            return self._map(name, COLUMNS[name], self.length)
+        elif name == OFFSETS:
+            return self._map(OFFSETS, np.dtype(np.int64), self.length + 1)
+        elif name == PAYLOAD:
+            return self._map(PAYLOAD, np.dtype(np.uint8), self.manifest["payloadBytes"])
+        raise KeyError(name)
+
+    def __len__(self):
+        return self.length
+
+    def payload(self, index: int) -> np.ndarray:
+        offsets = self[OFFSETS]
+        return self[PAYLOAD][offsets[index] : offsets[index + 1]]
+
+    def size_histogram(self, bins: int = 64) -> tuple[np.ndarray, np.ndarray]:
+        return np.histogram(self["size"], bins=bins)
+
+    def inter_arrival(self, flow_id: int | None = None) -> np.ndarray:
+        ts = self["timestamp"]
+        if flow_id is not None:
+            ts = ts[self["flow_id"] == flow_id]
+        return np.diff(ts)
+
+    def byte_position_counts(self, max_offset: int = 64) -> np.ndarray:
+        """Returns a ``(max_offset, 256)`` matrix counting each byte value at each frame offset."""
+        offsets, payload = self[OFFSETS], self[PAYLOAD]
+        lengths = np.diff(offsets)
+        counts = np.zeros((max_offset, 256), dtype=np.int64)
+        for position in range(max_offset):
+            present = lengths > position
+            values = payload[offsets[:-1][present] + position]
+            counts[position] = np.bincount(values, minlength=256)
+        return counts
+
+
+def _parse_timestamp(iso8601: str) -> float:
+    return datetime.datetime.fromisoformat(iso8601).timestamp()
+
+
+def export(
+    connection: sqlite3.Connection,
+    root=FilePath.columns,
+    batch_size: int = 10000,
+) -> int:
+    """Appends every packet not yet exported to the columnar files under ``root``. Returns the rows added.
+
+    Export stops at the reassembly checkpoint so that flow ids are never left unset.
+    """
+    os.makedirs(root, exist_ok=True)
+    try:
+        with open(root / _MANIFEST, "r") as fd:
+            manifest = json.load(fd)
+    except FileNotFoundError:
+        manifest = {"rows": 0, "payloadBytes": 0, "lastPacketID": 0}
+
+    # Discard anything written after the last manifest (e.g. an interrupted export).
+    rows, payload_bytes = manifest["rows"], manifest["payloadBytes"]
+    for name, dtype in COLUMNS.items():
+        _truncate(root / f"{name}.bin", rows * dtype.itemsize)
+    _truncate(root / f"{PAYLOAD}.bin", payload_bytes)
+    _truncate(root / f"{OFFSETS}.bin", (rows + 1) * 8 if rows else 0)
+    if rows == 0:
+        with open(root / f"{OFFSETS}.bin", "wb") as fd:
+            fd.write(np.zeros(1, dtype=np.int64).tobytes())
+
+    # Export is append-only, so a packet is exported only once reassembly has labelled it; before the first
+    # reassembly run nothing is.
+    upper = manifest["lastPacketID"]
+    if connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reassemblyState'"
+    ).fetchone():
+        row = connection.execute(
+            "SELECT lastPacketID FROM reassemblyState WHERE id = 0"
+        ).fetchone()
+        if row is not None:
+            upper = max(upper, row[0])
+    query = """
+        SELECT id, iso8601, sizeBytes, direction, flowID, packet FROM packets
+        WHERE id > ? AND id <= ? ORDER BY id ASC
+    """
+
+    added = 0
+    files = {
+        name: open(root / f"{name}.bin", "ab") for name in (*COLUMNS, PAYLOAD, OFFSETS)
+    }
+    try:
+        cur = None
+        if upper > manifest["lastPacketID"]:
+            cur = connection.execute(query, (manifest["lastPacketID"], upper))
+        while cur is not None and (batch := cur.fetchmany(batch_size)):
+            ids, timestamps, sizes, directions, flow_ids, frames = zip(*batch)
+            lengths = np.fromiter(map(len, frames), dtype=np.int64, count=len(frames))
+            files["id"].write(np.array(ids, dtype=np.int64).tobytes())
+            files["timestamp"].write(
+                np.fromiter(
+                    map(_parse_timestamp, timestamps), dtype=np.float64
+                ).tobytes()
+            )
+            files["size"].write(np.array(sizes, dtype=np.int32).tobytes())
+            files["direction"].write(
+                np.array(
+                    [-1 if d is None else d for d in directions], dtype=np.int8
+                ).tobytes()
+            )
+            files["flow_id"].write(
+                np.array(
+                    [-1 if f is None else f for f in flow_ids], dtype=np.int64
+                ).tobytes()
+            )
+            files[PAYLOAD].write(b"".join(frames))
+            files[OFFSETS].write((payload_bytes + np.cumsum(lengths)).tobytes())
+
+            rows += len(batch)
+            payload_bytes += int(lengths.sum())
+            added += len(batch)
+            manifest["lastPacketID"] = ids[-1]
+    finally:
+        for fd in files.values():
+            fd.close()
+
+    manifest["rows"], manifest["payloadBytes"] = rows, payload_bytes
+    with open(root / (_MANIFEST + ".tmp"), "w") as fd:
+        json.dump(manifest, fd)
+    os.replace(root / (_MANIFEST + ".tmp"), root / _MANIFEST)
+    return added
+
+
+def _truncate(path, size: int) -> None:
+    try:
+        with open(path, "r+b") as fd:
+            fd.truncate(size)
+    except FileNotFoundError:
+        pass
+
+
+def main() -> None:
+    with sqlite3.connect(FilePath.database, timeout=10) as con:
+        added = export(con)
+    columns = Columns()
+    Log.log(sender, f"Exported +{added} packets ({len(columns)} total).")
+
+
+if __name__ == "__main__":
+    main()
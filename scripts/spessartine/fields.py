@@ -0,0 +1,353 @@
+# fields.py
+
+import multiprocessing as mp
+import sqlite3
+from typing import NamedTuple
+
+import numpy as np
+
+from reassembly import parse_frame
+from spessartine import FilePath, Log, Time
+
+sender: str = __file__.rpartition("/")[-1].strip()
+
+# Payloads of one message type are aligned at offset 0 and cut to MAX_OFFSET bytes. Types with fewer than MIN_MESSAGES
+# payloads are skipped, and at most MAX_MESSAGES (the earliest) are used.
+MAX_OFFSET = 256
+MIN_MESSAGES = 8
+MAX_MESSAGES = 8192
+
+# Integer widths tried for counters and length fields, each in both byte orders.
+WIDTHS = (1, 2, 4)
+# A counter advances by 1..COUNTER_MAX_STEP (mod 2 ** bits) between consecutive messages at least this often.
+COUNTER_MAX_STEP = 16
+COUNTER_FRACTION = 0.9
+# A length field equals the payload length minus a fixed header size at least this often.
+LENGTH_FRACTION = 0.95
+
+# A boundary is proposed where the byte entropy changes by at least ENTROPY_STEP bits, unless the two bytes are
+# correlated at least MERGE_CORRELATION (they then likely belong to one multi-byte value).
+ENTROPY_STEP = 1.5
+MERGE_CORRELATION = 0.5
+
+
+class Profile(NamedTuple):
+    """Per-offset statistics of one message type, each an array of length ``min(max length, MAX_OFFSET)``."""
+
+    coverage: np.ndarray  # fraction of payloads long enough to have this offset
+    entropy: np.ndarray  # bits per byte, over the payloads that have it
+    min_value: np.ndarray
+    max_value: np.ndarray
+    distinct: np.ndarray
+    # Pearson correlation with the next offset; 0 where undefined
+    correlation: np.ndarray
+
+
+class Field(NamedTuple):
+    offset: int
+    width: int
+    kind: str  # "constant", "counter", "length" or "variable"
+    encoding: str | None  # e.g. "u16be" for counters and lengths
+    score: float  # fraction of messages that agree with ``kind``
+
+
+def align(payloads: list[bytes]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns ``(matrix, mask, lengths)``: payloads as rows of a zero-padded ``(N, L)`` uint8 matrix, which cells
+    hold real bytes, and the full payload lengths."""
+    lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=len(payloads))
+    width = int(min(lengths.max(initial=0), MAX_OFFSET))
+    matrix = np.zeros((len(payloads), width), dtype=np.uint8)
+    flat = np.frombuffer(b"".join(p[:width] for p in payloads), dtype=np.uint8)
+    mask = np.arange(width)[None, :] < np.minimum(lengths, width)[:, None]
+    matrix[mask] = flat  # Row-major boolean assignment fills each row's prefix in order
+    return matrix, mask, lengths
+
+
+def profile(matrix: np.ndarray, mask: np.ndarray) -> Profile:
+    n, width = matrix.shape
+    present = mask.sum(axis=0)
+    coverage = present / max(n, 1)
+
+    # One bincount over (offset, value) pairs gives the byte histogram of every offset at once
+    keys = (np.arange(width)[None, :] * 256 + matrix)[mask]
+    counts = np.bincount(keys, minlength=width * 256).reshape(width, 256)
+    p = counts / np.maximum(present, 1)[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = np.abs(-np.where(counts > 0, p * np.log2(p), 0).sum(axis=1))
+
+    min_value = np.where(mask, matrix, 255).min(axis=0, initial=255)
+    max_value = np.where(mask, matrix, 0).max(axis=0, initial=0)
+    distinct = (counts > 0).sum(axis=1)
+
+    # Adjacent-offset correlation over the payloads that have both bytes
+    x, y = matrix[:, :-1].astype(np.float64), matrix[:, 1:].astype(np.float64)
+    both = mask[:, 1:]  # Masks are prefixes, so offset j + 1 present implies j present
+    m = np.maximum(both.sum(axis=0), 1)
+    mx, my = (x * both).sum(axis=0) / m, (y * both).sum(axis=0) / m
+    dx, dy = (x - mx) * both, (y - my) * both
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = (dx * dy).sum(axis=0) / np.sqrt((dx**2).sum(axis=0) * (dy**2).sum(axis=0))
+    correlation = np.append(np.nan_to_num(r), 0.0)
+
+    return Profile(coverage, entropy, min_value, max_value, distinct, correlation)
+
+
+def _integers(matrix: np.ndarray, width: int, order: str) -> np.ndarray:
+    # (N, L - width + 1) int64: the unsigned integer starting at each offset
+    ret = np.zeros((len(matrix), matrix.shape[1] - width + 1), dtype=np.int64)
+    for k in range(width):
+        shift = 8 * (width - 1 - k if order == "be" else k)
+        ret |= matrix[:, k : k + ret.shape[1]].astype(np.int64) << shift
+    return ret
+
+
+def integer_fields(
+    matrix: np.ndarray, mask: np.ndarray, lengths: np.ndarray, distinct: np.ndarray
+) -> list[Field]:
+    """Finds counters and length fields among the fixed-width integers at every offset, one width and byte order at
+    a time. Messages are taken in capture order; ``distinct`` is ``Profile.distinct``.
+    """
+    ret = []
+    for width in WIDTHS:
+        if matrix.shape[1] < width:
+            break
+        valid = mask[:, width - 1 :]
+        for order in ("be", "le") if width > 1 else ("be",):
+            values = _integers(matrix, width, order)
+            encoding = f"u{8 * width}{order if width > 1 else ''}"
+
+            pairs = valid[1:] & valid[:-1]
+            step = (values[1:] - values[:-1]) % (1 << (8 * width))
+            advancing = ((step > 0) & (step <= COUNTER_MAX_STEP) & pairs).sum(axis=0)
+            counter = advancing / np.maximum(pairs.sum(axis=0), 1)
+
+            # Payload length minus the value; a length field makes it the same for (nearly) every message
+            header = np.ma.array(lengths[:, None] - values, mask=~valid)
+            typical = np.ma.median(header, axis=0).filled(-1)
+            length = ((header == typical).filled(False)).sum(axis=0) / np.maximum(
+                valid.sum(axis=0), 1
+            )
+            varies = (
+                np.ma.array(
+                    np.broadcast_to(lengths[:, None], values.shape), mask=~valid
+                )
+                .ptp(axis=0)
+                .filled(0)
+                > 0
+            )
+
+            for offset in np.flatnonzero(
+                (counter >= COUNTER_FRACTION) & (pairs.sum(axis=0) >= MIN_MESSAGES)
+            ):
+                ret.append(
+                    Field(
+                        int(offset), width, "counter", encoding, float(counter[offset])
+                    )
+                )
+            for offset in np.flatnonzero(
+                (length >= LENGTH_FRACTION)
+                & varies
+                & (valid.sum(axis=0) >= MIN_MESSAGES)
+            ):
+                ret.append(
+                    Field(int(offset), width, "length", encoding, float(length[offset]))
+                )
+
+    # Keep non-overlapping candidates, preferring those whose most significant byte varies, then the widest: a u16
+    # counter also passes as a u8 counter on its low byte, and as a u32 counter together with two constant bytes
+    def msb_varies(f: Field) -> bool:
+        msb = f.offset if f.encoding.endswith("be") else f.offset + f.width - 1
+        return bool(distinct[msb] > 1)
+
+    ret.sort(key=lambda f: (not msb_varies(f), -f.width, -f.score, f.offset))
+    taken = np.zeros(matrix.shape[1], dtype=bool)
+    kept = []
+    for field in ret:
+        if not taken[field.offset : field.offset + field.width].any():
+            taken[field.offset : field.offset + field.width] = True
+            kept.append(field)
+    return sorted(kept)
+
+
+def boundaries(prof: Profile) -> np.ndarray:
+    """Offsets where a new field likely starts: where a constant run starts or ends, or where the entropy jumps
+    between two bytes that do not move together."""
+    if len(prof.entropy) == 0:
+        return np.zeros(0, dtype=np.int64)
+    constant = prof.distinct <= 1
+    jump = np.abs(np.diff(prof.entropy)) >= ENTROPY_STEP
+    together = np.abs(prof.correlation[:-1]) >= MERGE_CORRELATION
+    starts = (constant[1:] != constant[:-1]) | (jump & ~together)
+    return np.concatenate([[0], np.flatnonzero(starts) + 1])
+
+
+def infer_fields(payloads: list[bytes]) -> tuple[Profile, list[Field]]:
+    """Aligns the payloads of one message type and proposes its fields, in offset order, covering every offset."""
+    matrix, mask, lengths = align(payloads)
+    prof = profile(matrix, mask)
+    integers = integer_fields(matrix, mask, lengths, prof.distinct)
+
+    # Counter and length fields are fields in their own right; the remaining ranges are split at the boundaries
+    taken = np.zeros(matrix.shape[1], dtype=bool)
+    for field in integers:
+        taken[field.offset : field.offset + field.width] = True
+    starts = set(boundaries(prof).tolist())
+    for field in integers:
+        starts.update((field.offset, field.offset + field.width))
+    starts = sorted(s for s in starts if s < matrix.shape[1])
+
+    fields = list(integers)
+    for start, end in zip(starts, starts[1:] + [matrix.shape[1]]):
+        if taken[start]:
+            continue
+        if bool((prof.distinct[start:end] <= 1).all()):
+            fields.append(Field(start, end - start, "constant", None, 1.0))
+        else:
+            coverage = float(prof.coverage[start:end].min())
+            fields.append(Field(start, end - start, "variable", None, coverage))
+    return prof, sorted(fields)
+
+
+def _infer(item: tuple[int, list[bytes]]) -> tuple[int, int, Profile, list[Field]]:
+    # Runs in a worker
+    cluster_id, payloads = item
+    return cluster_id, len(payloads), *infer_fields(payloads)
+
+
+def setup(connection: sqlite3.Connection) -> None:
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fieldProfiles
+        (
+            clusterID INTEGER PRIMARY KEY,
+            messages INTEGER NOT NULL ON CONFLICT ABORT,
+            iso8601 STRING NOT NULL ON CONFLICT ABORT
+        );
+        """
+    )
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fieldOffsets
+        (
+            clusterID INTEGER NOT NULL ON CONFLICT ABORT REFERENCES fieldProfiles (clusterID),
+            offset INTEGER NOT NULL ON CONFLICT ABORT,
+            coverage REAL NOT NULL ON CONFLICT ABORT,
+            entropy REAL NOT NULL ON CONFLICT ABORT,
+            minValue INTEGER NOT NULL ON CONFLICT ABORT,
+            maxValue INTEGER NOT NULL ON CONFLICT ABORT,
+            distinctValues INTEGER NOT NULL ON CONFLICT ABORT,
+            correlation REAL NOT NULL ON CONFLICT ABORT,
+            PRIMARY KEY (clusterID, offset)
+        );
+        """
+    )
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fields
+        (
+            clusterID INTEGER NOT NULL ON CONFLICT ABORT REFERENCES fieldProfiles (clusterID),
+            offset INTEGER NOT NULL ON CONFLICT ABORT,
+            width INTEGER NOT NULL ON CONFLICT ABORT,
+            kind STRING NOT NULL ON CONFLICT ABORT,
+            encoding STRING,
+            score REAL NOT NULL ON CONFLICT ABORT,
+            PRIMARY KEY (clusterID, offset)
+        );
+        """
+    )
+    connection.commit()
+
+
+def store(
+    connection: sqlite3.Connection,
+    cluster_id: int,
+    messages: int,
+    prof: Profile,
+    fields: list[Field],
+) -> None:
+    """Replaces the stored analysis of one message type. Does not commit."""
+    for table in ("fields", "fieldOffsets", "fieldProfiles"):
+        connection.execute(f"DELETE FROM {table} WHERE clusterID = ?", (cluster_id,))
+    connection.execute(
+        "INSERT INTO fieldProfiles (clusterID, messages, iso8601) VALUES (?, ?, ?)",
+        (cluster_id, messages, Time.now()),
+    )
+    connection.executemany(
+        """
+        INSERT INTO fieldOffsets
+            (clusterID, offset, coverage, entropy, minValue, maxValue, distinctValues, correlation)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            (cluster_id, offset, *row)
+            for offset, row in enumerate(
+                zip(
+                    prof.coverage.tolist(),
+                    prof.entropy.tolist(),
+                    prof.min_value.tolist(),
+                    prof.max_value.tolist(),
+                    prof.distinct.tolist(),
+                    prof.correlation.tolist(),
+                )
+            )
+        ),
+    )
+    connection.executemany(
+        "INSERT INTO fields (clusterID, offset, width, kind, encoding, score) VALUES (?, ?, ?, ?, ?, ?)",
+        ((cluster_id, *field) for field in fields),
+    )
+
+
+def load_fields(connection: sqlite3.Connection, cluster_id: int) -> list[Field]:
+    return [
+        Field(*row)
+        for row in connection.execute(
+            "SELECT offset, width, kind, encoding, score FROM fields WHERE clusterID = ? ORDER BY offset ASC",
+            (cluster_id,),
+        )
+    ]
+
+
+def main(batch_size: int = 10000) -> None:
+    with sqlite3.connect(FilePath.database, timeout=10) as con:
+        setup(con)
+
+        payloads: dict[int, list[bytes]] = {}
+        cur = con.execute(
+            "SELECT clusterID, packet FROM packets WHERE clusterID IS NOT NULL ORDER BY id ASC"
+        )
+        while rows := cur.fetchmany(batch_size):
+            for cluster_id, frame in rows:
+                segment = parse_frame(frame)
+                if segment is None or not segment.payload:
+                    continue
+                messages = payloads.setdefault(cluster_id, [])
+                if len(messages) < MAX_MESSAGES:
+                    messages.append(segment.payload)
+
+        work = [(k, v) for k, v in payloads.items() if len(v) >= MIN_MESSAGES]
+        Log.log(
+            sender,
+            f"Inferring fields of {len(work)} message types "
+            f"({len(payloads) - len(work)} with fewer than {MIN_MESSAGES} messages skipped).",
+        )
+        # Largest types first, so one big type does not start last and hold up the pool
+        work.sort(key=lambda item: -len(item[1]))
+        kinds: dict[str, int] = {}
+        with mp.Pool() as pool:
+            for cluster_id, messages, prof, fields in pool.imap_unordered(_infer, work):
+                store(con, cluster_id, messages, prof, fields)
+                for field in fields:
+                    kinds[field.kind] = kinds.get(field.kind, 0) + 1
+        con.commit()
+
+    Log.log(
+        sender,
+        f"Proposed {sum(kinds.values())} fields: "
+        + ", ".join(f"{count} {kind}" for kind, count in sorted(kinds.items()))
+        + ".",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+# query.py
+
+import argparse
+import asyncio
+import datetime
+import json
+import sqlite3
+import sys
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+from spessartine import FilePath, Log, Time
+
+sys.path.append(str(Path(__file__).parent.parent))
+import storage
+
+sender: str = __file__.rpartition("/")[-1].strip()
+
+_host, _port = "127.0.0.1", 8643
+
+# Rows per page by default and at most, and rows fetched from sqlite per step while a page is streamed.
+DEFAULT_LIMIT, MAX_LIMIT = 100, 1000
+_fetch_size = 64
+
+# Pages of hot queries are kept for at most CACHE_SECONDS, which bounds how stale columns filled in later (clusterID,
+# flowID) can be. Pages that a new packet could change are also dropped as soon as one is added.
+CACHE_ENTRIES = 256
+CACHE_SECONDS = 30.0
+
+# Returned for every packet, when the column exists. The packet itself only with payload=1.
+_COLUMNS = ("id", "iso8601", "sizeBytes", "blake2b", "flowID", "direction", "clusterID")
+
+
+class Page(NamedTuple):
+    lines: list[bytes]  # one JSON document per row, newline terminated
+    next: str | None  # cursor of the following page
+
+
+def setup(connection: sqlite3.Connection) -> None:
+    """Creates the indexes the queries rely on. Needs a writable connection; the service itself only reads."""
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(packets)")}
+    connection.execute("CREATE INDEX IF NOT EXISTS packetsIso8601 ON packets (iso8601)")
+    connection.execute("CREATE INDEX IF NOT EXISTS packetsSize ON packets (sizeBytes)")
+    connection.execute("CREATE INDEX IF NOT EXISTS packetsBlake2b ON packets (blake2b)")
+    if "flowID" in columns:
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS packetsFlowID ON packets (flowID)"
+        )
+    if "clusterID" in columns:
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS packetsClusterID ON packets (clusterID)"
+        )
+    connection.commit()
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _int(params: dict[str, str], name: str, default: int | None = None) -> int:
+    try:
+        return int(params[name]) if name in params else default
+    except ValueError:
+        raise QueryError(f"{name} must be an integer.")
+
+
+def _time(params: dict[str, str], name: str) -> str:
+    # iso8601 holds str(datetime) in Time.timezone, so a bound is only comparable as text in that same form. Bounds
+    # without an offset are taken to be in Time.timezone already.
+    try:
+        when = datetime.datetime.fromisoformat(params[name])
+    except ValueError:
+        raise QueryError(f"{name} must be an ISO 8601 date and time.")
+    if when.tzinfo is None:
+        return str(when.replace(tzinfo=Time.timezone))
+    return str(when.astimezone(Time.timezone))
+
+
+def plan(
+    con: sqlite3.Connection, params: dict[str, str], columns: list[str]
+) -> tuple[str, tuple, str]:
+    """Turns query parameters into ``(sql, args, cursor key)``. Every query walks one index in key order, and the
+    cursor is the key of the last row sent, so each page starts with an index seek rather than an OFFSET scan.
+
+    ``by`` is one of ``time`` (``start``, ``end`` as ISO 8601, in ``Time.timezone`` unless they have an offset),
+    ``flow`` / ``cluster`` (``id``), ``size`` (``min``, ``max``) or ``hash`` (``blake2b``). ``after`` is the cursor
+    from the previous page.
+
+    :raises QueryError:
+    """
+    select = ", ".join(columns + (["packet"] if params.get("payload") == "1" else []))
+    after = params.get("after")
+    by = params.get("by")
+
+    if by == "size":
+        lo, hi = _int(params, "min", 0), _int(params, "max", 1 << 62)
+        try:
+            # The cursor is "sizeBytes:id"
+            size, last = map(int, after.split(":")) if after else (lo, -1)
+        except ValueError:
+            raise QueryError("after must be a cursor returned by the previous page.")
+        return (
+            f"""
+            SELECT {select} FROM packets
+            WHERE (sizeBytes, id) > (?, ?) AND sizeBytes <= ?
+            ORDER BY sizeBytes ASC, id ASC LIMIT ?
+            """,
+            (size, last, hi),
+            "size",
+        )
+
+    last = _int(params, "after", 0)
+    if by == "time":
+        if "start" not in params or "end" not in params:
+            raise QueryError("by=time needs start and end.")
+        start, end = _time(params, "start"), _time(params, "end")
+        # Packets are stored in capture order, so the time range is an id range found with two index seeks
+        lo = con.execute(
+            "SELECT id FROM packets WHERE iso8601 >= ? ORDER BY iso8601 ASC, id ASC LIMIT 1",
+            (start,),
+        ).fetchone()
+        hi = con.execute(
+            "SELECT id FROM packets WHERE iso8601 < ? ORDER BY iso8601 DESC, id DESC LIMIT 1",
+            (end,),
+        ).fetchone()
+        lo, hi = (lo[0], hi[0]) if lo and hi else (1, 0)
+        return (
+            f"SELECT {select} FROM packets WHERE id > ? AND id <= ? ORDER BY id ASC LIMIT ?",
+            (max(last, lo - 1), hi),
+            "id",
+        )
+    if by in ("flow", "cluster"):
+        column = f"{by}ID"
+        if column not in columns:
+            raise QueryError(f"The packets have no {column} yet.")
+        if "id" not in params:
+            raise QueryError(f"by={by} needs id.")
+        return (
+            f"SELECT {select} FROM packets WHERE {column} = ? AND id > ? ORDER BY id ASC LIMIT ?",
+            (_int(params, "id"), last),
+            "id",
+        )
+    if by == "hash":
+        if "blake2b" not in params:
+            raise QueryError("by=hash needs blake2b.")
+        return (
+            f"SELECT {select} FROM packets WHERE blake2b = ? AND id > ? ORDER BY id ASC LIMIT ?",
+            (params["blake2b"], last),
+            "id",
+        )
+    raise QueryError("by must be one of time, flow, cluster, size or hash.")
+
+
+def _encode(names: list[str], row: tuple) -> bytes:
+    return (
+        json.dumps(
+            {
+                name: value.hex() if isinstance(value, bytes) else value
+                for name, value in zip(names, row)
+            }
+        ).encode()
+        + b"\n"
+    )
+
+
+class Cache(object):
+    """Least recently used pages, each valid for ``seconds`` and, unless it is stable, only while ``MAX(id)`` is what
+    it was when the page was read.
+
+    Packets are only ever appended with increasing ids, so a full page of an id-ordered query is stable: every packet
+    added later has an id past the page's last row. The last page of such a query, and any page ordered by size, can
+    still gain rows.
+    """
+
+    def __init__(self, entries: int = CACHE_ENTRIES, seconds: float = CACHE_SECONDS):
+        self.entries, self.seconds = entries, seconds
+        self._pages: OrderedDict[tuple, tuple[int, bool, float, Page]] = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key: tuple, stamp: int) -> Page | None:
+        entry = self._pages.get(key)
+        if (
+            entry is None
+            or not (entry[1] or entry[0] == stamp)
+            or time.monotonic() - entry[2] > self.seconds
+        ):
+            self.misses += 1
+            return None
+        self._pages.move_to_end(key)
+        self.hits += 1
+        return entry[3]
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def put(self, key: tuple, stamp: int, page: Page, stable: bool = False) -> None:
+        self._pages[key] = (stamp, stable, time.monotonic(), page)
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.entries:
+            self._pages.popitem(last=False)
+
+
+class QueryService(object):
+    """Serves paginated packet queries over HTTP from a pool of read-only connections.
+
+    Pages are streamed to the client as newline-delimited JSON while they are read, ending with a
+    ``{"next": cursor}`` line. sqlite work runs in worker threads, at most one query per pooled connection, so the
+    event loop only ever waits on sockets.
+    """
+
+    def __init__(self, pool: storage.Pool, cache: Cache | None = None):
+        self.pool = pool
+        self.cache = cache or Cache()
+        self._slots = asyncio.Semaphore(pool.size)
+        with pool.connection() as con:
+            present = {row[1] for row in con.execute("PRAGMA table_info(packets)")}
+        self.columns = [c for c in _COLUMNS if c in present]
+        self.queries = self.active = 0
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            method, target, _ = request.split(b"\r\n", 1)[0].decode().split(" ", 2)
+            url = urllib.parse.urlsplit(target)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            if method != "GET":
+                await self._reply(writer, 405, {"error": "only GET is supported"})
+            elif url.path == "/stats":
+                await self._reply(writer, 200, self.stats())
+            elif url.path == "/packets":
+                await self._packets(writer, params)
+            else:
+                await self._reply(writer, 404, {"error": "not found"})
+        except QueryError as e:
+            await self._reply(writer, 400, {"error": str(e)})
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _reply(self, writer: asyncio.StreamWriter, code: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        writer.write(
+            f"HTTP/1.1 {code} {'OK' if code == 200 else 'Error'}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+
+    async def _packets(
+        self, writer: asyncio.StreamWriter, params: dict[str, str]
+    ) -> None:
+        limit = min(max(_int(params, "limit", DEFAULT_LIMIT), 1), MAX_LIMIT)
+        key = tuple(sorted(params.items())) + (("limit", limit),)
+        self.queries += 1
+        self.active += 1
+        try:
+            async with self._slots:
+                with self.pool.connection() as con:
+                    stamp = await asyncio.to_thread(
+                        lambda: con.execute("SELECT MAX(id) FROM packets").fetchone()[0]
+                    )
+                    page = self.cache.get(key, stamp)
+                    if page is None:
+                        sql, args, cursor = await asyncio.to_thread(
+                            plan, con, params, self.columns
+                        )
+                        page = await self._stream(
+                            writer, con, sql, args + (limit,), limit, cursor
+                        )
+                        self.cache.put(
+                            key, stamp, page, cursor == "id" and page.next is not None
+                        )
+                        return
+            writer.write(self._head())
+            if page.lines:
+                # An empty chunk would be the terminating chunk and end the body before the cursor
+                writer.write(_chunk(b"".join(page.lines)))
+            await self._finish(writer, page.next)
+        finally:
+            self.active -= 1
+
+    @staticmethod
+    def _head() -> bytes:
+        return (
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+        )
+
+    async def _stream(
+        self,
+        writer: asyncio.StreamWriter,
+        con: sqlite3.Connection,
+        sql: str,
+        args: tuple,
+        limit: int,
+        cursor: str,
+    ) -> Page:
+        # Sends each batch as soon as it is read, and returns the whole page for the cache
+        cur = await asyncio.to_thread(con.execute, sql, args)
+        names = [d[0] for d in cur.description]
+        writer.write(self._head())
+        lines, last = [], None
+        while rows := await asyncio.to_thread(cur.fetchmany, _fetch_size):
+            batch = [_encode(names, row) for row in rows]
+            lines += batch
+            last = rows[-1]
+            writer.write(_chunk(b"".join(batch)))
+            await writer.drain()
+        following = None
+        if last is not None and len(lines) == limit:
+            row = dict(zip(names, last))
+            following = (
+                f"{row['sizeBytes']}:{row['id']}"
+                if cursor == "size"
+                else str(row["id"])
+            )
+        await self._finish(writer, following)
+        return Page(lines, following)
+
+    @staticmethod
+    async def _finish(writer: asyncio.StreamWriter, following: str | None) -> None:
+        writer.write(_chunk(json.dumps({"next": following}).encode() + b"\n"))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def stats(self) -> dict:
+        return {
+            "queries": self.queries,
+            "active": self.active,
+            "cacheHits": self.cache.hits,
+            "cacheMisses": self.cache.misses,
+            "cachedPages": len(self.cache),
+        }
+
+
+def _chunk(data: bytes) -> bytes:
+    return f"{len(data):x}\r\n".encode() + data + b"\r\n"
+
+
+def query(url: str = f"http://{_host}:{_port}", **params) -> Iterator[dict]:
+    """Stand-in client: yields every packet matching ``params``, following the cursor from page to page.
+
+    :raises ConnectionError: if a page ends without its ``{"next": cursor}`` line.
+    """
+    params = {k: str(v) for k, v in params.items()}
+    while True:
+        finished, following = False, None
+        with urllib.request.urlopen(
+            f"{url}/packets?{urllib.parse.urlencode(params)}"
+        ) as resp:
+            for line in resp:
+                row = json.loads(line)
+                if set(row) == {"next"}:
+                    finished, following = True, row["next"]
+                else:
+                    yield row
+        if not finished:
+            raise ConnectionError("The page ended before its next cursor.")
+        if following is None:
+            return
+        params["after"] = following
+
+
+async def serve(
+    database: Path = FilePath.database,
+    host: str = _host,
+    port: int = _port,
+    connections: int = 4,
+) -> None:
+    with storage.connect(database) as con:
+        setup(con)
+    con.close()
+    with storage.Pool(database, size=connections, readonly=True) as pool:
+        service = QueryService(pool)
+        server = await asyncio.start_server(service.handle, host, port)
+        Log.log(sender, f"Serving {database} on http://{host}:{port}.")
+        async with server:
+            await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Read-only query service over spessartine.sqlite3."
+    )
+    parser.add_argument("--port", type=int, default=_port)
+    parser.add_argument("--connections", type=int, default=4)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(port=args.port, connections=args.connections))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+# reassembly.py
+
+import socket
+import sqlite3
+import struct
+from dataclasses import dataclass, field
+from typing import Iterator, NamedTuple
+
+from spessartine import Net, FilePath, Log
+
+sender: str = __file__.rpartition("/")[-1].strip()
+
+# Direction of a byte stream within a flow.
+CLIENT_TO_SERVER, SERVER_TO_CLIENT = 0, 1
+
+# Out-of-order segments held back per stream before the missing bytes are declared lost.
+MAX_PENDING_SEGMENTS = 256
+
+_ETHERTYPE_IPV4, _ETHERTYPE_VLAN = 0x0800, 0x8100
+_IPPROTO_TCP = 6
+_TCP_SYN = 0x02
+
+
+class Segment(NamedTuple):
+    src: str
+    sport: int
+    dst: str
+    dport: int
+    seq: int
+    flags: int
+    payload: bytes
+
+
+def parse_frame(frame: bytes) -> Segment | None:
+    """Extracts the TCP segment from a raw Ethernet frame. Returns ``None`` for anything else."""
+    if len(frame) < 14:
+        return None
+    off = 12
+    (ethertype,) = struct.unpack_from("!H", frame, off)
+    while ethertype == _ETHERTYPE_VLAN and len(frame) >= off + 6:
+        off += 4
+        (ethertype,) = struct.unpack_from("!H", frame, off)
+    if ethertype != _ETHERTYPE_IPV4:
+        return None
+    ip = off + 2
+
+    if len(frame) < ip + 20:
+        return None
+    version_ihl, protocol = frame[ip], frame[ip + 9]
+    (total_length,) = struct.unpack_from("!H", frame, ip + 2)
+    if version_ihl >> 4 != 4 or protocol != _IPPROTO_TCP:
+        return None
+    tcp = ip + (version_ihl & 0x0F) * 4
+    end = min(ip + total_length, len(frame))  # Drop Ethernet padding
+    if end < tcp + 20:
+        return None
+
+    sport, dport, seq, _, offset_flags = struct.unpack_from("!HHIIH", frame, tcp)
+    payload = frame[tcp + (offset_flags >> 12) * 4 : end]
+    return Segment(
+        socket.inet_ntoa(frame[ip + 12 : ip + 16]),
+        sport,
+        socket.inet_ntoa(frame[ip + 16 : ip + 20]),
+        dport,
+        seq,
+        offset_flags & 0x3F,
+        payload,
+    )
+
+
+@dataclass
+class Stream:
+    """Reassembly state for one direction of a flow. Offsets are relative to ``isn``, unwrapped past 2**32."""
+
+    flow_id: int
+    direction: int
+    isn: int | None = None
+    next_offset: int = 0
+    pending: dict[int, tuple[bytes, int]] = field(default_factory=dict)
+    dirty: bool = False
+
+    def offset_of(self, seq: int) -> int:
+        # Choose the 64-bit offset congruent to seq that lies closest to where the stream is now.
+        rel = (seq - self.isn) % 2**32
+        base = self.next_offset - self.next_offset % 2**32
+        candidates = (base + rel - 2**32, base + rel, base + rel + 2**32)
+        return min(candidates, key=lambda o: abs(o - self.next_offset))
+
+
+# A reconnect reuses the address/port 4-tuple, so flows are not unique on it; the newest flow of a 4-tuple is the
+# current one.
+_FLOWS_COLUMNS = """
+        (
+            id INTEGER UNIQUE NOT NULL PRIMARY KEY ASC,
+            clientAddress STRING NOT NULL ON CONFLICT ABORT,
+            clientPort INTEGER NOT NULL ON CONFLICT ABORT,
+            serverAddress STRING NOT NULL ON CONFLICT ABORT,
+            serverPort INTEGER NOT NULL ON CONFLICT ABORT,
+            firstPacketID INTEGER NOT NULL ON CONFLICT ABORT,
+            lastPacketID INTEGER NOT NULL ON CONFLICT ABORT,
+            firstIso8601 STRING NOT NULL ON CONFLICT ABORT,
+            lastIso8601 STRING NOT NULL ON CONFLICT ABORT
+        )
+"""
+
+
+def setup(connection: sqlite3.Connection) -> None:
+    row = connection.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'flows'"
+    ).fetchone()
+    if row is not None and "UNIQUE (clientAddress" in row[0]:
+        # Tables from before reconnects were told apart were unique on the 4-tuple: rebuild without it
+        connection.executescript(
+            f"""
+            BEGIN;
+            CREATE TABLE flowsRebuilt {_FLOWS_COLUMNS};
+            INSERT INTO flowsRebuilt SELECT * FROM flows;
+            DROP TABLE flows;
+            ALTER TABLE flowsRebuilt RENAME TO flows;
+            COMMIT;
+            """
+        )
+    connection.executescript(
+        f"""
+        CREATE TABLE IF NOT EXISTS flows {_FLOWS_COLUMNS};
+        CREATE INDEX IF NOT EXISTS flowsAddress
+            ON flows (clientAddress, clientPort, serverAddress, serverPort);
+        CREATE TABLE IF NOT EXISTS flowStreams
+        (
+            flowID INTEGER NOT NULL ON CONFLICT ABORT REFERENCES flows (id),
+            direction INTEGER NOT NULL ON CONFLICT ABORT,
+            isn INTEGER,
+            nextOffset INTEGER NOT NULL ON CONFLICT ABORT,
+            PRIMARY KEY (flowID, direction)
+        );
+        CREATE TABLE IF NOT EXISTS streamSegments
+        (
+            id INTEGER UNIQUE NOT NULL PRIMARY KEY ASC,
+            flowID INTEGER NOT NULL ON CONFLICT ABORT REFERENCES flows (id),
+            direction INTEGER NOT NULL ON CONFLICT ABORT,
+            offset INTEGER NOT NULL ON CONFLICT ABORT,
+            sizeBytes INTEGER NOT NULL ON CONFLICT ABORT,
+            data BLOB NOT NULL ON CONFLICT ABORT,
+            packetID INTEGER NOT NULL ON CONFLICT ABORT REFERENCES packets (id)
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS streamSegmentsOffset
+            ON streamSegments (flowID, direction, offset);
+        CREATE TABLE IF NOT EXISTS pendingSegments
+        (
+            flowID INTEGER NOT NULL ON CONFLICT ABORT,
+            direction INTEGER NOT NULL ON CONFLICT ABORT,
+            offset INTEGER NOT NULL ON CONFLICT ABORT,
+            data BLOB NOT NULL ON CONFLICT ABORT,
+            packetID INTEGER NOT NULL ON CONFLICT ABORT,
+            PRIMARY KEY (flowID, direction, offset)
+        );
+        CREATE TABLE IF NOT EXISTS streamGaps
+        (
+            flowID INTEGER NOT NULL ON CONFLICT ABORT,
+            direction INTEGER NOT NULL ON CONFLICT ABORT,
+            offset INTEGER NOT NULL ON CONFLICT ABORT,
+            sizeBytes INTEGER NOT NULL ON CONFLICT ABORT,
+            PRIMARY KEY (flowID, direction, offset)
+        );
+        CREATE TABLE IF NOT EXISTS reassemblyState
+        (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            lastPacketID INTEGER NOT NULL ON CONFLICT ABORT
+        );
+    """
+    )
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(packets)")}
+    for column in ("flowID", "direction"):
+        if column not in columns:
+            connection.execute(f"ALTER TABLE packets ADD COLUMN {column} INTEGER")
+    connection.commit()
+
+
+class Reassembler(object):
+    """Groups rows of ``packets`` into client <-> server TCP flows and appends their in-order payload to
+    ``streamSegments``. Each run resumes after the last packet the previous run consumed.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.flows: dict[tuple[str, int, str, int], int] = {}
+        self.streams: dict[tuple[int, int], Stream] = {}
+        self.labels: list[tuple[int, int, int]] = []
+        # flowID -> (lastPacketID, lastIso8601) not yet written to flows
+        self.last_seen: dict[int, tuple[int, str]] = {}
+        self.segments_written = 0
+        self.gaps_written = 0
+
+    def _new_flow(
+        self, key: tuple[str, int, str, int], packet_id: int, iso8601: str
+    ) -> int:
+        flow_id = self.connection.execute(
+            """
+            INSERT INTO flows (clientAddress, clientPort, serverAddress, serverPort,
+                firstPacketID, lastPacketID, firstIso8601, lastIso8601)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (*key, packet_id, packet_id, iso8601, iso8601),
+        ).lastrowid
+        self.flows[key] = flow_id
+        return flow_id
+
+    def _flow_id(self, key: tuple[str, int, str, int], packet_id: int, iso8601: str):
+        try:
+            flow_id = self.flows[key]
+        except KeyError:
+            row = self.connection.execute(
+                """
+                SELECT id FROM flows
+                WHERE clientAddress = ? AND clientPort = ? AND serverAddress = ? AND serverPort = ?
+                ORDER BY id DESC LIMIT 1
+                """,
+                key,
+            ).fetchone()
+            if row is None:
+                return self._new_flow(key, packet_id, iso8601)
+            flow_id = self.flows[key] = row[0]
+        return flow_id
+
+    def _stream(self, flow_id: int, direction: int) -> Stream:
+        try:
+            return self.streams[(flow_id, direction)]
+        except KeyError:
+            pass
+        stream = Stream(flow_id, direction)
+        row = self.connection.execute(
+            "SELECT isn, nextOffset FROM flowStreams WHERE flowID = ? AND direction = ?",
+            (flow_id, direction),
+        ).fetchone()
+        if row is not None:
+            stream.isn, stream.next_offset = row
+            stream.pending = {
+                offset: (data, packet_id)
+                for offset, data, packet_id in self.connection.execute(
+                    """
+                    SELECT offset, data, packetID FROM pendingSegments
+                    WHERE flowID = ? AND direction = ?
+                    """,
+                    (flow_id, direction),
+                )
+            }
+        self.streams[(flow_id, direction)] = stream
+        return stream
+
+    def _append(self, stream: Stream, data: bytes, packet_id: int) -> None:
+        self.connection.execute(
+            """
+            INSERT INTO streamSegments (flowID, direction, offset, sizeBytes, data, packetID)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                stream.flow_id,
+                stream.direction,
+                stream.next_offset,
+                len(data),
+                data,
+                packet_id,
+            ),
+        )
+        stream.next_offset += len(data)
+        self.segments_written += 1
+
+    def _accept(self, stream: Stream, offset: int, data: bytes, packet_id: int):
+        # Trim bytes already delivered (retransmits, overlapping segments).
+        if offset < stream.next_offset:
+            data = data[stream.next_offset - offset :]
+            offset = stream.next_offset
+        if not data:
+            return
+        if offset > stream.next_offset:
+            held = stream.pending.get(offset)
+            if held is None or len(held[0]) < len(data):
+                stream.pending[offset] = (data, packet_id)
+            if len(stream.pending) > MAX_PENDING_SEGMENTS:
+                self._skip_gap(stream)
+        else:
+            self._append(stream, data, packet_id)
+        self._drain(stream)
+
+    def _drain(self, stream: Stream) -> None:
+        while stream.pending:
+            offset = min(stream.pending)
+            if offset > stream.next_offset:
+                return
+            data, packet_id = stream.pending.pop(offset)
+            data = data[stream.next_offset - offset :]
+            if data:
+                self._append(stream, data, packet_id)
+
+    def _skip_gap(self, stream: Stream) -> None:
+        offset = min(stream.pending)
+        self.connection.execute(
+            "INSERT OR IGNORE INTO streamGaps (flowID, direction, offset, sizeBytes) VALUES (?, ?, ?, ?)",
+            (
+                stream.flow_id,
+                stream.direction,
+                stream.next_offset,
+                offset - stream.next_offset,
+            ),
+        )
+        stream.next_offset = offset
+        self.gaps_written += 1
+
+    def feed(self, packet_id: int, frame: bytes, iso8601: str) -> None:
+        segment = parse_frame(frame)
+        if segment is None:
+            return
+        if segment.src == Net.client_address and segment.dst == Net.server_address:
+            direction = CLIENT_TO_SERVER
+            key = (segment.src, segment.sport, segment.dst, segment.dport)
+        elif segment.src == Net.server_address and segment.dst == Net.client_address:
+            direction = SERVER_TO_CLIENT
+            key = (segment.dst, segment.dport, segment.src, segment.sport)
+        else:
+            return
+
+        flow_id = self._flow_id(key, packet_id, iso8601)
+        stream = self._stream(flow_id, direction)
+        if segment.flags & _TCP_SYN:
+            # A SYN consumes one sequence number; data starts after it.
+            isn = (segment.seq + 1) % 2**32
+            if stream.isn is not None and stream.isn != isn:
+                # Not a retransmitted SYN: the 4-tuple was reused by a new connection
+                flow_id = self._new_flow(key, packet_id, iso8601)
+                stream = self._stream(flow_id, direction)
+            if stream.isn is None:
+                stream.isn, stream.next_offset = isn, 0
+        self.labels.append((flow_id, direction, packet_id))
+        self.last_seen[flow_id] = (packet_id, iso8601)
+        stream.dirty = True
+        if segment.flags & _TCP_SYN:
+            return
+        if not segment.payload:
+            return
+        if stream.isn is None:
+            # Capture started mid-flow: the first data segment we see defines offset 0.
+            stream.isn = segment.seq
+        self._accept(stream, stream.offset_of(segment.seq), segment.payload, packet_id)
+
+    def flush(self, last_packet_id: int) -> None:
+        self.connection.executemany(
+            "UPDATE packets SET flowID = ?, direction = ? WHERE id = ?", self.labels
+        )
+        self.labels.clear()
+        self.connection.executemany(
+            "UPDATE flows SET lastPacketID = ?, lastIso8601 = ? WHERE id = ?",
+            (
+                (packet_id, iso8601, flow_id)
+                for flow_id, (packet_id, iso8601) in self.last_seen.items()
+            ),
+        )
+        self.last_seen.clear()
+        for stream in self.streams.values():
+            if not stream.dirty:
+                continue
+            self.connection.execute(
+                "INSERT OR REPLACE INTO flowStreams (flowID, direction, isn, nextOffset) VALUES (?, ?, ?, ?)",
+                (stream.flow_id, stream.direction, stream.isn, stream.next_offset),
+            )
+            self.connection.execute(
+                "DELETE FROM pendingSegments WHERE flowID = ? AND direction = ?",
+                (stream.flow_id, stream.direction),
+            )
+            self.connection.executemany(
+                "INSERT INTO pendingSegments (flowID, direction, offset, data, packetID) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (stream.flow_id, stream.direction, offset, data, packet_id)
+                    for offset, (data, packet_id) in stream.pending.items()
+                ),
+            )
+            stream.dirty = False
+        self.connection.execute(
+            "INSERT OR REPLACE INTO reassemblyState (id, lastPacketID) VALUES (0, ?)",
+            (last_packet_id,),
+        )
+        self.connection.commit()
+
+    def run(self, batch_size: int = 10000) -> int:
+        """Consumes every packet newer than the stored checkpoint. Returns the number of packets read."""
+        row = self.connection.execute(
+            "SELECT lastPacketID FROM reassemblyState WHERE id = 0"
+        ).fetchone()
+        last_packet_id = 0 if row is None else row[0]
+        count = 0
+        while True:
+            rows = self.connection.execute(
+                "SELECT id, packet, iso8601 FROM packets WHERE id > ? ORDER BY id ASC LIMIT ?",
+                (last_packet_id, batch_size),
+            ).fetchall()
+            if not rows:
+                return count
+            for packet_id, frame, iso8601 in rows:
+                self.feed(packet_id, frame, iso8601)
+            last_packet_id = rows[-1][0]
+            count += len(rows)
+            self.flush(last_packet_id)
+
+
+def read(
+    connection: sqlite3.Connection, flow_id: int, direction: int, offset: int, size: int
+) -> bytes:
+    """Returns up to ``size`` bytes of a reassembled stream starting at ``offset``."""
+    assert offset >= 0 and size >= 0
+    start = connection.execute(
+        """
+        SELECT MAX(offset) FROM streamSegments
+        WHERE flowID = ? AND direction = ? AND offset <= ?
+        """,
+        (flow_id, direction, offset),
+    ).fetchone()[0]
+    if start is None:
+        start = offset
+    ret = bytearray()
+    for seg_offset, data in connection.execute(
+        """
+        SELECT offset, data FROM streamSegments
+        WHERE flowID = ? AND direction = ? AND offset >= ? AND offset < ?
+        ORDER BY offset ASC
+        """,
+        (flow_id, direction, start, offset + size),
+    ):
+        if seg_offset > offset + len(ret):
+            break  # Stop at a gap
+        ret += data[offset + len(ret) - seg_offset :]
+    return bytes(ret[:size])
+
+
+def iter_segments(
+    connection: sqlite3.Connection, flow_id: int, direction: int, offset: int = 0
+) -> Iterator[tuple[int, bytes]]:
+    """Yields ``(offset, data)`` for each stored segment at or after ``offset``, in stream order."""
+    yield from connection.execute(
+        """
+        SELECT offset, data FROM streamSegments
+        WHERE flowID = ? AND direction = ? AND offset >= ?
+        ORDER BY offset ASC
+        """,
+        (flow_id, direction, offset),
+    )
+
+
+def main() -> None:
+    with sqlite3.connect(FilePath.database, timeout=10) as con:
+        setup(con)
+        reassembler = Reassembler(con)
+        count = reassembler.run()
+    Log.log(
+        sender,
+        f"Reassembled {count} packets into {len(reassembler.flows)} flows "
+        f"(+{reassembler.segments_written} segments, +{reassembler.gaps_written} gaps).",
+    )
+
+
+if __name__ == "__main__":
+    main()
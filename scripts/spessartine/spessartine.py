@@ -1,22 +1,39 @@
 # spessartine.py
 
-import lzma
+import atexit
+import json
+import os
 import pickle
 import pathlib
 import datetime
 import logging
+import logging.handlers
+import queue
+import select
+import sqlite3
+import sys
+import threading
+import time
 from hashlib import blake2b
 from typing import Any
+from codec import Codec, Raw, XZ, Zlib, get as get_codec
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import storage
 
 
 class FilePath:
     root: pathlib.Path = pathlib.Path(__file__).parent.resolve()
     database = root / "spessartine.sqlite3"
     log = root / "spessartine.log"
+    columns = root / "spessartine.columns"
+    status = root / "spessartine.status.json"
 
 
 class Net:
     interface_name: str = "enp34s0"
+    client_address: str = "192.168.1.10"
+    server_address: str = "50.116.63.13"
 
 
 class Time:
@@ -27,9 +44,225 @@ class Time:
         return str(datetime.datetime.now(tz=Time.timezone))
 
 
+class _Writer(logging.handlers.QueueListener):
+    """The background writer. Callers queue plain tuples; they become ``LogRecord``s only here, off the caller's
+    thread. A queued ``threading.Event`` is set once everything queued before it has been handled.
+    """
+
+    def prepare(self, item):
+        if isinstance(item, threading.Event):
+            return item
+        monotonic_ns, level, sender, message, do_print, fields = item
+        record = logging.LogRecord(Log.name, level, "", 0, message, None, None)
+        record.created = Log.wall_ns(monotonic_ns) / 10**9
+        record.monotonic_ns, record.sender = monotonic_ns, sender
+        record.do_print, record.fields = do_print, fields
+        return record
+
+    def handle(self, record) -> None:
+        if isinstance(record, threading.Event):
+            record.set()
+        else:
+            super().handle(record)
+
+
+class _Meter(logging.Handler):
+    # Last handler on the writer thread: counts records and how long they waited to be written
+    def __init__(self):
+        super().__init__()
+        self.written = 0
+        self.lag_ns_total = self.lag_ns_max = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        lag = time.monotonic_ns() - record.monotonic_ns
+        self.written += 1
+        self.lag_ns_total += lag
+        self.lag_ns_max = max(self.lag_ns_max, lag)
+
+
+class _JsonLines(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(
+            {
+                "iso8601": Log.wall_clock(record.monotonic_ns),
+                "level": record.levelname,
+                "sender": record.sender.strip(),
+                "message": record.msg.strip(),
+                **record.fields,
+            },
+            default=str,
+        )
+
+
+class _Console(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return f"{Log.wall_clock(record.monotonic_ns)}:{record.sender.strip()}: {record.msg.strip()}"
+
+
+class _Pipe(object):
+    # Carries records from forked children to the writing process. Each record is a single write of at most
+    # PIPE_BUF bytes, which the OS makes atomic, so no lock is shared and a child killed mid-write cannot block the
+    # others. Larger records are written to the file by the child itself.
+    _header = 4
+
+    def __init__(self):
+        self._read, self._write = os.pipe()
+
+    def put(self, item) -> None:
+        data = pickle.dumps(item)
+        frame = len(data).to_bytes(_Pipe._header, "little") + data
+        if len(frame) <= select.PIPE_BUF:
+            os.write(self._write, frame)
+        else:
+            Log._direct().put(item)
+
+    def get(self):
+        size = int.from_bytes(self._read_exactly(_Pipe._header), "little")
+        return pickle.loads(self._read_exactly(size))
+
+    def _read_exactly(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            data += os.read(self._read, size - len(data))
+        return data
+
+    def close(self) -> None:
+        os.close(self._read)
+        os.close(self._write)
+
+
+class _Direct(object):
+    # Stands in for the pipe to the parent's writer in a worker that has none: handles each record on the caller's
+    # thread, so a terminated worker has nothing left queued
+    def __init__(self, writer: _Writer):
+        self.writer = writer
+
+    def put(self, item) -> None:
+        self.writer.handle(item)
+
+
 class Log:
-    logging.basicConfig(filename=FilePath.log, level=logging.INFO)
-    logger = logging.getLogger(pathlib.Path(__file__).name)
+    """Non-blocking logging to ``FilePath.log`` as JSON lines.
+
+    ``log`` only takes a ``time.monotonic_ns`` reading and queues the message. A background thread turns it into a
+    ``LogRecord``, formats the timestamp, writes the file (rotated at ``max_bytes``) and prints the records that
+    asked for it. If the writer falls ``queue_size`` records behind, further records are dropped rather than stalling
+    the caller; ``stats`` reports how many.
+
+    Only one process writes the file. Children forked from it once it has logged (e.g. ``mp.Pool`` workers) send
+    their records through a pipe to its writer; each ``log`` in a child returns once the record is in the pipe, so
+    nothing is lost when the worker is terminated. Other workers write each record to the file before ``log``
+    returns, and never rotate it.
+    """
+
+    name = pathlib.Path(__file__).name
+    max_bytes = 16 * 1024 * 1024
+    backups = 4
+    queue_size = 65536
+
+    _configured = False
+    _queue: queue.SimpleQueue | None = None
+    # The pipe between a writing process and its forked children, the parent's thread reading it, and whether this
+    # process logs through it (or through a _Direct) instead of its own writer thread
+    _channel = None
+    _relay: threading.Thread | None = None
+    _relaying = False
+    _meter: _Meter | None = None
+    _writer: _Writer | None = None
+    _anchor = (0, 0)  # (time.time_ns(), time.monotonic_ns()) taken together
+    _calls = _call_ns = _dropped = _relayed = 0
+
+    @staticmethod
+    def _configure() -> None:
+        # Deferred to the first message, so importing this module (e.g. for --help) neither opens the log file
+        # nor starts the writer
+        if Log._configured:
+            return
+        Log._anchor = (time.time_ns(), time.monotonic_ns())
+        Log._queue = queue.SimpleQueue()
+        Log._meter = _Meter()
+
+        mp = sys.modules.get("multiprocessing")
+        worker = mp is not None and mp.parent_process() is not None
+        Log._writer = Log._new_writer(worker)
+        if worker:
+            Log._channel, Log._relaying = _Direct(Log._writer), True
+        else:
+            Log._writer.start()
+        Log._configured = True
+
+    @staticmethod
+    def _new_writer(worker: bool) -> _Writer:
+        if worker:
+            # Not the writing process: append, reopening the file once the parent has rotated it
+            file = logging.handlers.WatchedFileHandler(
+                FilePath.log, encoding="utf-8", delay=True
+            )
+        else:
+            file = logging.handlers.RotatingFileHandler(
+                FilePath.log,
+                maxBytes=Log.max_bytes,
+                backupCount=Log.backups,
+                encoding="utf-8",
+                delay=True,
+            )
+        file.setFormatter(_JsonLines())
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(_Console())
+        console.addFilter(lambda record: record.do_print)
+        return _Writer(Log._queue, file, console, Log._meter)
+
+    @staticmethod
+    def _direct() -> _Direct:
+        # A forked child's own writer, for the records too large for the pipe
+        if Log._writer is None:
+            Log._meter = Log._meter or _Meter()
+            Log._writer = Log._new_writer(worker=True)
+        return _Direct(Log._writer)
+
+    @staticmethod
+    def _before_fork() -> None:
+        # Opens the pipe children will log through, once, and only if this process already has a writer thread:
+        # otherwise forking would start threads just before it. Children of a process that has not logged configure
+        # themselves when they first log.
+        if not Log._configured or Log._relaying or Log._relay is not None:
+            return
+        Log._channel = _Pipe()
+        Log._relay = threading.Thread(
+            target=Log._receive, args=(Log._channel,), name="Log relay", daemon=True
+        )
+        Log._relay.start()
+
+    @staticmethod
+    def _receive(channel) -> None:
+        # Parent side: moves records from forked children onto the writer's queue
+        while (item := channel.get()) is not None:
+            if Log._queue.qsize() < Log.queue_size:
+                Log._queue.put(item)
+            else:
+                Log._dropped += 1
+            Log._relayed += 1
+
+    @staticmethod
+    def _after_fork() -> None:
+        # The writer and relay threads do not survive fork. The child logs through the channel it inherited, or, if
+        # there is none, configures itself when it first logs.
+        Log._writer, Log._relay, Log._meter = None, None, None
+        Log._calls = Log._call_ns = Log._dropped = Log._relayed = 0
+        Log._relaying = Log._configured = Log._channel is not None
+
+    @staticmethod
+    def wall_ns(monotonic_ns: int) -> int:
+        return Log._anchor[0] + monotonic_ns - Log._anchor[1]
+
+    @staticmethod
+    def wall_clock(monotonic_ns: int) -> str:
+        """Formats a ``time.monotonic_ns`` reading as ``Time.now`` would have at that moment."""
+        return str(
+            datetime.datetime.fromtimestamp(
+                Log.wall_ns(monotonic_ns) / 10**9, tz=Time.timezone
+            )
+        )
 
     @staticmethod
     def log(
@@ -37,32 +270,85 @@ class Log:
         message: str,
         do_print: bool = True,
         level: logging.INFO | logging.WARNING | logging.ERROR = logging.INFO,
+        **fields,
     ) -> None:
-        assert isinstance(sender, str)
-        assert isinstance(message, str)
-        assert len(sender) > 0
-        assert len(message) > 0
-        assert isinstance(do_print, bool)
-        assert level in {0, 10, 20, 30, 40, 50}
-
-        message = f"{Time.now()}:{sender.strip()}: {message.strip()}"
-        match level:
-            case logging.INFO:
-                Log.logger.info(message)
-            case logging.WARNING:
-                Log.logger.warning(message)
-            case logging.ERROR:
-                Log.logger.error(message)
-
-        if do_print:
-            print(message)
-
-
-def pack(obj, do_compress=True, compression_preset=6) -> tuple[bytes, str]:
+        """Queues ``message`` from ``sender``. Keyword arguments are added to the JSON record as they are."""
+        t = time.monotonic_ns()
+        if not Log._configured:
+            Log._configure()
+        if Log._relaying:
+            try:
+                Log._channel.put((t, level, sender, message, do_print, fields))
+            except (pickle.PicklingError, TypeError, AttributeError):
+                fields = {k: str(v) for k, v in fields.items()}
+                Log._channel.put((t, level, sender, message, do_print, fields))
+        elif Log._queue.qsize() < Log.queue_size:
+            Log._queue.put((t, level, sender, message, do_print, fields))
+        else:
+            Log._dropped += 1
+        Log._calls += 1
+        Log._call_ns += time.monotonic_ns() - t
+
+    @staticmethod
+    def flush() -> None:
+        """Blocks until every record queued so far has been written. In a forked child, records are already with the
+        parent once ``log`` returns, and this returns at once."""
+        if Log._configured and not Log._relaying:
+            done = threading.Event()
+            Log._queue.put(done)
+            done.wait()
+
+    @staticmethod
+    def close() -> None:
+        """Writes the queued records and stops the writer thread. Logging again starts a new one."""
+        if Log._relay is not None:
+            # Children forked from now on get a new pipe; the records already in this one are written first
+            Log._channel.put(None)
+            Log._relay.join()
+            Log._channel.close()
+            Log._channel, Log._relay = None, None
+        if Log._writer is not None:
+            if Log._relaying:
+                Log._channel, Log._relaying = None, False
+            else:
+                Log._writer.stop()
+            for handler in Log._writer.handlers:
+                handler.close()
+            Log._configured, Log._writer = False, None
+
+    @staticmethod
+    def stats() -> dict[str, int | float]:
+        """Records logged, written, waiting and dropped, the mean cost of ``log`` to its caller and how long records
+        wait for the writer."""
+        if Log._meter is None:
+            return {"records": Log._calls}
+        meter = Log._meter
+        return {
+            "records": Log._calls,
+            "written": meter.written,
+            "queued": Log._queue.qsize(),
+            "dropped": Log._dropped,
+            "relayed": Log._relayed,
+            "call_us_mean": Log._call_ns / max(Log._calls, 1) / 1000,
+            "write_lag_ms_mean": meter.lag_ns_total / max(meter.written, 1) / 10**6,
+            "write_lag_ms_max": meter.lag_ns_max / 10**6,
+        }
+
+
+os.register_at_fork(before=Log._before_fork, after_in_child=Log._after_fork)
+atexit.register(Log.close)
+
+
+def pack(
+    obj, do_compress=True, compression_preset=6, codec: Codec | None = None
+) -> tuple[bytes, str]:
     """
-    Pickles ``obj`` and then [optionally] LZMA compresses the pickle. Returns a tuple containing the [compressed] pickle and its
+    Pickles ``obj`` and then [optionally] compresses the pickle. Returns a tuple containing the [compressed] pickle and its
     blake2b hash.
 
+    ``codec`` defaults to ``codec.XZ(compression_preset)``, the original format. Callers passing another codec must
+    store ``codec.codec_id`` alongside the blob so that ``unpack`` can reverse it.
+
     :raises pickle.PicklingError:
     :raises lzma.LZMAError:
     :raises AssertionError:
@@ -73,27 +359,166 @@ def pack(obj, do_compress=True, compression_preset=6) -> tuple[bytes, str]:
     ret = pickle.dumps(obj, protocol=5)
 
     if do_compress:
-        assert isinstance(compression_preset, int)
-        assert 9 >= compression_preset >= 0
-        assert lzma.is_check_supported(lzma.CHECK_SHA256)
-        ret = lzma.compress(
-            ret,
-            format=lzma.FORMAT_XZ,
-            check=lzma.CHECK_SHA256,
-            preset=lzma.PRESET_EXTREME | compression_preset,
-        )
+        if codec is None:
+            codec = XZ(compression_preset)
+        ret = codec.compress(ret)
 
     return ret, blake2b(ret).hexdigest()
 
 
-def unpack(obj: bytes, do_decompress=True) -> Any:
+def unpack(obj: bytes, do_decompress=True, codec: Codec | None = None) -> Any:
     """
-    Takes an LZMA compressed pickle ``obj``. Returns a decompressed, un-pickled ``obj``.
+    Takes a compressed pickle ``obj``. Returns a decompressed, un-pickled ``obj``.
+
+    ``codec`` defaults to ``codec.XZ``, which is what rows without a stored codec id were written with.
 
     :raises pickle.UnpicklingError:
     :raises lzma.LZMAError:
+    :raises zlib.error:
     """
     if do_decompress:
-        return pickle.loads(lzma.decompress(obj, format=lzma.FORMAT_XZ))
+        if codec is None:
+            codec = XZ()
+        return pickle.loads(codec.decompress(obj))
     else:
-        pickle.loads(obj)
+        return pickle.loads(obj)
+
+
+def pack_oob(
+    obj,
+    codec: Codec | None = None,
+    buffer_codec: Codec | None = None,
+    threshold: int = 1024 * 1024,
+) -> tuple[bytes, list[bytes | memoryview], str]:
+    """
+    Like ``pack``, but buffers of at least ``threshold`` bytes that support protocol 5 (NumPy arrays,
+    ``pickle.PickleBuffer``) are taken out of band instead of being copied into the pickle stream. ``bytes`` and
+    ``bytearray`` are always pickled in band; wrap them in ``pickle.PickleBuffer`` to send them out of band.
+
+    Returns the [compressed] pickle, one blob per out-of-band buffer and a blake2b hash covering all of them.
+    ``buffer_codec`` defaults to ``codec.Raw``, in which case the returned blobs are views of ``obj``'s own memory.
+
+    :raises pickle.PicklingError:
+    :raises AssertionError:
+    """
+    assert pickle.HIGHEST_PROTOCOL >= 5
+    assert threshold >= 0
+
+    if codec is None:
+        codec = XZ()
+    if buffer_codec is None:
+        buffer_codec = Raw()
+
+    oob: list[pickle.PickleBuffer] = []
+
+    def _buffer_callback(buf: pickle.PickleBuffer) -> bool:
+        # Returning a true value serializes the buffer in band.
+        if buf.raw().nbytes < threshold:
+            return True
+        oob.append(buf)
+        return False
+
+    ret = codec.compress(
+        pickle.dumps(obj, protocol=5, buffer_callback=_buffer_callback)
+    )
+    hasher = blake2b(ret)
+    buffers = []
+    for buf in oob:
+        view = buf.raw()
+        blob = view if isinstance(buffer_codec, Raw) else buffer_codec.compress(view)
+        hasher.update(blob)
+        buffers.append(blob)
+
+    return ret, buffers, hasher.hexdigest()
+
+
+def unpack_oob(
+    obj: bytes,
+    buffers: list,
+    codec: Codec | None = None,
+    buffer_codec: Codec | None = None,
+) -> Any:
+    """
+    Reverses ``pack_oob``. Raw buffers are handed to the unpickler as-is, so objects are rebuilt on top of the
+    memory in ``buffers`` without copying it.
+
+    :raises pickle.UnpicklingError:
+    :raises lzma.LZMAError:
+    :raises zlib.error:
+    """
+    if codec is None:
+        codec = XZ()
+    if buffer_codec is not None and not isinstance(buffer_codec, Raw):
+        buffers = [buffer_codec.decompress(buf) for buf in buffers]
+    return pickle.loads(codec.decompress(obj), buffers=buffers)
+
+
+def store_capture(
+    connection: sqlite3.Connection,
+    obj,
+    size_packets: int,
+    codec: Codec | None = None,
+    buffer_codec: Codec | None = None,
+) -> int:
+    """
+    Packs ``obj`` with ``pack_oob`` into a new ``capture`` row and puts its out-of-band buffers into ``storage``'s
+    blobs, one ``captureBuffers`` row each. Returns the new row id.
+
+    ``codec`` defaults to ``codec.Zlib()``: the codec id is stored with the row, so unlike ``pack`` this does not have
+    to keep the original XZ format, and level 1 deflate writes many times faster at a modest cost in ratio.
+
+    The pickle and the buffers are written a chunk at a time into preallocated blobs rather than bound whole.
+
+    :raises sqlite3.IntegrityError: if an identical capture is already stored.
+    """
+    if codec is None:
+        codec = Zlib()
+    if buffer_codec is None:
+        buffer_codec = Raw()
+    blob, buffers, digest = pack_oob(obj, codec, buffer_codec)
+    capture_id = connection.execute(
+        "INSERT OR ABORT INTO capture (capture, sizePackets, blake2b, iso8601, codec) VALUES (zeroblob(?), ?, ?, ?, ?)",
+        (len(blob), size_packets, digest, Time.now(), codec.codec_id),
+    ).lastrowid
+    storage.write_chunks(connection, "capture", "capture", capture_id, blob)
+    for idx, buf in enumerate(buffers):
+        connection.execute(
+            "INSERT INTO captureBuffers (captureID, idx, codec, buffer, blake2b) VALUES (?, ?, ?, X'', ?)",
+            (capture_id, idx, buffer_codec.codec_id, storage.put(connection, buf)),
+        )
+    connection.commit()
+    return capture_id
+
+
+def load_capture(connection: sqlite3.Connection, capture_id: int) -> Any:
+    """
+    Loads a row of ``capture`` written by ``store_capture`` or by plain ``pack`` (no buffers, possibly no codec).
+
+    :raises KeyError: if there is no such row.
+    """
+    row = connection.execute(
+        "SELECT codec FROM capture WHERE id = ?", (capture_id,)
+    ).fetchone()
+    if row is None:
+        raise KeyError(capture_id)
+
+    # Blobs are decompressed as they are read from incremental blob handles, and the pickle is read straight from
+    # the decompressing stream, so a multi-MB capture is never held whole in compressed or pickled form
+    buffers = []
+    for rowid, codec_id, key in connection.execute(
+        "SELECT rowid, codec, blake2b FROM captureBuffers WHERE captureID = ? ORDER BY idx ASC",
+        (capture_id,),
+    ).fetchall():
+        if key is None:
+            blob = connection.blobopen("captureBuffers", "buffer", rowid, readonly=True)
+        else:
+            blob = storage.open_blob(connection, key)
+        with blob:
+            if codec_id == Raw.codec_id:
+                buffers.append(blob.read())
+            else:
+                with get_codec(codec_id, connection).open(blob) as fd:
+                    buffers.append(fd.read())
+    with connection.blobopen("capture", "capture", capture_id, readonly=True) as blob:
+        with get_codec(row[0], connection).open(blob) as fd:
+            return pickle.load(fd, buffers=buffers)
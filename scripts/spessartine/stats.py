@@ -0,0 +1,219 @@
+# stats.py
+
+import json
+import math
+import os
+import time
+
+from spessartine import FilePath, Log
+
+
+class Histogram(object):
+    """Fixed-size histogram with geometrically growing buckets. Percentiles are accurate to within ``growth``."""
+
+    def __init__(self, lowest: float, highest: float, growth: float = 1.05):
+        assert 0 < lowest < highest
+        assert growth > 1
+        self.lowest = lowest
+        self.highest = highest
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.size = int(math.log(highest / lowest) / self._log_growth) + 2
+        self.counts = [0] * self.size
+        self.total = 0
+
+    def index(self, value: float) -> int:
+        if value < self.lowest:
+            return 0
+        return min(
+            int(math.log(value / self.lowest) / self._log_growth) + 1, self.size - 1
+        )
+
+    def upper_bound(self, index: int) -> float:
+        return self.lowest * self.growth**index
+
+    def add(self, value: float) -> None:
+        self.counts[self.index(value)] += 1
+        self.total += 1
+
+    def clear(self) -> None:
+        self.counts = [0] * self.size
+        self.total = 0
+
+    def merge(self, other: "Histogram") -> None:
+        assert other.size == self.size
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def percentile(self, p: float) -> float | None:
+        assert 0 <= p <= 100
+        if self.total == 0:
+            return None
+        rank, acc = math.ceil(self.total * p / 100) or 1, 0
+        for index, count in enumerate(self.counts):
+            acc += count
+            if acc >= rank:
+                return self.upper_bound(index)
+        return self.upper_bound(self.size - 1)
+
+
+class Rolling(object):
+    """Keeps the last ``intervals`` histograms of ``interval`` seconds each; memory does not grow with time."""
+
+    def __init__(
+        self,
+        lowest: float,
+        highest: float,
+        growth: float = 1.05,
+        interval: float = 10.0,
+        intervals: int = 6,
+    ):
+        self.interval = interval
+        self.ring = [Histogram(lowest, highest, growth) for _ in range(intervals)]
+        self.sums = [0.0] * intervals
+        self._started = time.monotonic()
+        self._epoch = int(self._started // interval)
+
+    def _current(self, now: float) -> int:
+        epoch = int(now // self.interval)
+        # Clear every slot skipped since the last sample.
+        for e in range(max(self._epoch + 1, epoch - len(self.ring) + 1), epoch + 1):
+            self.ring[e % len(self.ring)].clear()
+            self.sums[e % len(self.ring)] = 0.0
+        self._epoch = max(self._epoch, epoch)
+        return epoch % len(self.ring)
+
+    def add(self, value: float, now: float | None = None) -> None:
+        slot = self._current(time.monotonic() if now is None else now)
+        self.ring[slot].add(value)
+        self.sums[slot] += value
+
+    def window(self, now: float | None = None) -> Histogram:
+        self._current(time.monotonic() if now is None else now)
+        first = self.ring[0]
+        ret = Histogram(first.lowest, first.highest, first.growth)
+        for h in self.ring:
+            ret.merge(h)
+        return ret
+
+    def sum(self, now: float | None = None) -> float:
+        self._current(time.monotonic() if now is None else now)
+        return sum(self.sums)
+
+    def span(self, now: float | None = None) -> float:
+        """Returns the seconds the ring currently covers: the elapsed part of the current slot plus the full ones."""
+        now = time.monotonic() if now is None else now
+        self._current(now)
+        covered = (len(self.ring) - 1) * self.interval + now % self.interval
+        return max(min(covered, now - self._started), 1e-9)
+
+    def summary(self, now: float | None = None) -> dict[str, float | int | None]:
+        h = self.window(now)
+        return {
+            "count": h.total,
+            "p50": h.percentile(50),
+            "p90": h.percentile(90),
+            "p99": h.percentile(99),
+            "max": h.percentile(100),
+        }
+
+
+class TrafficStats(object):
+    """Streaming statistics for ``capture.mainloop``.
+
+    ``record_*`` are cheap enough to call per packet. ``publish`` atomically replaces ``path`` with a JSON snapshot
+    at most once per ``publish_interval`` seconds, so readers can poll the file without touching the capture.
+    """
+
+    def __init__(
+        self,
+        path=FilePath.status,
+        window: float = 60.0,
+        publish_interval: float = 1.0,
+    ):
+        intervals, interval = 6, window / 6
+        self.path = path
+        self.window = window
+        self.publish_interval = publish_interval
+        self.size = Rolling(1, 65536, interval=interval, intervals=intervals)
+        self.inter_arrival = Rolling(1e-6, 60.0, interval=interval, intervals=intervals)
+        self.lag = Rolling(1e-4, 600.0, interval=interval, intervals=intervals)
+        self.insert_latency = Rolling(
+            1e-6, 10.0, interval=interval, intervals=intervals
+        )
+        self.commit_latency = Rolling(
+            1e-5, 60.0, interval=interval, intervals=intervals
+        )
+        self.bytes = {
+            direction: Rolling(1, 65536, interval=interval, intervals=intervals)
+            for direction in ("client_to_server", "server_to_client", "other")
+        }
+        self.packets_total = 0
+        self.errors_total = 0
+        self._last_sniff: float | None = None
+        self._last_publish = 0.0
+        self._started = time.monotonic()
+
+    def record_packet(self, size: int, direction: str, sniff_timestamp: float) -> None:
+        now = time.monotonic()
+        self.packets_total += 1
+        self.size.add(size, now)
+        self.bytes[direction].add(size, now)
+        if self._last_sniff is not None:
+            self.inter_arrival.add(max(sniff_timestamp - self._last_sniff, 0.0), now)
+        self._last_sniff = sniff_timestamp
+        # How far behind the wire the capture loop is running.
+        self.lag.add(max(time.time() - sniff_timestamp, 0.0), now)
+
+    def record_insert(self, seconds: float) -> None:
+        self.insert_latency.add(seconds)
+
+    def record_commit(self, seconds: float) -> None:
+        self.commit_latency.add(seconds)
+
+    def record_error(self) -> None:
+        self.errors_total += 1
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        # Rates are over the seconds the rings actually hold, which is less than ``window`` mid-slot.
+        window = self.size.span(now)
+        return {
+            "iso8601_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "uptime_s": now - self._started,
+            "window_s": window,
+            "packets_total": self.packets_total,
+            "errors_total": self.errors_total,
+            "packets_per_s": self.size.window(now).total / window,
+            "bytes_per_s": {
+                direction: rolling.sum(now) / window
+                for direction, rolling in self.bytes.items()
+            },
+            "size_bytes": self.size.summary(now),
+            "inter_arrival_s": self.inter_arrival.summary(now),
+            "capture_lag_s": self.lag.summary(now),
+            "insert_latency_s": self.insert_latency.summary(now),
+            "commit_latency_s": self.commit_latency.summary(now),
+            "log": Log.stats(),
+        }
+
+    def publish(self, force: bool = False) -> bool:
+        now = time.monotonic()
+        if not force and now - self._last_publish < self.publish_interval:
+            return False
+        self._last_publish = now
+        tmp = str(self.path) + ".tmp"
+        with open(tmp, "w") as fd:
+            json.dump(self.snapshot(), fd, indent=2)
+        os.replace(tmp, self.path)
+        return True
+
+
+def main() -> None:
+    """Prints the most recent snapshot published by a running capture."""
+    with open(FilePath.status, "r") as fd:
+        print(json.dumps(json.load(fd), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+# synthetic.py
+
+import argparse
+import json
+import os
+import queue
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Literal, NamedTuple
+
+from spessartine import Net, FilePath, Log
+from stats import Histogram, TrafficStats
+
+sender: str = __file__.rpartition("/")[-1].strip()
+
+_PCAP_MAGIC, _LINKTYPE_ETHERNET = 0xA1B2C3D4, 1
+_SERVER_PORT = 43594
+
+
+class Frame(NamedTuple):
+    timestamp: float
+    data: bytes
+    src: str
+
+
+class Config(NamedTuple):
+    packets: int = 100_000
+    rate: float = 2_000.0  # packets per second of simulated wire time
+    flows: int = 4
+    size_mu: float = 4.0  # payload size ~ lognormal(mu, sigma), clamped to [1, 1460]
+    size_sigma: float = 1.0
+    server_share: float = 0.7  # fraction of packets sent by the server
+    seed: int = 0
+
+
+def _frame(src: str, dst: str, sport: int, dport: int, seq: int, payload: bytes):
+    tcp = struct.pack("!HHIIHHHH", sport, dport, seq, 0, (5 << 12) | 0x18, 0xFFFF, 0, 0)
+    ip = struct.pack(
+        "!BBHHHBBH4s4s",
+        0x45,
+        0,
+        20 + len(tcp) + len(payload),
+        0,
+        0x4000,
+        64,
+        6,
+        0,
+        socket.inet_aton(src),
+        socket.inet_aton(dst),
+    )
+    ethernet = b"\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02\x08\x00"
+    return ethernet + ip + tcp + payload
+
+
+def generate(config: Config) -> Iterator[Frame]:
+    """Yields Ethernet frames shaped like game traffic: many small messages over a few long-lived flows,
+    with Poisson arrivals at ``config.rate`` and a one-byte opcode in front of each payload.
+    """
+    rng = random.Random(config.seed)
+    ports = [rng.randrange(32768, 61000) for _ in range(config.flows)]
+    seqs = {
+        (port, direction): rng.randrange(2**32)
+        for port in ports
+        for direction in (0, 1)
+    }
+    t = time.time()
+    for _ in range(config.packets):
+        t += rng.expovariate(config.rate)
+        port = rng.choice(ports)
+        from_server = rng.random() < config.server_share
+        size = min(
+            max(int(rng.lognormvariate(config.size_mu, config.size_sigma)), 1), 1460
+        )
+        payload = bytes((rng.randrange(256),)) + rng.randbytes(size - 1)
+        if from_server:
+            src, dst, sport, dport = (
+                Net.server_address,
+                Net.client_address,
+                _SERVER_PORT,
+                port,
+            )
+        else:
+            src, dst, sport, dport = (
+                Net.client_address,
+                Net.server_address,
+                port,
+                _SERVER_PORT,
+            )
+        key = (port, int(from_server))
+        yield Frame(t, _frame(src, dst, sport, dport, seqs[key], payload), src)
+        seqs[key] = (seqs[key] + size) % 2**32
+
+
+def write_pcap(path, frames: Iterator[Frame]) -> int:
+    count = 0
+    with open(path, "wb") as fd:
+        fd.write(
+            struct.pack("<IHHiIII", _PCAP_MAGIC, 2, 4, 0, 0, 65535, _LINKTYPE_ETHERNET)
+        )
+        for frame in frames:
+            seconds = int(frame.timestamp)
+            micros = int((frame.timestamp - seconds) * 10**6)
+            fd.write(
+                struct.pack("<IIII", seconds, micros, len(frame.data), len(frame.data))
+            )
+            fd.write(frame.data)
+            count += 1
+    return count
+
+
+class _Layer(object):
+    def __init__(self, src: str):
+        self.src = src
+
+
+class SyntheticPacket(object):
+    """Exposes the subset of the pyshark packet interface used by ``capture.make_callback``."""
+
+    def __init__(self, frame: Frame):
+        self._frame = frame
+        self.length = str(len(frame.data))
+        self.sniff_timestamp = str(frame.timestamp)
+        self.ip = _Layer(frame.src)
+
+    def get_raw_packet(self) -> bytes:
+        return self._frame.data
+
+
+def _database_size(path: Path) -> int:
+    return sum(
+        os.path.getsize(p)
+        for p in (path, Path(str(path) + "-wal"), Path(str(path) + "-journal"))
+        if p.exists()
+    )
+
+
+def _replay(
+    frames: Iterator[Frame],
+    packets: queue.Queue,
+    stop: threading.Event,
+    dropped: list[int],
+) -> None:
+    # Hands each frame over at its generated timestamp, as the capture would see it arrive. A full queue is a full
+    # capture buffer: the frame is dropped rather than waited for.
+    t_start, first = time.perf_counter(), None
+    for frame in frames:
+        if stop.is_set():
+            return
+        first = frame.timestamp if first is None else first
+        delay = (frame.timestamp - first) - (time.perf_counter() - t_start)
+        if delay > 0.001:
+            time.sleep(delay)
+        try:
+            packets.put_nowait(SyntheticPacket(frame))
+        except queue.Full:
+            dropped[0] += 1
+    packets.put(None)
+
+
+def run(
+    config: Config,
+    mode: Literal["storage", "pyshark"] = "storage",
+    commit_every: float = 10.0,
+    workdir: Path | None = None,
+    buffer_packets: int = 4096,
+) -> dict:
+    """Pushes ``config.packets`` synthetic packets through ``capture``'s storage path into a scratch database.
+
+    ``storage`` replays the frames at their generated timestamps into a queue of ``buffer_packets`` and stores them
+    from there, so ``drop_rate`` is the fraction a capture at ``config.rate`` would lose to a full buffer, and
+    ``packets_per_s`` is measured over the time spent storing. ``pyshark`` writes a pcap and reads it back through
+    tshark as fast as it can, as a live capture would parse it; it cannot drop packets, so its ``drop_rate`` is None.
+    """
+    if workdir is not None:
+        workdir = Path(workdir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        return _run(config, mode, commit_every, workdir, buffer_packets)
+    with tempfile.TemporaryDirectory(prefix="spessartine-bench-") as tmp:
+        return _run(config, mode, commit_every, Path(tmp), buffer_packets)
+
+
+def _run(
+    config: Config,
+    mode: Literal["storage", "pyshark"],
+    commit_every: float,
+    workdir: Path,
+    buffer_packets: int,
+) -> dict:
+    import capture
+
+    database = workdir / "bench.sqlite3"
+    cursor = capture.setup_database(database)
+    stats = TrafficStats(path=workdir / "status.json")
+    callback = capture.make_callback(cursor, stats)
+    commit_latency = Histogram(1e-5, 60.0)
+    size_before = _database_size(database)
+
+    stop, dropped = threading.Event(), [0]
+    if mode == "storage":
+        buffer = queue.Queue(maxsize=buffer_packets)
+        producer = threading.Thread(
+            target=_replay, args=(generate(config), buffer, stop, dropped), daemon=True
+        )
+        packets = iter(buffer.get, None)
+    elif mode == "pyshark":
+        import pyshark
+
+        write_pcap(workdir / "bench.pcap", generate(config))
+        producer = None
+        packets = iter(
+            pyshark.FileCapture(
+                str(workdir / "bench.pcap"), use_json=True, include_raw=True
+            )
+        )
+    else:
+        raise ValueError('mode must be "storage" or "pyshark"')
+
+    def commit() -> None:
+        t = time.perf_counter()
+        cursor.connection.commit()
+        commit_latency.add(time.perf_counter() - t)
+
+    busy = 0.0
+    t_start = t_commit = time.perf_counter()
+    if producer is not None:
+        producer.start()
+    try:
+        for packet in packets:
+            t = time.perf_counter()
+            callback(packet)
+            if t - t_commit >= commit_every:
+                commit()
+                t_commit = time.perf_counter()
+            busy += time.perf_counter() - t
+    finally:
+        stop.set()
+    t = time.perf_counter()
+    commit()
+    busy += time.perf_counter() - t
+    elapsed = time.perf_counter() - t_start
+
+    stored = cursor.execute("SELECT COUNT(*) FROM packets").fetchone()[0]
+    cursor.connection.close()
+    growth = _database_size(database) - size_before
+    return {
+        "config": config._asdict(),
+        "mode": mode,
+        "iso8601_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "elapsed_s": elapsed,
+        "packets_stored": stored,
+        "packets_per_s": stored / (busy if mode == "storage" else elapsed),
+        "drop_rate": dropped[0] / config.packets if mode == "storage" else None,
+        "buffer_packets": buffer_packets if mode == "storage" else None,
+        "commit_latency_s": {
+            "count": commit_latency.total,
+            "p50": commit_latency.percentile(50),
+            "p99": commit_latency.percentile(99),
+            "max": commit_latency.percentile(100),
+        },
+        "insert_latency_s": stats.insert_latency.summary(),
+        "db_growth_bytes": growth,
+        "db_bytes_per_packet": growth / max(stored, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Spessartine ingestion benchmark")
+    parser.add_argument("--mode", choices=("storage", "pyshark"), default="storage")
+    parser.add_argument("--packets", type=int, default=Config().packets)
+    parser.add_argument("--rate", type=float, default=Config().rate)
+    parser.add_argument("--flows", type=int, default=Config().flows)
+    parser.add_argument("--seed", type=int, default=Config().seed)
+    parser.add_argument(
+        "--buffer",
+        type=int,
+        default=4096,
+        help="Packets the capture buffer holds before dropping (storage mode).",
+    )
+    parser.add_argument("--pcap", type=Path, help="Only write a pcap to this path.")
+    parser.add_argument(
+        "--baseline", type=Path, default=FilePath.root / "spessartine.benchmark.json"
+    )
+    args = parser.parse_args()
+    config = Config(
+        packets=args.packets, rate=args.rate, flows=args.flows, seed=args.seed
+    )
+
+    if args.pcap is not None:
+        count = write_pcap(args.pcap, generate(config))
+        Log.log(sender, f"Wrote {count} synthetic packets to {args.pcap}.")
+        return
+
+    result = run(config, mode=args.mode, buffer_packets=args.buffer)
+    try:
+        with open(args.baseline, "r") as fd:
+            history = json.load(fd)
+    except FileNotFoundError:
+        history = []
+    previous = [r for r in history if r["mode"] == result["mode"]]
+    if previous:
+        before = previous[-1]["packets_per_s"]
+        change = 100 * (result["packets_per_s"] / before - 1)
+        print(
+            f"Previous {result['mode']} baseline: {before:.1f} pkt/s ({change:+.1f}%)"
+        )
+    history.append(result)
+    with open(args.baseline, "w") as fd:
+        json.dump(history, fd, indent=2)
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
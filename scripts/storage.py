@@ -0,0 +1,397 @@
+import hashlib
+import lzma
+import queue
+import sqlite3 as sql
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator
+
+# New databases get large pages: multi-MB blobs then span a quarter as many overflow pages as with the 4 KiB default.
+# Existing databases keep their page size until ``vacuum``.
+PAGE_SIZE = 16 * 1024
+# Blobs are streamed in and out in pieces of this size.
+CHUNK_SIZE = 1024 * 1024
+
+_cache_kib = 64 * 1024
+_mmap_bytes = 256 * 1024 * 1024
+# How much of a compressed blob is kept in memory before spilling to disk while it is written.
+_spool_size = 64 * 1024 * 1024
+
+
+def connect(
+    database: str | Path,
+    readonly: bool = False,
+    uri: bool = False,
+    timeout: float = 10,
+    check_same_thread: bool = True,
+) -> sql.Connection:
+    """Opens ``database`` in WAL mode, so readers never block the writer or each other.
+
+    ``readonly`` opens it with ``mode=ro``; a read-only connection cannot switch the journal mode, so the database
+    must have been opened for writing at least once before.
+    """
+    if readonly:
+        if not uri:
+            database, uri = f"file:{Path(database).resolve()}?mode=ro", True
+        elif "mode=" not in str(database):
+            database = f"{database}{'&' if '?' in str(database) else '?'}mode=ro"
+    con = sql.connect(
+        database, uri=uri, timeout=timeout, check_same_thread=check_same_thread
+    )
+    if not readonly:
+        if con.execute("PRAGMA page_count").fetchone()[0] == 0:
+            con.execute(f"PRAGMA page_size = {PAGE_SIZE}")
+        con.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode NORMAL only risks the last transactions on power loss, never corruption
+        con.execute("PRAGMA synchronous = NORMAL")
+    con.execute(f"PRAGMA cache_size = -{_cache_kib}")
+    con.execute(f"PRAGMA mmap_size = {_mmap_bytes}")
+    return con
+
+
+def vacuum(database: str | Path, uri: bool = False) -> int:
+    """Rebuilds ``database`` with ``PAGE_SIZE`` pages and returns the new page size. The page size of a WAL database
+    can only change while it is briefly out of WAL mode, so this needs exclusive access.
+    """
+    con = sql.connect(database, uri=uri, timeout=10)
+    try:
+        con.execute("PRAGMA journal_mode = DELETE")
+        con.execute(f"PRAGMA page_size = {PAGE_SIZE}")
+        con.execute("VACUUM")
+        con.execute("PRAGMA journal_mode = WAL")
+        return con.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        con.close()
+
+
+class Pool(object):
+    """Up to ``size`` connections to one database, shared between threads.
+
+    Connections are opened on first demand and reused afterwards; ``connection()`` blocks while all of them are in
+    use. A connection whose block raises is rolled back before it is handed out again.
+    """
+
+    def __init__(
+        self,
+        database: str | Path,
+        size: int = 4,
+        readonly: bool = False,
+        uri: bool = False,
+        timeout: float = 10,
+    ):
+        assert size > 0
+        self.database, self.size, self.timeout = database, size, timeout
+        self.readonly, self.uri = readonly, uri
+        # None is the sentinel close() leaves behind for callers waiting on a connection
+        self._idle: queue.LifoQueue[sql.Connection | None] = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @contextmanager
+    def connection(self) -> Iterator[sql.Connection]:
+        con = self._acquire()
+        try:
+            yield con
+        except BaseException:
+            con.rollback()
+            raise
+        finally:
+            if self._closed:
+                con.close()
+            else:
+                self._idle.put(con)
+
+    def _acquire(self) -> sql.Connection:
+        if self._closed:
+            raise RuntimeError("The pool is closed.")
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                opening = self._opened < self.size
+                if opening:
+                    self._opened += 1
+            if opening:
+                try:
+                    return connect(
+                        self.database,
+                        readonly=self.readonly,
+                        uri=self.uri,
+                        timeout=self.timeout,
+                        check_same_thread=False,
+                    )
+                except BaseException:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            con = self._idle.get()
+        if con is None:
+            # Hand the sentinel on to the next waiter
+            self._idle.put(None)
+            raise RuntimeError("The pool is closed.")
+        return con
+
+    def close(self) -> None:
+        """Closes the idle connections now and the others as they are returned. Callers waiting for a connection
+        raise ``RuntimeError``."""
+        self._closed = True
+        while True:
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if con is not None:
+                con.close()
+        self._idle.put(None)
+
+    def __enter__(self) -> "Pool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def read_chunks(
+    con: sql.Connection,
+    table: str,
+    column: str,
+    rowid: int,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """Yields the blob in ``table.column`` of row ``rowid`` piece by piece, without loading all of it.
+
+    :raises sqlite3.OperationalError: if there is no such row.
+    """
+    with con.blobopen(table, column, rowid, readonly=True) as blob:
+        while chunk := blob.read(chunk_size):
+            yield chunk
+
+
+def write_chunks(
+    con: sql.Connection,
+    table: str,
+    column: str,
+    rowid: int,
+    data: bytes | memoryview | Iterable[bytes],
+) -> int:
+    """Writes ``data``, bytes-like or an iterable of chunks, into the blob in ``table.column`` of row ``rowid`` one
+    piece at a time and returns the bytes written. The blob must already have its final size, e.g. from
+    ``zeroblob(n)``: binding a whole value would have SQLite copy all of it first.
+
+    :raises ValueError: if the data does not fit the blob.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        view = memoryview(data).cast("B")
+        data = (view[ii : ii + CHUNK_SIZE] for ii in range(0, len(view), CHUNK_SIZE))
+    written = 0
+    with con.blobopen(table, column, rowid) as blob:
+        for chunk in data:
+            blob.write(chunk)
+            written += len(chunk)
+    return written
+
+
+# Content-addressed blobs, keyed by the blake2b of their content
+
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def setup(con: sql.Connection) -> None:
+    # blob is last so looking up a key or size never walks its overflow pages
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs
+        (
+            blobID INTEGER PRIMARY KEY ASC,
+            blake2b TEXT UNIQUE NOT NULL ON CONFLICT ABORT,
+            sizeBytes INTEGER NOT NULL ON CONFLICT ABORT,
+            xz INTEGER NOT NULL ON CONFLICT ABORT DEFAULT 0,
+            blob BLOB NOT NULL ON CONFLICT ABORT
+        );
+        """
+    )
+    columns = {row[1] for row in con.execute("PRAGMA table_info(blobs)")}
+    if "xz" not in columns:
+        con.execute("ALTER TABLE blobs ADD COLUMN xz INTEGER NOT NULL DEFAULT 0")
+    con.commit()
+
+
+def _insert(
+    con: sql.Connection,
+    digest: str,
+    size_bytes: int,
+    data: memoryview | Iterable[bytes],
+    xz: bool,
+) -> int:
+    # Preallocates the blob and fills it chunk by chunk. Compressed blobs are spooled first, since their size is
+    # only known at the end.
+    if not xz:
+        blob_id = con.execute(
+            "INSERT INTO blobs (blake2b, sizeBytes, xz, blob) VALUES (?, ?, 0, zeroblob(?))",
+            (digest, size_bytes, size_bytes),
+        ).lastrowid
+        write_chunks(con, "blobs", "blob", blob_id, data)
+        return blob_id
+
+    compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_SHA256)
+    with tempfile.SpooledTemporaryFile(max_size=_spool_size) as spool:
+        if isinstance(data, memoryview):
+            data = (
+                data[ii : ii + CHUNK_SIZE] for ii in range(0, len(data), CHUNK_SIZE)
+            )
+        for chunk in data:
+            spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        blob_id = con.execute(
+            "INSERT INTO blobs (blake2b, sizeBytes, xz, blob) VALUES (?, ?, 1, zeroblob(?))",
+            (digest, size_bytes, spool.tell()),
+        ).lastrowid
+        spool.seek(0)
+        write_chunks(
+            con, "blobs", "blob", blob_id, iter(partial(spool.read, CHUNK_SIZE), b"")
+        )
+    return blob_id
+
+
+def put(con: sql.Connection, data: bytes | BinaryIO, xz: bool = False) -> str:
+    """Stores ``data`` unless a blob with the same content is already present and returns its key. Does not commit.
+
+    With ``xz`` the blob is stored XZ compressed; it is still keyed, and read back, by its uncompressed content.
+
+    Bytes-like data is written a chunk at a time without copying it. A file is read twice from its current position,
+    once to hash it and once to copy it into a preallocated blob, so only one chunk of it is in memory at a time. It
+    must not change in between.
+
+    :raises ValueError: if the file changed between the two reads.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        view = memoryview(data).cast("B")
+        digest = blob_hash(view)
+        if not has(con, digest):
+            _insert(con, digest, len(view), view, xz)
+        return digest
+
+    start = data.tell()
+    hasher, size_bytes = hashlib.blake2b(digest_size=16), 0
+    while chunk := data.read(CHUNK_SIZE):
+        hasher.update(chunk)
+        size_bytes += len(chunk)
+    digest = hasher.hexdigest()
+    if has(con, digest):
+        return digest
+
+    data.seek(start)
+    hasher = hashlib.blake2b(digest_size=16)
+
+    def _chunks() -> Iterator[bytes]:
+        remaining = size_bytes
+        while remaining and (chunk := data.read(min(CHUNK_SIZE, remaining))):
+            hasher.update(chunk)
+            remaining -= len(chunk)
+            yield chunk
+
+    blob_id = _insert(con, digest, size_bytes, _chunks(), xz)
+    # A short read leaves zeros at the end of the blob, which the hash also catches
+    if hasher.hexdigest() != digest:
+        con.execute("DELETE FROM blobs WHERE blobID = ?", (blob_id,))
+        raise ValueError("The file changed while it was being stored.")
+    return digest
+
+
+def has(con: sql.Connection, digest: str) -> bool:
+    return (
+        con.execute("SELECT 1 FROM blobs WHERE blake2b = ?", (digest,)).fetchone()
+        is not None
+    )
+
+
+class _XZBlob(lzma.LZMAFile):
+    # Decompresses a blob as it is read, and closes the blob with itself.
+
+    def __init__(self, blob: sql.Blob):
+        super().__init__(blob, format=lzma.FORMAT_XZ)
+        self._blob = blob
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            self._blob.close()
+
+
+def open_blob(con: sql.Connection, digest: str) -> BinaryIO:
+    """Opens a blob for piecewise reading of its content. Use it as a context manager.
+
+    :raises KeyError: if there is no such blob.
+    """
+    row = con.execute(
+        "SELECT blobID, xz FROM blobs WHERE blake2b = ?", (digest,)
+    ).fetchone()
+    if row is None:
+        raise KeyError(f"No blob {digest}.")
+    blob = con.blobopen("blobs", "blob", row[0], readonly=True)
+    return _XZBlob(blob) if row[1] else blob
+
+
+def get(con: sql.Connection, digest: str) -> bytes:
+    """Returns the whole content of a blob. Use ``open_blob`` or ``copy`` for large ones.
+
+    :raises KeyError: if there is no such blob.
+    :raises lzma.LZMAError:
+    """
+    with open_blob(con, digest) as fd:
+        return fd.read()
+
+
+def copy(con: sql.Connection, digest: str, fd: BinaryIO) -> int:
+    """Writes the content of a blob to ``fd`` one chunk at a time and returns the number of bytes written.
+
+    :raises KeyError: if there is no such blob.
+    :raises lzma.LZMAError:
+    """
+    size_bytes = 0
+    with open_blob(con, digest) as blob:
+        while chunk := blob.read(CHUNK_SIZE):
+            fd.write(chunk)
+            size_bytes += len(chunk)
+    return size_bytes
+
+
+def main() -> None:
+    usage = (
+        f"Usage: {sys.argv[0]} DATABASE (put [--xz] FILE | get DIGEST FILE | vacuum)"
+    )
+    if len(sys.argv) < 3:
+        print(usage)
+        exit(1)
+    database, command, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    if command == "vacuum" and not args:
+        print(f"Page size is now {vacuum(database)} bytes.")
+    elif command == "put" and len(args) in (1, 2) and args[:-1] in ([], ["--xz"]):
+        con = connect(database)
+        setup(con)
+        with open(args[-1], "rb") as fd:
+            print(put(con, fd, xz=len(args) == 2))
+        con.commit()
+        con.close()
+    elif command == "get" and len(args) == 2:
+        con = connect(database, readonly=True)
+        with open(args[1], "wb") as fd:
+            print(f"{copy(con, args[0], fd)} bytes")
+        con.close()
+    else:
+        print(usage)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Single entry point for the vidyascape-re tools: ``python vre.py TOOL COMMAND [ARGS...]``.
+
+Nothing beyond the standard library is imported until a command runs, so ``--help`` and the command listing are
+instant. Each command runs its script as ``__main__`` with the script's own directory on ``sys.path``, exactly as
+if it had been started directly.
+"""
+
+import argparse
+import os
+import re
+import runpy
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+root = Path(__file__).parent.resolve()
+
+
+class Command(NamedTuple):
+    script: str  # relative to root
+    help: str
+    # Run from the script's directory, for scripts that use relative database paths
+    chdir: bool = False
+
+
+COMMANDS: dict[str, dict[str, Command]] = {
+    "andradite": {
+        "batch": Command(
+            "andradite/batch.py", "Run analyses over every archived version"
+        ),
+        "chunks": Command(
+            "andradite/chunk_diff.py",
+            "Chunk the cache and diff against the last version",
+        ),
+        "regions": Command(
+            "andradite/regions.py", "Segment files into labeled entropy regions"
+        ),
+        "classes": Command(
+            "andradite/class_index.py", "Index class-file constants of archived jars"
+        ),
+        "entropy": Command(
+            "andradite/binary_entropy.py", "Plot the binary entropy of a cache file"
+        ),
+        "bigrams": Command(
+            "andradite/cache_analysis.py",
+            "Plot the bigram surprise of the sprite index",
+        ),
+    },
+    "spessartine": {
+        "capture": Command(
+            "spessartine/capture.py", "Capture game traffic into the database"
+        ),
+        "reassemble": Command(
+            "spessartine/reassembly.py", "Reassemble TCP streams from captured packets"
+        ),
+        "cluster": Command(
+            "spessartine/clustering.py", "Cluster packets into message types"
+        ),
+        "fields": Command(
+            "spessartine/fields.py", "Propose field boundaries for each message type"
+        ),
+        "columns": Command(
+            "spessartine/columnar.py", "Export packets to memory-mapped columns"
+        ),
+        "query": Command(
+            "spessartine/query.py", "Serve read-only packet queries over localhost HTTP"
+        ),
+        "stats": Command("spessartine/stats.py", "Print the latest capture statistics"),
+        "bench": Command(
+            "spessartine/synthetic.py", "Benchmark ingestion with synthetic traffic"
+        ),
+        "codec": Command("spessartine/codec.py", "Benchmark packet compression codecs"),
+        "analyze": Command(
+            "spessartine/packet_analysis.py", "Load and analyze stored captures"
+        ),
+    },
+    "zircon": {
+        "simulate": Command("zircon/simulator.py", "Run the game mechanics simulator"),
+    },
+    "lawsonite": {
+        "dataset": Command(
+            "lawsonite/create_dataset.py",
+            "Build the icon dataset from item descriptors",
+        ),
+        "classify": Command(
+            "lawsonite/classifier.py", "Classify the inventory in a screenshot"
+        ),
+        "serve": Command(
+            "lawsonite/service.py",
+            "Serve screenshot classification over localhost HTTP",
+        ),
+        "phash": Command(
+            "lawsonite/phash.py", "Find near-duplicate icons by perceptual hash"
+        ),
+        "augment": Command(
+            "lawsonite/augment.py", "Benchmark the augmentation pipeline"
+        ),
+    },
+    "jar": {
+        "download": Command(
+            "dl_standalone_latest.py",
+            "Download and archive the latest client jar",
+            True,
+        ),
+        "migrate": Command(
+            "jar_store.py", "Convert archived jars to content-addressed members", True
+        ),
+    },
+}
+
+# Startup budget for "vre.py budget": wall time of each "--help" invocation, and the self time -X importtime reports
+# for the modules it imports beyond those a bare interpreter imports anyway.
+BUDGET_SECONDS = 0.5
+BUDGET_IMPORT_MS = 30.0
+
+
+def run(tool: str, command: str, args: list[str]) -> None:
+    """Runs one command as ``__main__`` with ``args`` as its ``sys.argv[1:]``."""
+    script = root / COMMANDS[tool][command].script
+    sys.argv = [str(script), *args]
+    sys.path.insert(0, str(script.parent))
+    if COMMANDS[tool][command].chdir:
+        os.chdir(script.parent)
+    runpy.run_path(str(script), run_name="__main__")
+
+
+def _imports(*argv: str) -> tuple[dict[str, int], int]:
+    # -X importtime lines: "import time: <self us> | <cumulative us> | <indented module>"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", *argv], capture_output=True, text=True
+    )
+    modules = {
+        m.group(2): int(m.group(1))
+        for m in re.finditer(
+            r"^import time:\s+(\d+)\s*\|\s*\d+\s*\|\s*(\S+)", proc.stderr, re.MULTILINE
+        )
+    }
+    return modules, proc.returncode
+
+
+def budget(
+    seconds: float = BUDGET_SECONDS, import_ms: float = BUDGET_IMPORT_MS
+) -> bool:
+    """Starts a fresh interpreter for the top-level and every per-tool ``--help`` and checks each against the
+    budget. Prints one line per invocation and returns whether all of them fit."""
+    script = str(Path(__file__).resolve())
+    baseline, _ = _imports("-c", "pass")
+    ok = True
+    for argv in [["--help"], *([tool, "--help"] for tool in COMMANDS)]:
+        t = time.perf_counter()
+        subprocess.run([sys.executable, script, *argv], stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - t
+        modules, returncode = _imports(script, *argv)
+        added = {name: us for name, us in modules.items() if name not in baseline}
+        imported = sum(added.values()) / 1000
+        fits = returncode == 0 and elapsed <= seconds and imported <= import_ms
+        ok &= fits
+        print(
+            f"[{'+' if fits else '!'}] vre.py {' '.join(argv):<24} {elapsed * 1000:>8.1f} ms wall "
+            f"{imported:>8.1f} ms imports ({len(added)} modules)"
+        )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="vre.py", description=__doc__.splitlines()[0])
+    tools = parser.add_subparsers(dest="tool", required=True, metavar="TOOL")
+    for tool, commands in COMMANDS.items():
+        sub = tools.add_parser(
+            tool,
+            help=", ".join(commands),
+            description="\n".join(
+                f"  {name:<12} {c.help}" for name, c in commands.items()
+            ),
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+        sub.add_argument("command", choices=commands, metavar="COMMAND")
+        sub.add_argument("args", nargs=argparse.REMAINDER, help="passed to the command")
+    check = tools.add_parser("budget", help="check cold-start time against the budget")
+    check.add_argument("--seconds", type=float, default=BUDGET_SECONDS)
+    check.add_argument("--import-ms", type=float, default=BUDGET_IMPORT_MS)
+    args = parser.parse_args()
+
+    if args.tool == "budget":
+        exit(0 if budget(args.seconds, args.import_ms) else 1)
+    run(args.tool, args.command, args.args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
+import vre
+
+# Dependencies that are slow to import and only some commands need.
+HEAVY = ("numpy", "matplotlib", "pyshark", "Levenshtein", "requests")
+
+
+def test_budget():
+    assert vre.budget()
+
+
+@pytest.mark.parametrize("tool", ["spessartine", "lawsonite"])
+def test_help_imports_no_heavy_dependency(tool):
+    modules, returncode = vre._imports(
+        str(Path(vre.__file__).resolve()), tool, "--help"
+    )
+    assert returncode == 0
+    assert modules, "-X importtime reported no imports"
+    imported = {name.partition(".")[0] for name in modules}
+    assert not imported & set(HEAVY)